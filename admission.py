@@ -0,0 +1,211 @@
+"""
+Admission control in front of the routes that run bcrypt.
+
+A request costs a bcrypt round when it sends Basic credentials, or logs in, with
+credentials the credential cache has not verified recently. Before such a request
+reaches a handler it takes a token from the bucket of its client address and one
+from the bucket of the email it names. An empty bucket answers 429 with
+Retry-After. Requests authenticated by Bearer token or cached credentials pass
+without touching the buckets.
+
+Load is shed with 503 before any work is done. Requests that would hash are shed
+while the hash pool queue is at ADMISSION_HASH_QUEUE_LIMIT, and every request
+while ADMISSION_DB_WAITING_LIMIT callers wait for a pooled connection.
+/healthz and /metrics are never rejected.
+
+Buckets are kept in insertion-ordered dicts, oldest access first. Each take drops
+at most a couple of buckets from the front that have refilled completely, since
+a full bucket is the same as no bucket, and ADMISSION_MAX_BUCKETS bounds the
+rest. Memory therefore stays bounded however many addresses or emails are seen,
+and no request pays for a scan.
+"""
+import base64
+import binascii
+import os
+import time
+from collections import OrderedDict
+
+import orjson
+
+import database
+import executors
+import metrics
+from auth import credential_cache
+from utils import read_body, replay_receive
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+# Password checks per second and burst size, per client address and per email
+RATE_LIMIT_IP_PER_SECOND = float(os.getenv("RATE_LIMIT_IP_PER_SECOND", "20"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "40"))
+RATE_LIMIT_EMAIL_PER_SECOND = float(os.getenv("RATE_LIMIT_EMAIL_PER_SECOND", "1"))
+RATE_LIMIT_EMAIL_BURST = float(os.getenv("RATE_LIMIT_EMAIL_BURST", "10"))
+ADMISSION_MAX_BUCKETS = int(os.getenv("ADMISSION_MAX_BUCKETS", "100000"))
+# Queue depths at which requests are shed, 0 disables the check
+ADMISSION_HASH_QUEUE_LIMIT = int(os.getenv("ADMISSION_HASH_QUEUE_LIMIT", "32"))
+ADMISSION_DB_WAITING_LIMIT = int(os.getenv("ADMISSION_DB_WAITING_LIMIT", "64"))
+
+LOGIN_PATH = "/v3/user/login"
+_EXEMPT_PATHS = {"/healthz", "/metrics"}
+
+
+class TokenBuckets:
+    """
+    Token buckets keyed by client, refilled at ``rate`` tokens per second up to ``burst``.
+
+    Only used from the event loop thread, so it takes no lock.
+    """
+
+    __slots__ = ("rate", "burst", "max_size", "_buckets", "_idle", "evictions")
+
+    def __init__(self, rate, burst, max_size=ADMISSION_MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        # Seconds after which an untouched bucket is full again
+        self._idle = burst / rate
+        self.evictions = 0
+
+    def take(self, key, now=None):
+        """
+        Take one token.
+
+        :return: 0 when the request may go ahead, otherwise the seconds until a token is available
+        """
+        now = time.monotonic() if now is None else now
+        self._sweep(now)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= 1:
+            self._buckets[key] = (tokens - 1, now)
+            wait = 0
+        else:
+            self._buckets[key] = (tokens, now)
+            wait = (1 - tokens) / self.rate
+        if len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+            self.evictions += 1
+        return wait
+
+    def _sweep(self, now, limit=2):
+        for _ in range(limit):
+            if not self._buckets:
+                return
+            key, (_, last) = next(iter(self._buckets.items()))
+            if now - last < self._idle:
+                return
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def _header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _basic_email(authorization):
+    try:
+        return base64.b64decode(authorization[6:]).decode("utf-8").partition(":")[0]
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        return None
+
+
+class AdmissionControl:
+    """Buckets, shedding thresholds and rejection counts shared by the middleware of a worker."""
+
+    def __init__(self):
+        self.ip_buckets = TokenBuckets(RATE_LIMIT_IP_PER_SECOND, RATE_LIMIT_IP_BURST)
+        self.email_buckets = TokenBuckets(RATE_LIMIT_EMAIL_PER_SECOND, RATE_LIMIT_EMAIL_BURST)
+        self.hash_queue_limit = ADMISSION_HASH_QUEUE_LIMIT
+        self.db_waiting_limit = ADMISSION_DB_WAITING_LIMIT
+        self.rejected = {"ip": 0, "email": 0, "hash_queue": 0, "db_pool": 0}
+
+    def stats(self):
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "rejected": dict(self.rejected),
+            "ip_buckets": len(self.ip_buckets),
+            "email_buckets": len(self.email_buckets),
+            "evictions": self.ip_buckets.evictions + self.email_buckets.evictions,
+        }
+
+
+admission_control = AdmissionControl()
+
+
+class AdmissionMiddleware:
+    """ASGI middleware rate limiting password checks and shedding load, see the module docstring."""
+
+    def __init__(self, app, control=None):
+        self.app = app
+        self.control = control or admission_control
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in _EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+
+        control = self.control
+        if control.db_waiting_limit and getattr(database.request_pool(), "waiting", 0) >= control.db_waiting_limit:
+            return await self.reject(send, "db_pool", 503, 1)
+
+        email = None
+        authorization = _header(scope, b"authorization")
+        if authorization and authorization.startswith("Basic "):
+            if credential_cache.principal(authorization) is not None:
+                return await self.app(scope, receive, send)
+            email = _basic_email(authorization) or ""
+        elif scope["method"] == "POST" and scope["path"] == LOGIN_PATH:
+            messages, body = await read_body(receive)
+            receive = replay_receive(messages, receive)
+            email = self._login_email(body)
+            if email is None:
+                # Cached credentials, or a body validation rejects before any password check
+                return await self.app(scope, receive, send)
+        else:
+            return await self.app(scope, receive, send)
+
+        if control.hash_queue_limit and executors.hash_pool.queued >= control.hash_queue_limit:
+            return await self.reject(send, "hash_queue", 503, 1)
+        client = scope.get("client")
+        wait = control.ip_buckets.take(client[0] if client else "")
+        if wait:
+            return await self.reject(send, "ip", 429, wait)
+        wait = control.email_buckets.take(email.lower())
+        if wait:
+            return await self.reject(send, "email", 429, wait)
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    def _login_email(body):
+        """The email of a login body, None when the credentials are cached or the body is not a login."""
+        try:
+            data = orjson.loads(body)
+            email, password = data["email"], data["password"]
+        except (orjson.JSONDecodeError, TypeError, KeyError):
+            return None
+        if not isinstance(email, str) or not isinstance(password, str) or not email or not password:
+            return None
+        # Same cache key authenticate_user verifies against
+        credentials = "Basic " + base64.b64encode("{}:{}".format(email, password).encode()).decode()
+        if credential_cache.principal(credentials) is not None:
+            return None
+        return email
+
+    async def reject(self, send, reason, status_code, retry_after):
+        self.control.rejected[reason] += 1
+        metrics.incr("admission.rejected.{}".format(reason))
+        message = b"Too many requests" if status_code == 429 else b"Server is overloaded"
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"retry-after", str(max(1, int(retry_after + 0.999))).encode())],
+        })
+        await send({"type": "http.response.body", "body": b'{"message":"' + message + b'"}'})
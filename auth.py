@@ -0,0 +1,370 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+
+import orjson
+from fastapi import Depends, Header, Request, status
+from sqlalchemy import select
+
+import metrics
+import models
+from cache import LOST_BEFORE, CacheUnavailable, backend_call, load_backend
+from database import get_session
+from executors import run_hash
+from health import db_health
+from passwords import verify_password
+from schema import ResponseException
+from utils import response
+
+logger = logging.getLogger("cloud")
+
+AUTH_CACHE_ENABLED = os.getenv("AUTH_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+# Comma separated kid:secret pairs, the first key signs and all of them verify
+AUTH_TOKEN_KEYS = os.getenv("AUTH_TOKEN_KEYS", "")
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "3600"))
+AUTH_REVOKED_TOKENS_SIZE = int(os.getenv("AUTH_REVOKED_TOKENS_SIZE", "10000"))
+
+Principal = namedtuple("Principal", ["id", "email"])
+
+
+class CredentialCache:
+    """
+    Bounded LRU+TTL cache of credentials that passed bcrypt verification.
+
+    Entries are keyed by an HMAC of the credentials, so plaintext passwords never
+    live in memory longer than the request, and remember the password hash they
+    were verified against so a changed hash invalidates them.
+    """
+
+    def __init__(self, max_size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL, enabled=AUTH_CACHE_ENABLED, secret=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self._secret = secret or os.getenv("AUTH_CACHE_KEY", "").encode() or secrets.token_bytes(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, credentials):
+        return hmac.new(self._secret, credentials.encode(), hashlib.sha256).digest()
+
+    def get(self, credentials, password_hash):
+        if not self.enabled:
+            return False
+        key = self._key(credentials)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False
+            cached_hash, _, expires_at = entry
+            if expires_at < time.monotonic() or not hmac.compare_digest(cached_hash, password_hash):
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def principal(self, credentials):
+        """Id of the user whose credentials were verified recently, without loading the user."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(self._key(credentials))
+            if entry is None or entry[2] < time.monotonic():
+                return None
+            return entry[1]
+
+    def put(self, credentials, password_hash, user_id=None):
+        if not self.enabled:
+            return
+        key = self._key(credentials)
+        with self._lock:
+            self._entries[key] = (password_hash, user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+credential_cache = CredentialCache()
+
+
+async def verify_credentials(credentials, password, password_hash, user_id=None):
+    """
+    Verify a password against its stored hash on the hash pool, skipping bcrypt
+    for credentials that were verified recently.
+
+    :param credentials: the raw Authorization header value used as the cache key
+    :param password: plaintext password sent by the client
+    :param password_hash: bcrypt hash stored for the user
+    :param user_id: id of the user, remembered for ``CredentialCache.principal``
+    :return: True if the password matches
+    """
+    if credential_cache.get(credentials, password_hash):
+        return True
+    with metrics.timer("bcrypt.verify"):
+        verified = await run_hash(verify_password, password, password_hash)
+    if not verified:
+        return False
+    credential_cache.put(credentials, password_hash, user_id)
+    return True
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def parse_token_keys(spec):
+    keys = OrderedDict()
+    for pair in filter(None, (item.strip() for item in spec.split(","))):
+        kid, secret = pair.split(":", 1)
+        keys[kid] = secret.encode()
+    return keys
+
+
+class TokenSigner:
+    """
+    Issues and verifies ``kid.payload.signature`` access tokens signed with HMAC-SHA256.
+
+    The payload carries the user id, email, expiry and a token id, so a valid
+    signature is enough to authenticate a request without a query or bcrypt.
+    Keys are rotated by putting the new key first in AUTH_TOKEN_KEYS and keeping
+    the old one listed until its tokens expired. Revoked token ids are remembered
+    until the token would have expired anyway.
+
+    Revocations fail closed: while the backend cannot be reached no token is
+    accepted, and after a CacheServer restart lost them, tokens issued before it
+    are rejected.
+    """
+
+    def __init__(self, keys=None, ttl=AUTH_TOKEN_TTL, revoked_size=AUTH_REVOKED_TOKENS_SIZE, backend=None):
+        self.keys = keys or parse_token_keys(AUTH_TOKEN_KEYS)
+        if not self.keys:
+            logger.warning("AUTH_TOKEN_KEYS is not set, access tokens are only valid in this process")
+            self.keys = OrderedDict(local=secrets.token_bytes(32))
+        self.ttl = ttl
+        # Shared between workers with a shared CACHE_BACKEND, so a logout holds on every worker
+        self.revoked = backend or load_backend(name="revoked_tokens", max_size=revoked_size, ttl=ttl)
+        self.issued = 0
+        self.rejected = 0
+
+    @property
+    def active_kid(self):
+        return next(iter(self.keys))
+
+    def _sign(self, kid, signing_input):
+        return _b64encode(hmac.new(self.keys[kid], signing_input.encode(), hashlib.sha256).digest())
+
+    def issue(self, user_id, email):
+        now = int(time.time())
+        claims = {"sub": str(user_id), "email": email, "iat": now, "exp": now + self.ttl, "jti": uuid.uuid4().hex}
+        signing_input = "{}.{}".format(self.active_kid, _b64encode(orjson.dumps(claims)))
+        self.issued += 1
+        return "{}.{}".format(signing_input, self._sign(self.active_kid, signing_input))
+
+    def verify(self, token):
+        """Return the claims of a valid, unexpired and unrevoked token, otherwise None."""
+        claims = self._decode(token)
+        if claims is None or self._revoked(claims):
+            return None
+        return claims
+
+    async def check(self, token):
+        """``verify`` for the event loop, a remote revocation backend is asked from the io pool."""
+        claims = self._decode(token)
+        if claims is None or await backend_call(self.revoked, self._revoked, claims):
+            return None
+        return claims
+
+    def _decode(self, token):
+        try:
+            kid, payload, signature = token.split(".")
+            # Compared as bytes, compare_digest rejects str with non-ASCII characters with a TypeError
+            if kid not in self.keys or not hmac.compare_digest(signature.encode(), self._sign(kid, kid + "." + payload).encode()):
+                raise ValueError("bad signature")
+            claims = orjson.loads(_b64decode(payload))
+        except (ValueError, binascii.Error, orjson.JSONDecodeError):
+            self.rejected += 1
+            return None
+        if claims["exp"] < time.time():
+            self.rejected += 1
+            return None
+        return claims
+
+    def _revoked(self, claims):
+        try:
+            # Tokens issued before the iat claim was added are dated from their expiry
+            issued = claims.get("iat", claims["exp"] - self.ttl)
+            revoked = (self.revoked.get("revoked:{}".format(claims["jti"])) is not None
+                       or issued <= self.revoked.counter(LOST_BEFORE))
+        except CacheUnavailable:
+            metrics.incr("auth.revocations_unavailable")
+            revoked = True
+        if revoked:
+            self.rejected += 1
+        return revoked
+
+    def revoke(self, claims):
+        """Remember the token id until the token would have expired anyway, raises CacheUnavailable."""
+        self.revoked.set("revoked:{}".format(claims["jti"]), True, ttl=max(0, claims["exp"] - time.time()))
+
+    def stats(self):
+        return {
+            "active_kid": self.active_kid,
+            "keys": len(self.keys),
+            "issued": self.issued,
+            "rejected": self.rejected,
+            "revoked": self.revoked.stats().get("size", 0),
+        }
+
+
+token_signer = TokenSigner()
+
+
+async def cached_principal(authorization, db):
+    """
+    Id of the caller when it is known without loading an assignment or running bcrypt:
+    a valid Bearer token, or Basic credentials verified recently against the password
+    hash the user still has. The hash is read by primary key, so a changed password
+    ends the cached credentials right away.
+    """
+    if not authorization:
+        return None
+    if authorization.startswith("Bearer "):
+        claims = await token_signer.check(authorization[7:])
+        return uuid.UUID(claims["sub"]) if claims else None
+    user_id = credential_cache.principal(authorization)
+    if user_id is None:
+        return None
+    password_hash = await db.scalar(select(models.User.password).filter_by(id=user_id))
+    return user_id if password_hash and credential_cache.get(authorization, password_hash) else None
+
+
+async def authenticate(authorization, db):
+    """
+    Resolve the Authorization header to the calling user.
+
+    Bearer tokens are checked by signature only. Basic credentials load the user
+    and verify the password, skipping bcrypt when the credential cache has them.
+
+    :return: a Principal, or the error response to send
+    """
+    if authorization is None:
+        return response("Authorization header missing", status.HTTP_400_BAD_REQUEST)
+    auth_type, _, encoded_code = authorization.partition(" ")
+    if auth_type == "Bearer":
+        claims = await token_signer.check(encoded_code)
+        if not claims:
+            return response("Invalid or expired token", status.HTTP_401_UNAUTHORIZED)
+        return Principal(uuid.UUID(claims["sub"]), claims["email"])
+    if auth_type != "Basic":
+        return response("Authorization type not supported", status.HTTP_400_BAD_REQUEST)
+
+    try:
+        email, password = decode_basic(encoded_code)
+    except (ValueError, binascii.Error, UnicodeDecodeError) as e:
+        return response("Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST)
+    user = await db.scalar(select(models.User).filter_by(email=email))
+    if not user:
+        return response("User not found", status.HTTP_404_NOT_FOUND)
+    if not await verify_credentials(authorization, password, user.password, user.id):
+        return response("Invalid authorization", status.HTTP_401_UNAUTHORIZED)
+    return Principal(user.id, user.email)
+
+
+def decode_basic(encoded_code):
+    email, password = base64.b64decode(encoded_code).decode("utf-8").split(":")
+    return email, password
+
+
+class OwnedAssignment:
+    """
+    Dependency that loads the assignment named by the ``id`` path parameter and checks
+    the caller owns it.
+
+    Basic credentials are resolved in the same round trip as the assignment: the
+    caller's user row is outer joined by email, so a protected request runs one
+    query. Bearer tokens need no user row at all. The principal is kept on
+    ``request.state.principal`` for the handler.
+    """
+
+    def __init__(self, not_found_status=status.HTTP_404_NOT_FOUND):
+        self.not_found_status = not_found_status
+
+    async def __call__(self, id: uuid.UUID, request: Request, authorization: str = Header(None),
+                       db=Depends(get_session)):
+        return await self.resolve(id, request, authorization, db)
+
+    async def resolve(self, id, request, authorization, db):
+        if not db_health.is_available():
+            raise ResponseException(response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True))
+        principal = getattr(request.state, "principal", None)
+        auth_type, _, encoded_code = (authorization or "").partition(" ")
+
+        if principal is not None or auth_type != "Basic":
+            assignment = await db.scalar(select(models.Assignment).filter_by(id=id))
+            if not assignment:
+                raise ResponseException(response("Assignment not found", self.not_found_status))
+            if principal is None:
+                principal = await authenticate(authorization, db)
+                if not isinstance(principal, Principal):
+                    raise ResponseException(principal)
+        else:
+            try:
+                email, password = decode_basic(encoded_code)
+            except (ValueError, binascii.Error, UnicodeDecodeError) as e:
+                raise ResponseException(response("Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST))
+            row = (await db.execute(select(models.Assignment, models.User.id, models.User.password)
+                                    .outerjoin(models.User, models.User.email == email)
+                                    .where(models.Assignment.id == id))).first()
+            if not row:
+                raise ResponseException(response("Assignment not found", self.not_found_status))
+            assignment, user_id, password_hash = row
+            if user_id is None:
+                raise ResponseException(response("User not found", status.HTTP_404_NOT_FOUND))
+            if not await verify_credentials(authorization, password, password_hash, user_id):
+                raise ResponseException(response("Invalid authorization", status.HTTP_401_UNAUTHORIZED))
+            principal = Principal(user_id, email)
+
+        request.state.principal = principal
+        # Check if user is authorized to access this data
+        if assignment.owner_user_id != principal.id:
+            raise ResponseException(response("Not authorized to access other user's data", status.HTTP_403_FORBIDDEN))
+        return assignment
+
+
+owned_assignment = OwnedAssignment()
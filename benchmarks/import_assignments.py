@@ -0,0 +1,95 @@
+"""
+Throughput of the bulk assignment import.
+
+Measures parsing and validation alone, then full imports of a generated CSV and
+NDJSON upload at several batch sizes, against the old way of one ORM insert and
+commit per assignment, as ``POST /v3/assignments`` does. One row in twenty is
+invalid. Needs DATABASE_URL to point at a database the benchmark may write to.
+
+    python -m benchmarks.import_assignments [rows]
+"""
+import io
+import json
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import delete
+
+import models
+from database import SessionLocal, init_engine
+from import_assignments import AssignmentImport, import_assignments
+
+
+def generate(rows, format):
+    lines = ["name,points,num_of_attemps,deadline"] if format == "csv" else []
+    for i in range(rows):
+        points = 11 if i % 20 == 0 else i % 10 + 1
+        if format == "csv":
+            lines.append('"Assignment {}, week {}",{},{},2099-01-01T00:00:00'.format(i, i % 15, points, i % 100 + 1))
+        else:
+            lines.append(json.dumps({"name": "Assignment {}".format(i), "points": points,
+                                     "num_of_attemps": i % 100 + 1, "deadline": "2099-01-01T00:00:00"}))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def rate(rows, elapsed):
+    return round(rows / elapsed, 1) if elapsed else 0.0
+
+
+def parse_only(upload, format):
+    importer = AssignmentImport(uuid.uuid4(), format, batch_size=1000)
+    start = time.perf_counter()
+    rows = 0
+    for offset in range(0, len(upload), 1 << 16):
+        rows += sum(len(batch) for batch in importer.feed(upload[offset:offset + (1 << 16)]))
+    rows += sum(len(batch) for batch in importer.finish())
+    return {"rows_per_second": rate(rows, time.perf_counter() - start), "rejected": importer.rejected}
+
+
+def row_at_a_time(db, owner_id, rows):
+    start = time.perf_counter()
+    for i in range(rows):
+        db.add(models.Assignment(name="Assignment {}".format(i), points=i % 10 + 1, num_of_attemps=i % 100 + 1,
+                                 deadline=datetime(2099, 1, 1), owner_user_id=owner_id))
+        db.commit()
+    return {"rows_per_second": rate(rows, time.perf_counter() - start)}
+
+
+def clear(db, owner_id):
+    db.execute(delete(models.Assignment).filter_by(owner_user_id=owner_id))
+    db.commit()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    models.ensure_schema(init_engine())
+    db = SessionLocal()
+    email = "import-bench-{}@example.com".format(uuid.uuid4().hex)
+    owner = models.User(email=email, first_name="bench", last_name="bench", password="x")
+    db.add(owner)
+    db.commit()
+
+    results = {"rows": rows, "parse_and_validate": {}, "import": {}}
+    try:
+        for format in ("csv", "ndjson"):
+            upload = generate(rows, format)
+            results["parse_and_validate"][format] = parse_only(upload, format)
+            for batch_size in (100, 1000, 5000):
+                summary = import_assignments(email, io.BytesIO(upload), format, batch_size=batch_size)
+                results["import"]["{}_batch_{}".format(format, batch_size)] = {
+                    "rows_per_second": summary["rows_per_second"], "imported": summary["imported"],
+                    "rejected": summary["rejected"]}
+                clear(db, owner.id)
+        results["row_at_a_time"] = row_at_a_time(db, owner.id, min(rows, 2000))
+        clear(db, owner.id)
+    finally:
+        db.execute(delete(models.User).filter_by(id=owner.id))
+        db.commit()
+        db.close()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
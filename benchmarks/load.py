@@ -0,0 +1,277 @@
+"""
+Load test every route of the API and report throughput and latency percentiles.
+
+Users and assignments are seeded straight into DATABASE_URL at the chosen scale,
+then each route is driven by ``--concurrency`` concurrent clients for
+``--duration`` seconds (or ``--requests`` requests), one route after the other
+so the numbers do not mix. By default the app runs in-process through the ASGI
+transport with SNS stubbed; ``--url`` targets a running server instead (start it
+without SNS_TOPIC_ARN so events stay in the outbox).
+
+    DATABASE_URL=sqlite:////tmp/bench.db python -m benchmarks.load --users 20 --concurrency 16 --duration 5
+    python -m benchmarks.load --routes get_assignment,list_assignments --output results.json --compare baseline.json
+
+Each seeded assignment takes 100 submissions, so raise ``--users`` or
+``--assignments`` when the submission route starts answering 400.
+
+Results are printed and, with ``--output``, saved as JSON together with the
+commit they were measured on.
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import delete, insert, select
+
+import models
+from database import get_engine
+from passwords import pwd_context
+
+PASSWORD = "bench-password"
+ROUTES = ("healthz", "login", "create_assignment", "get_assignment", "update_assignment", "list_assignments",
+          "create_submission", "delete_assignment")
+
+
+class StubSNS:
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        return {"Successful": [{"Id": entry["Id"]} for entry in PublishBatchRequestEntries], "Failed": []}
+
+
+def seed(users, assignments_per_user):
+    """Insert benchmark users and their assignments. Every user shares one bcrypt hash to keep seeding fast."""
+    engine = get_engine()
+    models.ensure_schema(engine)
+    run_id = uuid.uuid4().hex[:8]
+    password_hash = pwd_context.hash(PASSWORD)
+    now = datetime.utcnow()
+    user_rows = [{"id": uuid.uuid4(), "first_name": "bench", "last_name": str(i), "password": password_hash,
+                  "email": "bench-{}-{}@example.com".format(run_id, i), "account_created": now, "account_updated": now}
+                 for i in range(users)]
+    assignment_rows = [{"id": uuid.uuid4(), "name": "bench {}".format(i), "points": 5, "num_of_attemps": 100,
+                        "deadline": now + timedelta(days=365), "owner_user_id": user["id"], "submission_count": 0,
+                        "assignment_created": now, "assignment_updated": now}
+                       for user in user_rows for i in range(assignments_per_user)]
+    with engine.begin() as connection:
+        connection.execute(insert(models.User.__table__), user_rows)
+        connection.execute(insert(models.Assignment.__table__), assignment_rows)
+    owned = {}
+    for row in assignment_rows:
+        owned.setdefault(row["owner_user_id"], []).append(row["id"])
+    return [{"id": user["id"], "email": user["email"], "assignments": owned.get(user["id"], [])} for user in user_rows]
+
+
+def cleanup(users):
+    user_ids = [user["id"] for user in users]
+    assignment_ids = select(models.Assignment.id).where(models.Assignment.owner_user_id.in_(user_ids))
+    submission_ids = select(models.Submission.id).where(models.Submission.assignment_id.in_(assignment_ids))
+    with get_engine().begin() as connection:
+        connection.execute(delete(models.SubmissionEvent).where(models.SubmissionEvent.submission_id.in_(submission_ids)))
+        connection.execute(delete(models.Submission).where(models.Submission.assignment_id.in_(assignment_ids)))
+        connection.execute(delete(models.Assignment).where(models.Assignment.owner_user_id.in_(user_ids)))
+        connection.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Scenario:
+    """Builds the request for each route and remembers what the run created."""
+
+    def __init__(self, users, auth):
+        self.users = users
+        self.auth = auth
+        self.tokens = {}
+        self.created = []
+        self._next_user = itertools.cycle(users)
+        self._next_created = 0
+
+    def headers(self, user):
+        if self.auth == "bearer" and user["email"] in self.tokens:
+            return {"Authorization": "Bearer " + self.tokens[user["email"]]}
+        credentials = "{}:{}".format(user["email"], PASSWORD).encode()
+        return {"Authorization": "Basic " + base64.b64encode(credentials).decode()}
+
+    async def login_all(self, client):
+        for user in self.users:
+            response = await client.post("/v3/user/login", json={"email": user["email"], "password": PASSWORD})
+            self.tokens[user["email"]] = response.headers.get("access-token")
+
+    async def request(self, client, route):
+        user = next(self._next_user)
+        assignment = random.choice(user["assignments"])
+        body = {"name": "load", "points": 5, "num_of_attemps": 3, "deadline": "2099-01-01T00:00:00"}
+        if route == "healthz":
+            return await client.get("/healthz")
+        if route == "login":
+            return await client.post("/v3/user/login", json={"email": user["email"], "password": PASSWORD})
+        if route == "create_assignment":
+            response = await client.post("/v3/assignments", json=body, headers=self.headers(user))
+            if response.status_code == 201:
+                self.created.append((user, response.json()["id"]))
+            return response
+        if route == "get_assignment":
+            return await client.get("/v3/assignments/{}".format(assignment), headers=self.headers(user))
+        if route == "update_assignment":
+            return await client.put("/v3/assignments/{}".format(assignment), json=body, headers=self.headers(user))
+        if route == "list_assignments":
+            return await client.get("/v3/assignments", params={"limit": 50})
+        if route == "create_submission":
+            return await client.post("/v3/assignments/{}/submission".format(assignment),
+                                     json={"submission_url": "https://example.com/load.zip"}, headers=self.headers(user))
+        if route == "delete_assignment":
+            # Deletes what create_assignment made, so the seeded data stays intact
+            if self._next_created >= len(self.created):
+                return None
+            owner, id = self.created[self._next_created]
+            self._next_created += 1
+            return await client.delete("/v3/assignments/{}".format(id), headers=self.headers(owner))
+        raise ValueError("Unknown route {}".format(route))
+
+
+async def drive(client, scenario, route, concurrency, duration, requests):
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + duration
+    remaining = itertools.count()
+
+    async def worker():
+        while time.perf_counter() < deadline and (requests is None or next(remaining) < requests):
+            start = time.perf_counter()
+            response = await scenario.request(client, route)
+            if response is None:
+                return
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        return {"requests": 0}
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+        "max_ms": round(max(latencies), 3),
+        "status": {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+async def run(args, users):
+    scenario = Scenario(users, args.auth)
+    routes = args.routes.split(",") if args.routes != "all" else list(ROUTES)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60)
+        lifespan = None
+    else:
+        from events import publisher
+        from main import app
+
+        publisher.topic_arn, publisher._client = "arn:aws:sns:local:000000000000:bench", StubSNS()
+        client = httpx.AsyncClient(app=app, base_url="http://bench", timeout=60)
+        lifespan = app.router.lifespan_context(app)
+        await lifespan.__aenter__()
+    try:
+        async with client:
+            await scenario.login_all(client)
+            results = {}
+            for route in routes:
+                results[route] = await drive(client, scenario, route, args.concurrency, args.duration, args.requests)
+                print("{:<20} {}".format(route, json.dumps(results[route])), file=sys.stderr)
+            return results
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Relative change of throughput and p95 latency against an earlier results file."""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["routes"]
+    changes = {}
+    for route, current in results.items():
+        before = baseline.get(route)
+        if before and before.get("requests") and current.get("requests"):
+            changes[route] = {"rps_change": round(current["rps"] / before["rps"] - 1, 3),
+                              "p95_change": round(current["p95_ms"] / before["p95_ms"] - 1, 3)}
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test every API route")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--assignments", type=int, default=5, help="seeded assignments per user")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per route")
+    parser.add_argument("--requests", type=int, default=None, help="stop each route after this many requests")
+    parser.add_argument("--routes", default="all", help="comma separated, from: " + ", ".join(ROUTES))
+    parser.add_argument("--auth", choices=("basic", "bearer"), default="basic")
+    parser.add_argument("--url", default=None, help="running server; defaults to the app in-process")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--keep-data", action="store_true", help="do not delete the seeded rows")
+    args = parser.parse_args(argv)
+
+    if not args.url:
+        # In-process runs stay quiet unless asked, logging every response would dominate the numbers
+        os.environ.setdefault("LOG_SUCCESS_SAMPLE_RATE", "0")
+    users = seed(args.users, args.assignments)
+    try:
+        routes = asyncio.run(run(args, users))
+    finally:
+        if not args.keep_data:
+            cleanup(users)
+
+    results = {
+        "meta": {
+            "commit": commit(),
+            "measured_at": datetime.utcnow().isoformat(),
+            "target": args.url or "in-process",
+            "database": get_engine().dialect.name,
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "users": args.users,
+            "assignments_per_user": args.assignments,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "requests": args.requests,
+            "auth": args.auth,
+        },
+        "routes": routes,
+    }
+    if args.compare:
+        results["compared_to"] = {"file": args.compare, "changes": compare(routes, args.compare)}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=4)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
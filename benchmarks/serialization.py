@@ -0,0 +1,68 @@
+"""
+Per-response serialization cost of an assignment payload.
+
+Compares the old json.dumps/json.loads round trip rendered by JSONResponse with
+Assignment.to_json sent as raw bytes.
+
+    python -m benchmarks.serialization [iterations]
+"""
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from fastapi.responses import JSONResponse, Response
+
+import models
+
+
+def legacy_to_dict(assignment):
+    return {
+        "id": assignment.id,
+        "name": assignment.name,
+        "points": assignment.points,
+        "num_of_attemps": assignment.num_of_attemps,
+        "deadline": assignment.deadline,
+        "assignment_created": assignment.assignment_created,
+        "assignment_updated": assignment.assignment_updated,
+    }
+
+
+def legacy(assignment):
+    data = json.loads(json.dumps(legacy_to_dict(assignment), indent=4, sort_keys=True, default=str))
+    return JSONResponse(content=data, status_code=200, media_type="application/json").body
+
+
+def current(assignment):
+    return Response(content=assignment.to_json(), status_code=200, media_type="application/json").body
+
+
+def measure(fn, assignment, iterations):
+    fn(assignment)
+    start = time.process_time()
+    for _ in range(iterations):
+        fn(assignment)
+    cpu = (time.process_time() - start) / iterations
+
+    # Peak memory allocated while building a single response
+    tracemalloc.start()
+    fn(assignment)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"cpu_us": round(cpu * 1e6, 2), "peak_bytes": peak}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    now = datetime.utcnow()
+    assignment = models.Assignment(id=uuid.uuid4(), name="Assignment 1", points=10, num_of_attemps=3, deadline=now,
+                                   assignment_created=now, assignment_updated=now, owner_user_id=uuid.uuid4())
+    results = {"legacy": measure(legacy, assignment, iterations), "orjson": measure(current, assignment, iterations)}
+    results["speedup"] = round(results["legacy"]["cpu_us"] / results["orjson"]["cpu_us"], 2)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Cold start cost of a worker: importing the app, running the startup lifespan and
+serving the first request. Each run happens in a fresh interpreter.
+
+    python -m benchmarks.startup [runs]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    started = time.perf_counter()
+    client.get("/v3/assignments?limit=10")
+    first = time.perf_counter()
+    client.get("/v3/assignments?limit=10")
+    second = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "lifespan_ms": (started - imported) * 1000,
+                  "first_request_ms": (first - started) * 1000, "second_request_ms": (second - first) * 1000}))
+"""
+
+
+def run_once(warmup):
+    env = dict(os.environ, STARTUP_WARMUP="true" if warmup else "false")
+    output = subprocess.run([sys.executable, "-c", PROBE], env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {key: round(statistics.median(sample[key] for sample in samples), 3) for key in samples[0]}
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    results = {
+        "no_warmup": summarize([run_once(False) for _ in range(runs)]),
+        "warmup": summarize([run_once(True) for _ in range(runs)]),
+    }
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
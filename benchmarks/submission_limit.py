@@ -0,0 +1,92 @@
+"""
+Latency of creating a submission under the attempt limit.
+
+Compares the old flow (load assignment, count submissions, insert, commit) with
+the single conditional statement used by create_submission. Needs DATABASE_URL
+to point at a Postgres database the benchmark may write to.
+
+    python -m benchmarks.submission_limit [iterations]
+"""
+import json
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select
+
+import models
+from database import SessionLocal, init_engine
+from events import submission_event
+from main import submission_insert_statement
+
+
+def new_submission(assignment_id):
+    now = datetime.utcnow()
+    return models.Submission(id=uuid.uuid4(), assignment_id=assignment_id, submission_url="https://example.com/a.zip",
+                             submission_date=now, submission_updated=now)
+
+
+def legacy(db, assignment_id, user):
+    assignment = db.scalar(select(models.Assignment).filter_by(id=assignment_id))
+    if assignment.deadline < datetime.now():
+        return False
+    count = db.scalar(select(func.count()).select_from(models.Submission).filter_by(assignment_id=assignment_id))
+    if count >= assignment.num_of_attemps:
+        return False
+    submission = new_submission(assignment_id)
+    db.add_all([submission, submission_event(submission, user.id, user.email)])
+    db.commit()
+    return True
+
+
+def single_statement(db, assignment_id, user):
+    submission = new_submission(assignment_id)
+    event = submission_event(submission, user.id, user.email)
+    inserted = db.execute(submission_insert_statement(submission, event, datetime.now())).first()
+    db.commit()
+    return inserted is not None
+
+
+def measure(flow, db, assignment_id, user, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        assert flow(db, assignment_id, user)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {"mean_ms": round(statistics.mean(timings), 3), "p50_ms": round(statistics.median(timings), 3),
+            "p95_ms": round(sorted(timings)[int(len(timings) * 0.95) - 1], 3)}
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    models.ensure_schema(init_engine())
+    db = SessionLocal()
+    user = models.User(email="bench-{}@example.com".format(uuid.uuid4().hex), first_name="bench", last_name="bench",
+                       password="x")
+    db.add(user)
+    db.flush()
+    assignments = [models.Assignment(name="bench", points=1, num_of_attemps=100, owner_user_id=user.id,
+                                     deadline=datetime.now() + timedelta(days=1)) for _ in range(2)]
+    db.add_all(assignments)
+    db.commit()
+    try:
+        results = {
+            "legacy": measure(legacy, db, assignments[0].id, user, iterations),
+            "single_statement": measure(single_statement, db, assignments[1].id, user, iterations),
+        }
+        print(json.dumps(results, indent=4))
+    finally:
+        ids = [assignment.id for assignment in assignments]
+        submissions = select(models.Submission.id).where(models.Submission.assignment_id.in_(ids))
+        db.execute(delete(models.SubmissionEvent).where(models.SubmissionEvent.submission_id.in_(submissions)))
+        db.execute(delete(models.Submission).where(models.Submission.assignment_id.in_(ids)))
+        db.execute(delete(models.Assignment).where(models.Assignment.id.in_(ids)))
+        db.execute(delete(models.User).filter_by(id=user.id))
+        db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+import hashlib
+import importlib
+import logging
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from multiprocessing import AuthenticationError
+from multiprocessing.managers import BaseManager
+
+import metrics
+from executors import run_io
+
+logger = logging.getLogger("cloud")
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+# Set by server.py for the workers when it runs the CacheServer
+CACHE_SERVER_ADDRESS = os.getenv("CACHE_SERVER_ADDRESS", "")
+CACHE_SERVER_KEY = os.getenv("CACHE_SERVER_KEY", "")
+ASSIGNMENT_CACHE_ENABLED = os.getenv("ASSIGNMENT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ASSIGNMENT_CACHE_SIZE = int(os.getenv("ASSIGNMENT_CACHE_SIZE", "10000"))
+ASSIGNMENT_CACHE_TTL = float(os.getenv("ASSIGNMENT_CACHE_TTL", "30"))
+# Seconds a SharedBackend waits before it reconnects to a CacheServer it could not reach
+CACHE_RECONNECT_INTERVAL = float(os.getenv("CACHE_RECONNECT_INTERVAL", "1"))
+# Counter read from a store: the time the CacheServer before this one died, its entries are lost
+LOST_BEFORE = "store:lost_before"
+
+
+class CacheUnavailable(Exception):
+    """A remote CacheBackend could not be reached."""
+
+
+class CacheBackend:
+    """
+    Key/value store used by the caches in this module.
+
+    Values are plain tuples of bytes, str and UUID so a shared store only needs to
+    serialize them. ``incr`` keeps counters that are never evicted.
+
+    A ``remote`` backend makes a round trip per call, async code goes through
+    ``backend_call`` so it does not block the event loop. When it cannot reach its
+    store it raises CacheUnavailable.
+    """
+
+    remote = False
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def incr(self, key):
+        raise NotImplementedError
+
+    def counter(self, key):
+        raise NotImplementedError
+
+    def set_if_counter(self, key, value, counter_key, expected, ttl=None):
+        """``set`` only while counter ``counter_key`` is ``expected``, in one step. True when stored."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Bounded LRU+TTL store local to the worker process. Counters start at
+    ``counter_start``, untouched ones read as that value.
+    """
+
+    def __init__(self, max_size=ASSIGNMENT_CACHE_SIZE, ttl=ASSIGNMENT_CACHE_TTL, counter_start=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.counter_start = counter_start
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, self.counter_start) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, self.counter_start)
+
+    def set_if_counter(self, key, value, counter_key, expected, ttl=None):
+        with self._lock:
+            if self._counters.get(counter_key, self.counter_start) != expected:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+async def backend_call(backend, fn, *args):
+    """Call ``fn``, a method of ``backend`` or a function using it, on the io pool when the backend is remote."""
+    if backend.remote:
+        return await run_io(fn, *args)
+    return fn(*args)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+_lost_before = 0
+
+
+def _named_store(name, options):
+    """
+    Runs in the CacheServer: the first worker asking for a store creates it. After a
+    restart counters start at the time the old server died, above any value a
+    worker read from it, and LOST_BEFORE reads that time.
+    """
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = MemoryBackend(**options, counter_start=_lost_before)
+        return _stores[name]
+
+
+class CacheServer(BaseManager):
+    """
+    Process started by server.py holding one MemoryBackend per store name for
+    every worker on the host. Workers reach it through SharedBackend.
+    """
+
+
+CacheServer.register("store", callable=_named_store,
+                     exposed=("get", "set", "delete", "incr", "counter", "set_if_counter", "clear", "stats"))
+
+
+def serve(address, authkey, lost_before=0):
+    """
+    Run a CacheServer in this process until it is killed. ``lost_before`` is the time
+    the previous server died, 0 for the first one.
+    """
+    global _lost_before
+    _lost_before = lost_before
+    # Kept alive through a signal sent to the whole group, the supervisor kills it after the workers drained
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    CacheServer(address=address, authkey=authkey).get_server().serve_forever()
+
+
+class SharedBackend(CacheBackend):
+    """
+    Store ``name`` of the supervisor's CacheServer, the same for every worker.
+    Each call is a round trip over a Unix socket.
+
+    The connection is opened on first use. When the server is gone calls raise
+    CacheUnavailable, and the backend reconnects at most every CACHE_RECONNECT_INTERVAL
+    seconds, to the server the supervisor started in its place.
+    """
+
+    remote = True
+
+    def __init__(self, name="default", **options):
+        self.name = name
+        self.options = options
+        self._store = None
+        self._failed_at = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if self._store is not None:
+                return self._store
+            if self._failed_at is not None and time.monotonic() - self._failed_at < CACHE_RECONNECT_INTERVAL:
+                raise CacheUnavailable("CacheServer at {} is unavailable".format(CACHE_SERVER_ADDRESS))
+            try:
+                server = CacheServer(address=CACHE_SERVER_ADDRESS, authkey=CACHE_SERVER_KEY.encode())
+                server.connect()
+                self._store = server.store(self.name, self.options)
+            except (OSError, EOFError, AuthenticationError) as e:
+                self._failed_at = time.monotonic()
+                logger.warning("Could not connect to the CacheServer at {}: {}".format(CACHE_SERVER_ADDRESS, e))
+                raise CacheUnavailable(str(e)) from e
+            self._failed_at = None
+            return self._store
+
+    def _call(self, method, *args):
+        for attempt in range(2):
+            store = self._store
+            if store is None:
+                store = self._connect()
+            try:
+                return getattr(store, method)(*args)
+            except (OSError, EOFError) as e:
+                error = e
+                with self._lock:
+                    if self._store is store:
+                        self._store = None
+                # Proxies share one connection per thread and address, a new proxy would reuse the dead one
+                connection = store._tls.__dict__.pop("connection", None)
+                if connection is not None:
+                    connection.close()
+        raise CacheUnavailable(str(error)) from error
+
+    def get(self, key):
+        return self._call("get", key)
+
+    def set(self, key, value, ttl=None):
+        self._call("set", key, value, ttl)
+
+    def delete(self, key):
+        self._call("delete", key)
+
+    def incr(self, key):
+        return self._call("incr", key)
+
+    def counter(self, key):
+        return self._call("counter", key)
+
+    def set_if_counter(self, key, value, counter_key, expected, ttl=None):
+        return self._call("set_if_counter", key, value, counter_key, expected, ttl)
+
+    def clear(self):
+        self._call("clear")
+
+    def stats(self):
+        try:
+            return self._call("stats")
+        except CacheUnavailable:
+            return {"available": False}
+
+
+def load_backend(spec=CACHE_BACKEND, name="default", **options):
+    """
+    ``memory`` or the ``module:Class`` path of a CacheBackend, e.g. ``cache:SharedBackend``.
+    A shared backend gets the store ``name``; ``options`` (max_size, ttl) size the store.
+    """
+    if spec == "memory":
+        return MemoryBackend(**options)
+    module, attribute = spec.split(":")
+    return getattr(importlib.import_module(module), attribute)(name=name, **options)
+
+
+def etag(*parts):
+    """Strong validator over the values that identify a representation."""
+    digest = hashlib.blake2b("|".join(str(part) for part in parts).encode(), digest_size=12).hexdigest()
+    return '"{}"'.format(digest)
+
+
+def etag_matches(if_none_match, value):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison
+    return value in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+
+CachedAssignment = namedtuple("CachedAssignment", ["etag", "body", "owner_user_id"])
+CachedPage = namedtuple("CachedPage", ["etag", "body", "next_cursor"])
+
+
+class AssignmentCache:
+    """
+    Read-through cache of serialized assignment payloads and list pages.
+
+    A single assignment is keyed by its id and dropped by ``invalidate``. List pages
+    are keyed by their query and a generation counter, so any write retires every
+    cached page at once without scanning the store.
+
+    A backend that cannot be reached is a miss: reads go to the database and
+    nothing is stored until it is back.
+    """
+
+    def __init__(self, backend=None, enabled=ASSIGNMENT_CACHE_ENABLED):
+        self.backend = backend or load_backend(name="assignments")
+        self.enabled = enabled
+
+    async def _call(self, fn, *args):
+        try:
+            return await backend_call(self.backend, fn, *args)
+        except CacheUnavailable:
+            metrics.incr("cache.unavailable")
+            return None
+
+    async def generation(self):
+        """
+        Read before querying and pass to ``put_*``, so a write racing the query is not
+        cached: the entry is stored only while the counter still has this value,
+        checked and set in one backend call. ``put_*`` with None builds the entry
+        without storing it.
+        """
+        return await self._call(self.backend.counter, "assignments:generation")
+
+    async def get_assignment(self, id):
+        if not self.enabled:
+            return None
+        return await self._call(self.backend.get, "assignment:{}".format(id))
+
+    async def put_assignment(self, assignment, generation):
+        entry = CachedAssignment(etag(assignment.id, assignment.assignment_updated.isoformat()),
+                                 assignment.to_json(), assignment.owner_user_id)
+        if self.enabled and generation is not None:
+            await self._call(self.backend.set_if_counter, "assignment:{}".format(assignment.id), entry,
+                             "assignments:generation", generation)
+        return entry
+
+    async def get_page(self, query, generation):
+        if not self.enabled or generation is None:
+            return None
+        return await self._call(self.backend.get, "assignments:{}:{}".format(generation, query))
+
+    async def put_page(self, query, generation, columns, rows, body, next_cursor):
+        entry = CachedPage(etag(",".join(columns), next_cursor,
+                                *("{}@{}".format(row.id, row.assignment_updated.isoformat()) for row in rows)),
+                           body, next_cursor)
+        if self.enabled and generation is not None:
+            await self._call(self.backend.set_if_counter, "assignments:{}:{}".format(generation, query), entry,
+                             "assignments:generation", generation)
+        return entry
+
+    async def invalidate(self, *ids):
+        """Drop the given assignments and every cached list page after a write."""
+        await self._call(self._invalidate, ids)
+
+    def _invalidate(self, ids):
+        for id in ids:
+            self.backend.delete("assignment:{}".format(id))
+        self.backend.incr("assignments:generation")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return dict(self.backend.stats(), enabled=self.enabled)
+
+
+assignment_cache = AssignmentCache()
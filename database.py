@@ -1,15 +1,15 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import CursorResult
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool, AsyncAdaptedQueuePool
 import os
+import threading
+import time
 import logging
-from logging.config import dictConfig
-from passlib.context import CryptContext
-from log import LogConfig
+from contextlib import asynccontextmanager
+from executors import run_io
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-dictConfig(LogConfig().dict())
 logger = logging.getLogger("cloud")
 
 
@@ -18,24 +18,321 @@ if "DATABASE_URL" in os.environ:
 else:
     raise ValueError("DATABASE_URL must be set")
 
+# Connection pool configuration, one pool per worker process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+# Connect timeout of the health probes, which never use the request pool
+DB_PROBE_TIMEOUT = int(os.getenv("DB_PROBE_TIMEOUT", "2"))
+# Serve requests from an AsyncEngine instead of running a sync Session on the io pool
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
 
-def database_connection():
+
+class PoolStatsMixin:
+    """Records how long callers wait to check out a connection from the pool."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def connect(self):
+        with self._stats_lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except Exception:
+            with self._stats_lock:
+                self.waiting -= 1
+                self.checkout_timeouts += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.total_wait += elapsed
+            self.max_wait = max(self.max_wait, elapsed)
+        return connection
+
+    def recreate(self):
+        # Carry the statistics over when the engine disposes of the pool
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.checkout_timeouts = self.checkout_timeouts
+        pool.total_wait = self.total_wait
+        pool.max_wait = self.max_wait
+        pool.max_waiting = self.max_waiting
+        return pool
+
+
+class InstrumentedQueuePool(PoolStatsMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(PoolStatsMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _engine_options(url, poolclass=InstrumentedQueuePool):
+    if url.startswith("sqlite") and ":memory:" in url:
+        return {}
+    options = {
+        "poolclass": poolclass,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+    }
+    options.update(_connect_args(url, DB_CONNECT_TIMEOUT))
+    return options
+
+
+def _connect_args(url, timeout):
+    if url.startswith("postgresql+asyncpg"):
+        return {"connect_args": {"timeout": timeout}}
+    if url.startswith("postgres"):
+        return {"connect_args": {"connect_timeout": timeout}}
+    return {}
+
+
+def probe_engine(url):
+    """
+    Engine for health probes. It opens a fresh connection per probe with a short
+    timeout, so a saturated request pool is never mistaken for a database outage.
+    """
+    return create_engine(url, poolclass=NullPool, **_connect_args(url, DB_PROBE_TIMEOUT))
+
+
+def ping(probe, name="Database"):
+    """SELECT 1 through a probe engine, blocking, for health monitor threads."""
     try:
-        engine = create_engine(SQLALCHEMY_DATABASE_URL)
-        connection = engine.connect()
-        connection.close()
+        with probe.connect() as connection:
+            connection.execute(text("SELECT 1"))
         return True
     except Exception:
-        logger.error("Database is not connected")
+        logger.error("{} is not connected".format(name))
         return False
-    
-    
+
+
+def _async_database_url(url):
+    scheme, rest = url.split("://", 1)
+    driver = {"postgres": "postgresql+asyncpg", "postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+    return "{}://{}".format(driver.get(scheme.split("+")[0], scheme), rest)
+
+
+# Engines are created by init_engine() during application startup, once per worker process
+engine = None
+async_engine = None
+primary_probe = None
+# Objects stay loaded after commit so handlers never lazy-load on the event loop
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False)
+AsyncSessionLocal = None
+_engine_lock = threading.Lock()
+
+
+def init_engine():
+    """Create the engine and bind SessionLocal to it, plus the AsyncEngine when DB_ASYNC is set."""
+    global engine
+    with _engine_lock:
+        if engine is None:
+            engine = create_engine(SQLALCHEMY_DATABASE_URL, **_engine_options(SQLALCHEMY_DATABASE_URL))
+            SessionLocal.configure(bind=engine)
+            if DB_ASYNC:
+                init_async_engine()
+    return engine
+
+
+def get_engine():
+    return engine or init_engine()
+
+
+async def dispose_engines():
+    """Close pooled connections on shutdown."""
+    global engine, async_engine
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
+    if engine is not None:
+        engine.dispose()
+        engine = None
+
+
+def init_async_engine():
+    """Create the AsyncEngine used when DB_ASYNC is enabled. Needs asyncpg or aiosqlite."""
+    global async_engine, AsyncSessionLocal
+    if async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        url = os.getenv("DATABASE_ASYNC_URL") or _async_database_url(SQLALCHEMY_DATABASE_URL)
+        async_engine = create_async_engine(url, **_engine_options(url, InstrumentedAsyncQueuePool))
+        AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    return async_engine
+
+
+def request_pool():
+    """The pool request handlers check out from."""
+    sync_engine = get_engine()
+    return async_engine.pool if DB_ASYNC else sync_engine.pool
+
+
+def pool_stats():
+    pool = request_pool()
+    if not isinstance(pool, PoolStatsMixin):
+        return {"pool": pool.status()}
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "waiting": pool.waiting,
+        "max_waiting": pool.max_waiting,
+        "checkouts": pool.checkouts,
+        "checkout_timeouts": pool.checkout_timeouts,
+        "avg_wait_ms": round(pool.total_wait / pool.checkouts * 1000, 3) if pool.checkouts else 0.0,
+        "max_wait_ms": round(pool.max_wait * 1000, 3),
+    }
+
+
+def database_connection():
+    """Probe the primary on a connection of its own, see ``probe_engine``."""
+    global primary_probe
+    if primary_probe is None:
+        primary_probe = probe_engine(SQLALCHEMY_DATABASE_URL)
+    return ping(primary_probe)
+
+
 def get_db():
-    
+    get_engine()
+    db = SessionLocal()
     try:
-        engine = create_engine(SQLALCHEMY_DATABASE_URL)
-        SessionLocal = sessionmaker(autocommit=False,autoflush=False, bind=engine)
-        db = SessionLocal()
         yield db
     finally:
         db.close()
+
+
+class ThreadedSession:
+    """
+    AsyncSession-like facade over a sync Session for async handlers.
+
+    Every call that may hit the database runs on the io thread pool, so a slow
+    query never blocks the event loop. Calls are awaited one at a time, so the
+    underlying Session is never used from two threads at once.
+    """
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    @property
+    def bind(self):
+        return self.sync_session.bind
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    def _execute(self, statement, params=None, **kwargs):
+        result = self.sync_session.execute(statement, params, **kwargs)
+        # Fetch rows on the worker thread so iterating them on the loop never blocks
+        if isinstance(result, CursorResult) and not result.returns_rows:
+            return result
+        return result.freeze()()
+
+    async def execute(self, statement, params=None, **kwargs):
+        return await run_io(self._execute, statement, params, **kwargs)
+
+    async def scalar(self, statement, params=None, **kwargs):
+        return await run_io(self.sync_session.scalar, statement, params, **kwargs)
+
+    async def scalars(self, statement, params=None, **kwargs):
+        return (await self.execute(statement, params, **kwargs)).scalars()
+
+    async def get(self, entity, ident):
+        return await run_io(self.sync_session.get, entity, ident)
+
+    async def delete(self, instance):
+        await run_io(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_io(self.sync_session.flush)
+
+    async def refresh(self, instance):
+        await run_io(self.sync_session.refresh, instance)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        """Call ``fn(session, *args, **kwargs)`` with the sync Session, like AsyncSession.run_sync."""
+        return await run_io(fn, self.sync_session, *args, **kwargs)
+
+    async def commit(self):
+        await run_io(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_io(self.sync_session.rollback)
+
+    async def close(self):
+        await run_io(self.sync_session.close)
+
+
+@asynccontextmanager
+async def open_session(session_factory=None, async_session_factory=None):
+    """
+    An AsyncSession when DB_ASYNC is set, otherwise a ThreadedSession, from the
+    primary's session factories unless others are given.
+
+    Both expose the same awaitable API so handlers work unchanged on either path.
+    """
+    if DB_ASYNC:
+        async with (async_session_factory or AsyncSessionLocal)() as db:
+            yield db
+        return
+    db = ThreadedSession((session_factory or SessionLocal)())
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def get_session():
+    """Session on the primary, for handlers that write."""
+    get_engine()
+    async with open_session() as db:
+        yield db
+
+
+async def stream_partitions(statement, size=500, bind=None):
+    """
+    Yield lists of rows from a server-side cursor, so memory stays flat no matter
+    how many rows the statement returns.
+
+    ``bind`` is the engine of the session the rows are read through (an AsyncEngine
+    with DB_ASYNC), the primary by default.
+    """
+    statement = statement.execution_options(yield_per=size)
+    if DB_ASYNC:
+        async with (bind or async_engine).connect() as connection:
+            result = await connection.stream(statement)
+            async for partition in result.partitions(size):
+                yield partition
+        return
+    connection = await run_io((bind or get_engine()).connect)
+    try:
+        result = await run_io(connection.execute, statement)
+        while True:
+            partition = await run_io(result.fetchmany, size)
+            if not partition:
+                break
+            yield partition
+    finally:
+        await run_io(connection.close)
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import boto3
+from sqlalchemy import or_, select, update
+
+import metrics
+import models
+from database import SessionLocal
+
+logger = logging.getLogger("cloud")
+
+SNS_QUEUE_SIZE = int(os.getenv("SNS_QUEUE_SIZE", "10000"))
+SNS_BATCH_LINGER = float(os.getenv("SNS_BATCH_LINGER", "0.05"))
+SNS_MAX_RETRIES = int(os.getenv("SNS_MAX_RETRIES", "5"))
+SNS_RETRY_BACKOFF = float(os.getenv("SNS_RETRY_BACKOFF", "0.2"))
+SNS_OUTBOX_SWEEP_INTERVAL = float(os.getenv("SNS_OUTBOX_SWEEP_INTERVAL", "30"))
+SNS_OUTBOX_GRACE = float(os.getenv("SNS_OUTBOX_GRACE", "60"))
+SNS_OUTBOX_LEASE = float(os.getenv("SNS_OUTBOX_LEASE", "300"))
+
+# PublishBatch accepts at most 10 entries per call
+SNS_BATCH_SIZE = 10
+
+
+def submission_event(submission, user_id, user_email):
+    """Build the outbox row for a new submission, published to SNS after commit."""
+    message = json.dumps({
+        "repo_url": submission.submission_url,
+        "user_id": str(user_id),
+        "assigmment_id": str(submission.assignment_id),
+        "submission_id": str(submission.id),
+        "user_email": user_email
+    })
+    return models.SubmissionEvent(id=uuid.uuid4(), submission_id=submission.id, payload=message, created=datetime.utcnow())
+
+
+class SubmissionPublisher:
+    """
+    Publishes submission events to SNS from a background thread.
+
+    Events are written to the submission_events outbox in the same transaction as
+    the submission and then handed to an in-memory queue. The publisher sends them
+    in PublishBatch calls, retries failures with exponential backoff and marks the
+    outbox rows as published. Events that never make it through the queue (full
+    queue, crash, failed retries) are picked up by a periodic outbox sweep, so
+    delivery is at least once.
+    """
+
+    def __init__(self, topic_arn=None, region=None, client=None, queue_size=SNS_QUEUE_SIZE):
+        self.topic_arn = topic_arn or os.getenv("SNS_TOPIC_ARN")
+        self.region = region or os.getenv("AWS_REGION")
+        self._client = client
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_sweep = 0.0
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.topic_arn)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client("sns", region_name=self.region)
+        return self._client
+
+    def enqueue(self, event):
+        """Hand a committed outbox event to the publisher without blocking the request."""
+        if not self.enabled:
+            return False
+        try:
+            self._queue.put_nowait((event.id, event.payload))
+            return True
+        except queue.Full:
+            # The row is still in the outbox, the next sweep will publish it
+            self.dropped += 1
+            return False
+
+    def _next_batch(self, timeout):
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + SNS_BATCH_LINGER
+        while len(batch) < SNS_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _publish(self, batch):
+        """Publish up to 10 events, retrying the failed entries. Returns the ids that were delivered."""
+        pending = {event_id.hex: (event_id, payload) for event_id, payload in batch}
+        delivered = []
+        for attempt in range(SNS_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(SNS_RETRY_BACKOFF * 2 ** (attempt - 1))
+            entries = [{"Id": key, "Message": payload, "Subject": "New Submission"}
+                       for key, (_, payload) in pending.items()]
+            try:
+                with metrics.timer("sns.publish_batch"):
+                    result = self.client.publish_batch(TopicArn=self.topic_arn, PublishBatchRequestEntries=entries)
+            except Exception as e:
+                logger.error("SNS publish failed: {}".format(e))
+                metrics.incr("sns.publish_errors")
+                continue
+            for entry in result.get("Successful", []):
+                delivered.append(pending.pop(entry["Id"])[0])
+            if not pending:
+                break
+        self.published += len(delivered)
+        self.failed += len(pending)
+        metrics.incr("sns.published", len(delivered))
+        return delivered
+
+    def _mark_published(self, event_ids, db=None):
+        if not event_ids:
+            return
+        session = db or SessionLocal()
+        try:
+            session.execute(update(models.SubmissionEvent)
+                            .where(models.SubmissionEvent.id.in_(event_ids))
+                            .values(published_at=datetime.utcnow()))
+            session.commit()
+        finally:
+            if db is None:
+                session.close()
+
+    def _claim_outbox(self):
+        """
+        Lease the oldest undelivered outbox rows for SNS_OUTBOX_LEASE seconds, in a
+        short transaction of its own. Rows leased by another worker are skipped;
+        rows whose lease ran out without being published are claimed again.
+        """
+        now = datetime.utcnow()
+        event = models.SubmissionEvent
+        with SessionLocal() as db:
+            rows = db.execute(select(event.id, event.payload)
+                              .where(event.published_at.is_(None),
+                                     event.created < now - timedelta(seconds=SNS_OUTBOX_GRACE),
+                                     or_(event.claimed_until.is_(None), event.claimed_until < now))
+                              .order_by(event.created)
+                              .limit(SNS_BATCH_SIZE * 10)
+                              .with_for_update(skip_locked=True)).all()
+            if rows:
+                db.execute(update(event).where(event.id.in_([row.id for row in rows]))
+                           .values(claimed_until=now + timedelta(seconds=SNS_OUTBOX_LEASE)))
+            db.commit()
+        return rows
+
+    def sweep_outbox(self):
+        """
+        Publish outbox rows that were not delivered through the in-memory queue. No
+        transaction or connection is held while SNS is called and retried.
+        """
+        try:
+            rows = self._claim_outbox()
+            for start in range(0, len(rows), SNS_BATCH_SIZE):
+                self._mark_published(self._publish(rows[start:start + SNS_BATCH_SIZE]))
+        except Exception as e:
+            logger.error("SNS outbox sweep failed: {}".format(e))
+
+    def flush(self, timeout=0.0):
+        while True:
+            batch = self._next_batch(timeout)
+            if not batch:
+                return
+            try:
+                self._mark_published(self._publish(batch))
+            except Exception as e:
+                logger.error("SNS publish failed: {}".format(e))
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch(timeout=1.0)
+            if batch:
+                try:
+                    self._mark_published(self._publish(batch))
+                except Exception as e:
+                    logger.error("SNS publish failed: {}".format(e))
+            if time.monotonic() - self._last_sweep >= SNS_OUTBOX_SWEEP_INTERVAL:
+                self._last_sweep = time.monotonic()
+                self.sweep_outbox()
+        self.flush()
+
+    def start(self):
+        if not self.enabled:
+            logger.warning("SNS_TOPIC_ARN is not set, submission events stay in the outbox")
+            return
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sns-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """Stop the publisher after flushing whatever is still queued."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "queued": self._queue.qsize(),
+            "published": self.published,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+publisher = SubmissionPublisher()
@@ -0,0 +1,118 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Blocking database and boto3 calls run on a thread pool, bcrypt on a process pool.
+# HASH_POOL_SIZE=0 runs hashing on the io pool instead (bcrypt releases the GIL).
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "32"))
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", str(os.cpu_count() or 1)))
+
+
+class TrackedExecutor:
+    """Lazily created executor that keeps track of how much work is queued on it."""
+
+    def __init__(self, name, factory, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._factory = factory
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._factory(self.max_workers)
+        return self._executor
+
+    @property
+    def queued(self):
+        return max(0, self.in_flight - self.max_workers)
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        executor = self.executor
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.in_flight -= 1
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        if kwargs:
+            fn = functools.partial(fn, **kwargs)
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        return {
+            "max_workers": self.max_workers,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+        }
+
+
+def process_pool(size):
+    """
+    Process pool whose workers start from a forkserver rather than a fork of this
+    process. By the time a pool is created the log listener, health monitor and
+    publisher threads run, and a fork could copy a lock one of them holds.
+    """
+    return ProcessPoolExecutor(size, mp_context=multiprocessing.get_context("forkserver"))
+
+
+io_pool = TrackedExecutor("io", lambda size: ThreadPoolExecutor(size, thread_name_prefix="io"), IO_POOL_SIZE)
+if HASH_POOL_SIZE > 0:
+    hash_pool = TrackedExecutor("hash", process_pool, HASH_POOL_SIZE)
+else:
+    hash_pool = io_pool
+
+
+async def run_io(fn, *args, **kwargs):
+    """Run a blocking call on the io thread pool, in the caller's context so request metrics follow it."""
+    return await io_pool.run(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+async def run_hash(fn, *args):
+    """Run a CPU bound hashing call on the hash pool. The function must be picklable."""
+    return await hash_pool.run(fn, *args)
+
+
+def pool_stats():
+    stats = {"io": io_pool.stats()}
+    if hash_pool is not io_pool:
+        stats["hash"] = hash_pool.stats()
+    return stats
+
+
+def shutdown(wait=True):
+    hash_pool.shutdown(wait=wait)
+    io_pool.shutdown(wait=wait)
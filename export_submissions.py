@@ -0,0 +1,162 @@
+"""
+Export the submissions to an owner's assignments as CSV or NDJSON.
+
+    python -m export_submissions owner@example.com --format csv --output submissions.csv.gz
+    python -m export_submissions owner@example.com --cursor <cursor of the last row received>
+
+Rows are read from a server-side cursor in batches of ``--batch-size`` and
+written as they arrive, so memory stays flat however many submissions there
+are. ``GET /v3/submissions/export`` streams the same rows over HTTP.
+
+Rows are ordered by (submission_date, id), and every row carries the keyset
+cursor that points past it. An interrupted export resumes from the cursor of
+the last complete row; write the rest to a new file (a resumed CSV has no
+header line) and concatenate the two. Gzip output is flushed after every
+batch, so the received part of a download can still be decompressed.
+"""
+import argparse
+import csv
+import io
+import logging
+import sys
+import time
+import uuid
+import zlib
+
+import orjson
+from sqlalchemy import select, tuple_
+
+import models
+from database import get_engine
+from log import configure_logging
+from pagination import decode_cursor, encode_cursor
+from schema import CustomException
+from utils import dumps
+
+logger = logging.getLogger("cloud")
+
+EXPORT_COLUMNS = ("id", "assignment_id", "assignment_name", "submission_url", "submission_date", "submission_updated",
+                  "cursor")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def submission_export_query(owner_id, after=None, assignment_id=None):
+    """Submissions joined with their assignment for one owner, in keyset order."""
+    submissions = models.Submission.__table__
+    assignments = models.Assignment.__table__
+    statement = (select(submissions.c.id, submissions.c.assignment_id, assignments.c.name.label("assignment_name"),
+                        submissions.c.submission_url, submissions.c.submission_date, submissions.c.submission_updated)
+                 .join_from(submissions, assignments, submissions.c.assignment_id == assignments.c.id)
+                 .where(assignments.c.owner_user_id == owner_id))
+    if assignment_id:
+        statement = statement.where(submissions.c.assignment_id == assignment_id)
+    if after:
+        statement = statement.where(tuple_(submissions.c.submission_date, submissions.c.id) > tuple_(*after))
+    return statement.order_by(submissions.c.submission_date, submissions.c.id)
+
+
+def _with_cursor(row):
+    return tuple(row) + (encode_cursor(row.submission_date, row.id),)
+
+
+def csv_header():
+    return ",".join(EXPORT_COLUMNS).encode() + b"\r\n"
+
+
+def encode_rows(rows, format):
+    """One batch of rows as CSV lines or NDJSON lines."""
+    if format == "ndjson":
+        return b"".join(dumps(dict(zip(EXPORT_COLUMNS, _with_cursor(row))), option=orjson.OPT_APPEND_NEWLINE)
+                        for row in rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows((str(row.id), str(row.assignment_id), row.assignment_name, row.submission_url,
+                      row.submission_date.isoformat(), row.submission_updated.isoformat(),
+                      encode_cursor(row.submission_date, row.id)) for row in rows)
+    return buffer.getvalue().encode()
+
+
+class ChunkEncoder:
+    """
+    Turns batches of rows into output chunks, gzip compressed when asked, flushed after
+    every batch. A resumed CSV export has no header line.
+    """
+
+    def __init__(self, format, compress=False, header=True):
+        self.format = format
+        self.header = header
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self.rows = 0
+
+    def _out(self, data):
+        if self.compressor is None:
+            return data
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def start(self):
+        return self._out(csv_header() if self.format == "csv" and self.header else b"")
+
+    def encode(self, rows):
+        self.rows += len(rows)
+        return self._out(encode_rows(rows, self.format))
+
+    def finish(self):
+        return self.compressor.flush() if self.compressor is not None else b""
+
+
+def export_submissions(owner_email, output, format="ndjson", compress=False, cursor=None, assignment_id=None,
+                       batch_size=1000):
+    """
+    Write the submissions of ``owner_email``'s assignments to the binary file ``output``.
+
+    :return: dict with the number of rows written and the rows per second
+    """
+    start = time.perf_counter()
+    engine = get_engine()
+    with engine.connect() as connection:
+        owner_id = connection.scalar(select(models.User.id).filter_by(email=owner_email))
+        if owner_id is None:
+            raise ValueError("User {} does not exist".format(owner_email))
+        statement = submission_export_query(owner_id, decode_cursor(cursor) if cursor else None, assignment_id)
+        encoder = ChunkEncoder(format, compress, header=not cursor)
+        output.write(encoder.start())
+        result = connection.execution_options(yield_per=batch_size).execute(statement)
+        for partition in result.partitions():
+            output.write(encoder.encode(partition))
+        output.write(encoder.finish())
+
+    elapsed = time.perf_counter() - start
+    summary = {"rows": encoder.rows, "seconds": round(elapsed, 3),
+               "rows_per_second": round(encoder.rows / elapsed, 1) if elapsed else 0.0}
+    logger.info("Exported submissions: {}".format(summary))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the submissions to an owner's assignments")
+    parser.add_argument("owner", help="email of the assignments' owner")
+    parser.add_argument("--format", choices=sorted(MEDIA_TYPES), default="ndjson")
+    parser.add_argument("--output", default=None, help="file to write, stdout by default")
+    parser.add_argument("--gzip", action="store_true", help="compress the output, implied by a .gz output file")
+    parser.add_argument("--cursor", default=None, help="resume after the row carrying this cursor")
+    parser.add_argument("--assignment", default=None, help="only this assignment id")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    compress = args.gzip or bool(args.output and args.output.endswith(".gz"))
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        assignment_id = uuid.UUID(args.assignment) if args.assignment else None
+        export_submissions(args.owner, output, args.format, compress, args.cursor, assignment_id, args.batch_size)
+    except (ValueError, CustomException) as e:
+        logger.error(getattr(e, "msg", None) or str(e))
+        return 1
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+import logging
+
+from database import database_connection
+
+logger = logging.getLogger("cloud")
+
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "5"))
+DB_HEALTH_TTL = float(os.getenv("DB_HEALTH_TTL", "10"))
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "3"))
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "15"))
+
+
+class CircuitBreaker:
+    """Opens after repeated failures and lets a single trial through once the reset timeout passes."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=DB_BREAKER_THRESHOLD, reset_timeout=DB_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """Return True if a call to the protected resource may go ahead."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("Database circuit breaker closed")
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.error("Database circuit breaker opened")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class DatabaseHealth:
+    """
+    Keeps a TTL-cached view of database health, refreshed by a background probe.
+
+    Requests only read the cached state and never probe, so the event loop never
+    blocks on a connect. A result older than the TTL (the monitor is stuck or not
+    running) counts as unavailable.
+    """
+
+    def __init__(self, probe=database_connection, interval=DB_HEALTH_INTERVAL, ttl=DB_HEALTH_TTL, breaker=None):
+        self.probe = probe
+        self.interval = interval
+        self.ttl = ttl
+        self.breaker = breaker or CircuitBreaker()
+        self._healthy = False
+        self._checked_at = None
+        self._probe_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run_probe(self):
+        if not self._probe_lock.acquire(blocking=False):
+            # Another caller is probing, fall back to the last known state
+            return self._healthy
+        try:
+            healthy = self.probe()
+            if healthy:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+            self._healthy = healthy
+            self._checked_at = time.monotonic()
+            return healthy
+        finally:
+            self._probe_lock.release()
+
+    def is_fresh(self):
+        return self._checked_at is not None and time.monotonic() - self._checked_at < self.ttl
+
+    def is_available(self):
+        """Cheap check used on the request path."""
+        return self._healthy and self.is_fresh() and self.breaker.state == CircuitBreaker.CLOSED
+
+    def check(self):
+        """Probe now unless the breaker is open. Blocking, call from a thread or with run_io."""
+        if self.breaker.allow():
+            self._run_probe()
+        return self.is_available()
+
+    def status(self):
+        return {
+            "healthy": self._healthy,
+            "breaker": self.breaker.state,
+            "checked_seconds_ago": None if self._checked_at is None else round(time.monotonic() - self._checked_at, 3),
+        }
+
+    def _monitor(self):
+        # The first probe usually already ran during startup
+        while not self._stop.wait(0 if self._checked_at is None else self.interval):
+            self.check()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._monitor, name="db-health-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+
+db_health = DatabaseHealth()
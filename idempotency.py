@@ -0,0 +1,258 @@
+"""
+Idempotency-Key support for the POST routes that create assignments (one or a batch) and submissions.
+
+A request carrying an ``Idempotency-Key`` header has its response stored for
+IDEMPOTENCY_TTL seconds. The key is scoped to the Authorization header and the
+path. Sending the same key again returns the stored response with an
+``Idempotent-Replayed: true`` header. Nothing runs again, not even the password
+check, so a retry neither uses up an attempt nor publishes a second event. A
+duplicate that arrives while the first request is still running waits for its
+response instead of running in parallel.
+
+Reusing a key with a different body is answered with 422. 5xx, 401, 403, 408
+and 429 responses are not stored, so the client can retry them, e.g. once its
+credentials are accepted again.
+
+Keys are claimed in the ``idempotency_keys`` table, so every worker sees them.
+The first request inserts the key as pending and stores its response there
+when it finishes. A duplicate in another worker finds the pending row and polls
+until the response is stored. When a request cannot store one (an error, or a
+worker that died) the key is released, or taken over by a duplicate once it
+has been pending for IDEMPOTENCY_LOCK_TIMEOUT seconds. Duplicates within one
+worker wait on the first request directly, and stored responses are kept in the
+cache backend as well, so most replays need no query. While that backend cannot
+be reached replays come from the table.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+
+import orjson
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+import database
+import metrics
+import models
+from cache import CacheUnavailable, backend_call, load_backend
+from executors import run_io
+from utils import read_body, replay_receive
+
+logger = logging.getLogger("cloud")
+
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() in ("1", "true", "yes")
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_SIZE = int(os.getenv("IDEMPOTENCY_SIZE", "10000"))
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "60"))
+
+IDEMPOTENT_PATHS = re.compile(r"^/v3/assignments(:batch|/[^/]+/submission)?$")
+_MAX_KEY_LENGTH = 255
+_REPLAYED_HEADER = (b"idempotent-replayed", b"true")
+_RETRYABLE = {401, 403, 408, 429}
+
+
+def _digest(*parts):
+    return hashlib.blake2b(b"|".join(parts), digest_size=16).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Keys claimed and responses stored in the ``idempotency_keys`` table, the
+    responses also in the cache backend, plus the futures of the requests still
+    running in this worker. The table methods block, call them with run_io.
+    """
+
+    CLAIMED, PENDING, STORED = "claimed", "pending", "stored"
+
+    def __init__(self, backend=None, ttl=IDEMPOTENCY_TTL, lock_timeout=IDEMPOTENCY_LOCK_TIMEOUT, bind=None):
+        self.backend = backend or load_backend(name="idempotency", max_size=IDEMPOTENCY_SIZE, ttl=ttl)
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.bind = bind
+        self.in_flight = {}
+        self.stored = 0
+        self.replayed = 0
+        self.coalesced = 0
+        self.taken_over = 0
+
+    @property
+    def table(self):
+        return models.IdempotencyKey.__table__
+
+    async def get(self, key):
+        """The response stored in the cache backend, None when it is not there or cannot be reached."""
+        try:
+            return await backend_call(self.backend, self.backend.get, "idempotency:{}".format(key))
+        except CacheUnavailable:
+            metrics.incr("cache.unavailable")
+            return None
+
+    def _remember(self, key, stored, ttl):
+        try:
+            self.backend.set("idempotency:{}".format(key), stored, ttl=ttl)
+        except CacheUnavailable:
+            metrics.incr("cache.unavailable")
+
+    def claim(self, key, fingerprint):
+        """
+        Claim ``key`` for a request about to run.
+
+        :return: (CLAIMED, None), (STORED, (fingerprint, status_code, headers, body))
+                 or (PENDING, fingerprint) while another request holds the key
+        """
+        bind = self.bind or database.get_engine()
+        table = self.table
+        while True:
+            now = datetime.utcnow()
+            claim = dict(fingerprint=fingerprint, status="pending", status_code=None, headers=None, body=None,
+                         locked_until=now + timedelta(seconds=self.lock_timeout),
+                         expires_at=now + timedelta(seconds=self.ttl))
+            try:
+                with bind.begin() as connection:
+                    connection.execute(insert(table).values(key=key, **claim))
+                return self.CLAIMED, None
+            except IntegrityError:
+                pass
+            with bind.begin() as connection:
+                # The response expired, or the request holding the key stopped without releasing it
+                if connection.execute(update(table).where(table.c.key == key, or_(
+                        table.c.expires_at < now, and_(table.c.status == "pending", table.c.locked_until < now))
+                ).values(**claim)).rowcount:
+                    self.taken_over += 1
+                    return self.CLAIMED, None
+                row = connection.execute(select(table).where(table.c.key == key)).one_or_none()
+            if row is None:
+                continue  # released in between, try to insert again
+            if row.status == "pending":
+                return self.PENDING, row.fingerprint
+            stored = (row.fingerprint, row.status_code,
+                      tuple((name.encode("latin-1"), value.encode("latin-1")) for name, value in orjson.loads(row.headers)),
+                      row.body)
+            self._remember(key, stored, (row.expires_at - now).total_seconds())
+            return self.STORED, stored
+
+    def put(self, key, fingerprint, status_code, headers, body):
+        """Store the response of a claimed key."""
+        headers = tuple(headers)
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        with (self.bind or database.get_engine()).begin() as connection:
+            connection.execute(update(self.table).where(self.table.c.key == key).values(
+                status="complete", status_code=status_code, body=body, expires_at=expires_at,
+                headers=orjson.dumps([(name.decode("latin-1"), value.decode("latin-1")) for name, value in headers])))
+            if self.stored % 1000 == 0:
+                connection.execute(delete(self.table).where(self.table.c.expires_at < datetime.utcnow()))
+        self._remember(key, (fingerprint, status_code, headers, body), self.ttl)
+        self.stored += 1
+
+    def release(self, key):
+        """Drop a claimed key whose response is not stored, so the client can retry it."""
+        with (self.bind or database.get_engine()).begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.key == key, self.table.c.status == "pending"))
+
+    def stats(self):
+        return dict(self.backend.stats(), in_flight=len(self.in_flight), stored=self.stored, replayed=self.replayed,
+                    coalesced=self.coalesced, taken_over=self.taken_over)
+
+
+idempotency_store = IdempotencyStore()
+
+
+async def _send_json(send, status_code, message):
+    await send({"type": "http.response.start", "status": status_code,
+                "headers": [(b"content-type", b"application/json")]})
+    await send({"type": "http.response.body", "body": b'{"message":"' + message + b'"}'})
+
+
+class IdempotencyMiddleware:
+    """ASGI middleware storing and replaying the responses of POSTs sent with an Idempotency-Key."""
+
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store or idempotency_store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not IDEMPOTENT_PATHS.match(scope["path"]):
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(b"idempotency-key")
+        if idempotency_key is None:
+            return await self.app(scope, receive, send)
+        if not idempotency_key or len(idempotency_key) > _MAX_KEY_LENGTH:
+            return await _send_json(send, 400, b"Idempotency-Key must be 1 to 255 characters")
+
+        messages, body = await read_body(receive)
+        key = _digest(headers.get(b"authorization", b""), scope["path"].encode(), idempotency_key)
+        fingerprint = _digest(body)
+
+        while key in self.store.in_flight:
+            # Same key still running in this worker, answer with its response
+            self.store.coalesced += 1
+            metrics.incr("idempotency.coalesced")
+            await asyncio.shield(self.store.in_flight[key])
+        stored = await self.store.get(key)
+        if stored is not None:
+            return await self.replay(send, stored, fingerprint)
+
+        future = asyncio.get_running_loop().create_future()
+        self.store.in_flight[key] = future
+        try:
+            receive = replay_receive(messages, receive)
+            try:
+                state, stored = await self.claim(key, fingerprint)
+            except DBAPIError as e:
+                logger.warning("Idempotency-Key not claimed, running the request without it: {}".format(e))
+                return await self.app(scope, receive, send)
+            if state == self.store.STORED:
+                return await self.replay(send, stored, fingerprint)
+            if state == self.store.PENDING:
+                return await _send_json(send, 422, b"Idempotency-Key was already used with a different request")
+            await self.record(scope, receive, send, key, fingerprint)
+        finally:
+            del self.store.in_flight[key]
+            future.set_result(None)
+
+    async def claim(self, key, fingerprint):
+        """Claim the key, waiting while a request in another worker holds it with the same body."""
+        delay = 0.01
+        while True:
+            state, stored = await run_io(self.store.claim, key, fingerprint)
+            if state != self.store.PENDING or stored != fingerprint:
+                return state, stored
+            self.store.coalesced += 1
+            metrics.incr("idempotency.coalesced")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    async def replay(self, send, stored, fingerprint):
+        stored_fingerprint, status_code, headers, body = stored
+        if stored_fingerprint != fingerprint:
+            return await _send_json(send, 422, b"Idempotency-Key was already used with a different request")
+        self.store.replayed += 1
+        metrics.incr("idempotency.replayed")
+        await send({"type": "http.response.start", "status": status_code, "headers": list(headers) + [_REPLAYED_HEADER]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def record(self, scope, receive, send, key, fingerprint):
+        start = None
+        chunks = []
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        stored = False
+        try:
+            await self.app(scope, receive, send_wrapper)
+            if start is not None and start["status"] < 500 and start["status"] not in _RETRYABLE:
+                await run_io(self.store.put, key, fingerprint, start["status"], start.get("headers", []), b"".join(chunks))
+                stored = True
+        finally:
+            if not stored:
+                await run_io(self.store.release, key)
@@ -0,0 +1,147 @@
+"""
+Process startup and shutdown, run once per worker from the application lifespan.
+
+Nothing touches the database at import time. The lifespan configures logging,
+creates the engines (read replicas included), applies the schema only when its
+fingerprint changed, starts the background workers, optionally warms the
+connection and hash pools and only then marks the worker ready for /healthz.
+When the schema cannot be applied the worker stays not ready and retries in
+the background.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from sqlalchemy import select, text
+
+import database
+import executors
+import metrics
+import models
+import profiling
+from events import publisher
+from executors import run_hash, run_io
+from health import db_health
+from log import configure_logging, stop_logging
+from passwords import warm_hash
+from replicas import replica_router
+
+logger = logging.getLogger("cloud")
+
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes")
+SCHEMA_RETRY_INTERVAL = float(os.getenv("SCHEMA_RETRY_INTERVAL", "5"))
+
+
+def _warm_sync_pool():
+    engine = database.get_engine()
+    connections = []
+    try:
+        for _ in range(database.DB_POOL_SIZE):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.execute(text("SELECT 1"))
+        # Representative query, so the first request does not pay for plan and statement caches
+        connections[0].execute(select(models.Assignment.id).order_by(
+            models.Assignment.assignment_created, models.Assignment.id).limit(1)).all()
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+async def _warm_async_pool():
+    connections = []
+    try:
+        for _ in range(database.DB_POOL_SIZE):
+            connection = await database.async_engine.connect()
+            connections.append(connection)
+            await connection.execute(text("SELECT 1"))
+    finally:
+        for connection in connections:
+            await connection.close()
+
+
+async def warmup():
+    """Fill the connection pool and start the hash pool workers before serving traffic."""
+    start = time.perf_counter()
+    tasks = [run_io(_warm_sync_pool)]
+    if database.DB_ASYNC:
+        tasks.append(_warm_async_pool())
+    tasks += [run_hash(warm_hash) for _ in range(executors.hash_pool.max_workers)]
+    await asyncio.gather(*tasks)
+    logger.info("Warmup finished in {:.3f}s".format(time.perf_counter() - start))
+
+
+async def startup(app):
+    configure_logging()
+    app.state.ready = False
+    engines = [database.init_engine()]
+    if database.async_engine is not None:
+        engines.append(database.async_engine.sync_engine)
+    for replica in replica_router.init():
+        engines += replica.engines()
+    for engine in engines:
+        metrics.instrument_engine(engine)
+        profiling.instrument_engine(engine)
+    schema_applied = await apply_schema()
+    # First health result before the worker reports ready, the monitor keeps it current
+    await run_io(db_health.check)
+    db_health.start()
+    replica_router.start()
+    publisher.start()
+    if schema_applied:
+        await become_ready(app)
+    else:
+        # /healthz keeps answering 503 until the schema is in place
+        app.state.schema_task = asyncio.create_task(retry_schema(app))
+
+
+async def apply_schema():
+    try:
+        await run_io(models.ensure_schema)
+        return True
+    except Exception as e:
+        logger.error("Database schema could not be applied: {}".format(e))
+        return False
+
+
+async def retry_schema(app):
+    """Apply the schema every SCHEMA_RETRY_INTERVAL seconds until it succeeds, then report ready."""
+    while True:
+        await asyncio.sleep(SCHEMA_RETRY_INTERVAL)
+        if await apply_schema():
+            break
+    await become_ready(app)
+
+
+async def become_ready(app):
+    if STARTUP_WARMUP:
+        try:
+            await warmup()
+        except Exception as e:
+            logger.error("Warmup failed: {}".format(e))
+    app.state.ready = True
+
+
+async def shutdown(app):
+    app.state.ready = False
+    schema_task = getattr(app.state, "schema_task", None)
+    if schema_task is not None:
+        schema_task.cancel()
+    db_health.stop()
+    replica_router.stop()
+    publisher.stop()
+    executors.shutdown()
+    await replica_router.dispose()
+    await database.dispose_engines()
+    stop_logging()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await startup(app)
+    try:
+        yield
+    finally:
+        await shutdown(app)
@@ -1,11 +1,28 @@
+import atexit
+import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+
+import orjson
 from pydantic import BaseModel
 
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FILE = os.getenv("LOG_FILE", "cloud.log")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Fraction of 2xx/3xx response logs that are kept, errors are always logged
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", "1.0"))
+
+
 class LogConfig(BaseModel):
     """Logging configuration to be set for the server"""
 
     LOGGER_NAME: str = "cloud"
     LOG_FORMAT: str = "%(levelprefix)s | %(asctime)s | %(message)s"
-    LOG_LEVEL: str = "DEBUG"
+    LOG_LEVEL: str = LOG_LEVEL
 
     # Logging config
     version = 1
@@ -14,6 +31,9 @@ class LogConfig(BaseModel):
         'standard': {
             'format': "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s",
             'datefmt': "%b/%d/%Y %H:%M:%S"
+        },
+        'json': {
+            '()': 'log.JsonFormatter',
         }
     }
     handlers = {
@@ -25,12 +45,112 @@ class LogConfig(BaseModel):
         "file": {
             "level": 'INFO',
             "class": 'logging.handlers.RotatingFileHandler',
-            "formatter": "standard",
-            "filename": 'cloud.log',
+            "formatter": "json",
+            "filename": LOG_FILE,
             'maxBytes': 1024 * 1025 * 50,
             'backupCount': 10,
         }
     }
     loggers = {
         LOGGER_NAME: {"handlers": ["console", "file"], "level": LOG_LEVEL},
-    }
\ No newline at end of file
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, the format the CloudWatch agent parses."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "module": record.module,
+            "line": record.lineno,
+        }
+        status_code = getattr(record, "status_code", None)
+        if status_code is not None:
+            entry["status_code"] = status_code
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry).decode()
+
+
+class SuccessSampler(logging.Filter):
+    """Keeps a sample of the response logs below 400, everything else passes."""
+
+    def __init__(self, rate=LOG_SUCCESS_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        status_code = getattr(record, "status_code", None)
+        if status_code is None or status_code >= 400 or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without formatting them and drops them
+    when the queue is full, so logging never blocks a request.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread, the record never leaves the process
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_queue_handler = None
+_listener = None
+
+
+def configure_logging():
+    """Apply LogConfig once per process and move its handlers behind a queue."""
+    global _queue_handler, _listener
+    if _listener is not None:
+        return
+    config = LogConfig()
+    dictConfig(config.dict())
+    logger = logging.getLogger(config.LOGGER_NAME)
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(SuccessSampler())
+    logger.addHandler(_queue_handler)
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out what is still queued and stop the listener thread."""
+    global _queue_handler, _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    logger = logging.getLogger(LogConfig().LOGGER_NAME)
+    logger.removeHandler(_queue_handler)
+    # Anything logged after shutdown is written directly
+    for handler in _listener.handlers:
+        handler.flush()
+        logger.addHandler(handler)
+    _queue_handler = _listener = None
+
+
+def logging_stats():
+    if _queue_handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
@@ -1,39 +1,65 @@
 # python imports
 import base64
-from typing import Any
-import json
-import statsd
+from typing import Any, List, Optional
+from uuid import UUID, uuid4
+import orjson
 from datetime import datetime
-import boto3
 import os
+from urllib.parse import urlencode
 
 # Framework Imports
-from fastapi import FastAPI, status, Request, HTTPException, Depends, Header, Body
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, status, Request, HTTPException, Depends, Header, Body, Query
+from sqlalchemy import case, delete, exists, select, insert, update, literal, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # Project Imports
-from utils import response
-from passlib.context import CryptContext
-from logging.config import dictConfig
+from utils import response, dumps
 from fastapi.exceptions import RequestValidationError
 import logging
-from log import LogConfig
-from database import database_connection, get_db
+from log import logging_stats
+from database import get_session, pool_stats, stream_partitions
+import executors
+import metrics
+import profiling
+from health import db_health
+from events import publisher, submission_event
+from auth import OwnedAssignment, Principal, authenticate, cached_principal, credential_cache, owned_assignment, token_signer, verify_credentials
 from schema import LoginSerializer
 import models
-from schema import Assignment, CustomException, Submission
-from fastapi.responses import JSONResponse
+from schema import Assignment, CustomException, ResponseException, Submission, validate_assignment
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pagination import encode_cursor, decode_cursor, parse_fields
+from lifecycle import lifespan
+from cache import CacheUnavailable, assignment_cache, backend_call, etag_matches
+from export_submissions import MEDIA_TYPES, ChunkEncoder, submission_export_query
+from import_assignments import AssignmentImport, import_format, insert_rows
+from admission import ADMISSION_ENABLED, AdmissionMiddleware, admission_control
+from idempotency import IDEMPOTENCY_ENABLED, IdempotencyMiddleware, idempotency_store
+from replicas import ReadYourWritesMiddleware, get_read_session, replica_router
+
+
+DEFAULT_PAGE_SIZE = int(os.getenv("ASSIGNMENTS_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("ASSIGNMENTS_MAX_PAGE_SIZE", "1000"))
+BATCH_MAX_ITEMS = int(os.getenv("ASSIGNMENTS_BATCH_MAX_ITEMS", "100"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
 
-c = statsd.StatsClient()
-
-
-
-dictConfig(LogConfig().dict())
 logger = logging.getLogger("cloud")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+app = FastAPI(default_response_class=ORJSONResponse)
+app.state.ready = False
+# FastAPI 0.89 does not take a lifespan argument yet, the router does
+app.router.lifespan_context = lifespan
+app.add_middleware(ReadYourWritesMiddleware)
+if ADMISSION_ENABLED:
+    app.add_middleware(AdmissionMiddleware)
+# Outside admission control, so a replayed response costs no rate limit token
+if IDEMPOTENCY_ENABLED:
+    app.add_middleware(IdempotencyMiddleware)
+app.add_middleware(metrics.TimingMiddleware)
+if profiling.PROFILING_ENABLED:
+    app.add_middleware(profiling.ProfilingMiddleware)
 
-app = FastAPI()
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -43,7 +69,7 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         for error in exc.errors():
             dct[error["loc"][1]] = error["msg"]
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content=dct,
         )
@@ -52,11 +78,16 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 
 @app.exception_handler(CustomException)
 async def handle_custom_exception(request, exc: CustomException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code, content=exc.msg
     )
 
 
+@app.exception_handler(ResponseException)
+async def handle_response_exception(request, exc: ResponseException):
+    return exc.response
+
+
 @app.exception_handler(exc_class_or_status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
 async def handle_method_not_allowed(request: Request, exc: HTTPException):
     return response("Method Not Allowed", status.HTTP_405_METHOD_NOT_ALLOWED, no_content=True)
@@ -66,32 +97,65 @@ async def handle_method_not_allowed(request: Request, exc: HTTPException):
 @app.get("/healthz")
 async def health_check(payload: Any = Body(None)):
 
-    c.incr("Health")
+    metrics.incr("Health")
 
     if payload:
         return response("Request cannot contain payload", status.HTTP_405_METHOD_NOT_ALLOWED, no_content=True)
-    if not database_connection():
+    if not app.state.ready:
+        return response("Application is starting", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
+    if not db_health.is_available():
         return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
     return response("Database is connected", status.HTTP_200_OK, log_level="info", no_content=True)
 
 
-def authenticate_user(user: LoginSerializer, db: Session = Depends(get_db)):
+# Runtime statistics used to size the worker pools under load
+@app.get("/metrics")
+async def runtime_metrics():
+    stats = pool_stats()
+    for key in ("checked_out", "overflow", "waiting"):
+        if key in stats:
+            metrics.gauge("DB_Pool_" + key, stats[key])
+    executor_stats = executors.pool_stats()
+    for name, pool in executor_stats.items():
+        metrics.gauge("Executor_{}_queued".format(name), pool["queued"])
+    # Each of these asks the cache backend, a shared one over a socket
+    auth_tokens, cached_assignments, idempotency = await executors.run_io(
+        lambda: (token_signer.stats(), assignment_cache.stats(), idempotency_store.stats()))
+    return {"db_pool": stats, "db_health": db_health.status(), "auth_cache": credential_cache.stats(),
+            "auth_tokens": auth_tokens, "assignment_cache": cached_assignments,
+            "executors": executor_stats, "sns_publisher": publisher.stats(), "logging": logging_stats(),
+            "read_replicas": replica_router.stats(), "admission": admission_control.stats(),
+            "idempotency": idempotency}
+
+
+@app.get("/admin/profiles")
+async def recent_profiles(request: Request, limit: int = Query(20, ge=1)):
+    if not profiling.PROFILING_ENABLED:
+        return response("Profiling is disabled", status.HTTP_404_NOT_FOUND)
+    if not profiling.authorized(request.headers.get(profiling.PROFILING_HEADER)):
+        return response("Not authorized to read profiles", status.HTTP_403_FORBIDDEN)
+    return {"profiles": profiling.recent(limit)}
+
+
+async def authenticate_user(user: LoginSerializer, db: AsyncSession = Depends(get_session)):
     try:
-        if not database_connection():
+        if not db_health.is_available():
             return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
         if not user.email or not user.password:
             return response("Email and password are required", status.HTTP_400_BAD_REQUEST)
 
-        stored_user = db.query(models.User).filter_by(email=user.email).first()
+        stored_user = await db.scalar(select(models.User).filter_by(email=user.email))
         if not stored_user:
             return response("Incorrect email or password", status.HTTP_401_UNAUTHORIZED)
 
-        if not pwd_context.verify(user.password, stored_user.password):
+        credentials = base64.b64encode(
+            f'{user.email}:{user.password}'.encode()).decode()
+
+        if not await verify_credentials("Basic " + credentials, user.password, stored_user.password, stored_user.id):
             return response("Incorrect email or password", status.HTTP_401_UNAUTHORIZED)
 
-        # generate token
-        token = base64.b64encode(
-            f'{user.email}:{user.password}'.encode()).decode()
+        # Signed token, later requests authenticate with it without a query or bcrypt
+        token = token_signer.issue(stored_user.id, stored_user.email)
 
         # return response with token and user data
         return response( "Login Successful", status.HTTP_200_OK, data={
@@ -99,25 +163,38 @@ def authenticate_user(user: LoginSerializer, db: Session = Depends(get_db)):
             "last_name": stored_user.last_name,
             "email": stored_user.email
         }, headers={
-            "access-token": token
+            "access-token": token,
+            "token-type": "Bearer"
         })
     except Exception as e:
         return response( str(e), status.HTTP_408_REQUEST_TIMEOUT)
 
 
 @app.post("/v3/user/login")
-def login(user: LoginSerializer, auth: str = Depends(authenticate_user)):
+async def login(user: LoginSerializer, auth: str = Depends(authenticate_user)):
     return auth
 
 
+@app.post("/v3/user/logout")
+async def logout(authorization: str = Header(None)):
+    claims = await token_signer.check(authorization[7:]) if authorization and authorization.startswith("Bearer ") else None
+    if not claims:
+        return response("Invalid or expired token", status.HTTP_401_UNAUTHORIZED)
+    try:
+        await backend_call(token_signer.revoked, token_signer.revoke, claims)
+    except CacheUnavailable:
+        return response("Logout is unavailable, try again later", status.HTTP_503_SERVICE_UNAVAILABLE)
+    return response("Logout Successful", status.HTTP_204_NO_CONTENT, log_level="info")
+
+
 
 ############################################################################################
 
 @app.post("/v3/assignments")
-def create_assignment(assignment: Assignment, authorization: str = Header(None),  db: Session = Depends(get_db)):
-    c.incr("Create_Assignment")
+async def create_assignment(assignment: Assignment, authorization: str = Header(None),  db: AsyncSession = Depends(get_session)):
+    metrics.incr("Create_Assignment")
     try:
-        if not database_connection():
+        if not db_health.is_available():
             return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
         
         assignment_data = assignment.dict()
@@ -125,286 +202,499 @@ def create_assignment(assignment: Assignment, authorization: str = Header(None),
         if any(item not in ["name", "points", "num_of_attemps", "deadline"] for item in assignment_data.keys()):
             return response( "Please provide correct parameters", status.HTTP_400_BAD_REQUEST)
 
-        if authorization is None:
-            return response( "Authorization header missing", status.HTTP_400_BAD_REQUEST)
-
-        auth_type, encoded_code = authorization.split(" ")
-        if auth_type != "Basic":
-            return response( "Authorization type not supported", status.HTTP_400_BAD_REQUEST)
-
-        code = base64.b64decode(encoded_code).decode("utf-8")
-
-        email, password = code.split(":")
-
-        user = db.query(models.User).filter_by(email=email).first()
-        if not user:
-            return response( "User not found", status.HTTP_404_NOT_FOUND)
-        
-        if not pwd_context.verify(password, user.password):
-            return response( "Invalid authorization", status.HTTP_401_UNAUTHORIZED)
+        principal = await authenticate(authorization, db)
+        if not isinstance(principal, Principal):
+            return principal
 
         new_assignment = models.Assignment(
             name=assignment.name,
             points=assignment.points,
             num_of_attemps=assignment.num_of_attemps,
             deadline=assignment.deadline,
-            owner_user_id=user.id
+            owner_user_id=principal.id
         )
 
         db.add(new_assignment)
-        db.commit()
-        return_data = json.loads(
-            json.dumps(db.query(models.Assignment).filter_by(id=new_assignment.id).first().to_dict(),
-                       indent=4, sort_keys=True, default=str))
-        return response( "Assignment Created Successfully", status.HTTP_201_CREATED, return_data, log_level="info")
+        await db.commit()
+        await assignment_cache.invalidate()
+        return response( "Assignment Created Successfully", status.HTTP_201_CREATED, new_assignment.to_json(), log_level="info")
     except Exception as e:
         return response( str(e), status.HTTP_408_REQUEST_TIMEOUT)
 
 
 
 @app.put("/v3/assignments/{id}")
-async def update_assignment(id: str, data: Assignment, authorization: str = Header(None), db: Session = Depends(get_db)):
-    c.incr("Update_Assignment")
+async def update_assignment(data: Assignment, assignment: models.Assignment = Depends(owned_assignment),
+                            db: AsyncSession = Depends(get_session)):
+    metrics.incr("Update_Assignment")
     try:
-        if not database_connection():
-            return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
-        assignment = db.query(models.Assignment).filter_by(id=id).first()
-        if not assignment:
-            return response( "Assignment not found", status.HTTP_404_NOT_FOUND)
+        # Update assignment data
+        assignment.name = data.name
+        assignment.points = data.points
+        assignment.num_of_attemps = data.num_of_attemps
+        assignment.deadline = data.deadline
 
-        if authorization is None:
-            return response( "Authorization header missing", status.HTTP_400_BAD_REQUEST)
-        try:
-            auth_type, encoded_code = authorization.split(" ")
-            if auth_type != "Basic":
-                return response( "Authorization type not supported", status.HTTP_400_BAD_REQUEST)
+        db.add(assignment)
+        await db.commit()
+        await db.refresh(assignment)
+        await assignment_cache.invalidate(assignment.id)
 
-            code = base64.b64decode(encoded_code).decode("utf-8")
-            email, password = code.split(":")
+        return response("Assignment Updated successfully", status.HTTP_204_NO_CONTENT, log_level="info")
 
-            user = db.query(models.User).filter_by(email=email).first()
-            if not user:
-                return response( "User not found", status.HTTP_404_NOT_FOUND)
-            
-             # Check if user is authorized to access this data
-            if assignment.owner_user_id != user.id:
-                return response( "Not authorized to access other user's data", status.HTTP_403_FORBIDDEN)
+    except Exception as e:
+        return response( str(e), status.HTTP_400_BAD_REQUEST)
 
-            if not pwd_context.verify(password, user.password):
-                return response( "Invalid authorization", status.HTTP_401_UNAUTHORIZED)
 
-           
+@app.delete("/v3/assignments/{id}")
+async def delete_assignment(assignment: models.Assignment = Depends(owned_assignment),
+                            db: AsyncSession = Depends(get_session)):
+    metrics.incr("delete_Assignment")
+    try:
+        await db.delete(assignment)
+        await db.commit()
+        await assignment_cache.invalidate(assignment.id)
 
-            # Update assignment data
-            assignment.name = data.name
-            assignment.points = data.points
-            assignment.num_of_attemps = data.num_of_attemps
-            assignment.deadline = data.deadline
+        return response( "Assignment deleted successfully", status.HTTP_204_NO_CONTENT, log_level="info")
 
-            db.add(assignment)
-            db.commit()
-            db.refresh(assignment)
+    except Exception as e:
+        return response( str(e), status.HTTP_400_BAD_REQUEST)
 
-            return response("Assignment Updated successfully", status.HTTP_204_NO_CONTENT, log_level="info")
 
-            
-        except Exception as e:
-            return response("Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST)
+async def batch_principal(items, authorization, db):
+    """Checks shared by the batch endpoints, then authenticates the caller once for every item."""
+    if not db_health.is_available():
+        return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
+    if not items or len(items) > BATCH_MAX_ITEMS:
+        return response("A batch takes 1 to {} items".format(BATCH_MAX_ITEMS), status.HTTP_400_BAD_REQUEST)
+    return await authenticate(authorization, db)
 
-    except Exception as e:
-        return response( str(e), status.HTTP_408_REQUEST_TIMEOUT)
 
+def batch_error(index, status_code, errors):
+    return {"index": index, "status": status_code, "errors": errors}
 
-@app.delete("/v3/assignments/{id}")
-async def delete_assignment(id: str, authorization: str = Header(None), db: Session = Depends(get_db)):
-    c.incr("delete_Assignment")
+
+def batch_item_id(item):
+    """Assignment id of a PATCH or DELETE batch item, None when it is missing or malformed."""
     try:
-        if not database_connection():
-            return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
-        # Check if assignment exists
-        assignment = db.query(models.Assignment).filter_by(id=id).first()
-        if not assignment:
-            return response( "Assignment not found", status.HTTP_404_NOT_FOUND)
+        return UUID(str(item["id"] if isinstance(item, dict) else item))
+    except (KeyError, ValueError):
+        return None
+
+
+def parse_batch_items(items, with_id):
+    """
+    Validate batch items with the schema.Assignment rules.
+
+    :return: the valid items as (index, id, Assignment) and the results of the invalid ones by index
+    """
+    valid, results, seen = [], {}, set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, {"item": "Expected an object"})
+            continue
+        fields = dict(item)
+        id = None
+        if with_id:
+            id = batch_item_id(fields)
+            fields.pop("id", None)
+            if id is None or id in seen:
+                results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, {"id": "A unique assignment id is required"})
+                continue
+            seen.add(id)
+        assignment, errors = validate_assignment(fields)
+        if errors:
+            results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, errors)
+        else:
+            valid.append((index, id, assignment))
+    return valid, results
+
+
+async def missing_batch_ids(db, ids, principal):
+    """Status of the items a bulk statement did not match: 404 when the assignment does not exist, 403 when another user owns it."""
+    if not ids:
+        return {}
+    table = models.Assignment.__table__
+    owners = dict((await db.execute(select(table.c.id, table.c.owner_user_id).where(table.c.id.in_(ids)))).all())
+    return {id: status.HTTP_404_NOT_FOUND if id not in owners
+            else status.HTTP_403_FORBIDDEN if owners[id] != principal.id else None for id in ids}
+
+
+def batch_response(results):
+    return response("Batch processed", status.HTTP_200_OK, data=dumps([results[index] for index in sorted(results)]),
+                    log_level="info")
+
+
+def assignment_columns():
+    table = models.Assignment.__table__
+    return [table.c[name] for name in models.Assignment.public_fields]
+
+
+@app.post("/v3/assignments:batch")
+async def create_assignments_batch(items: List[Any] = Body(...), authorization: str = Header(None),
+                                   db: AsyncSession = Depends(get_session)):
+    """Create up to ASSIGNMENTS_BATCH_MAX_ITEMS assignments with one multi-row INSERT ... RETURNING."""
+    metrics.incr("Batch_Create_Assignment")
+    try:
+        principal = await batch_principal(items, authorization, db)
+        if not isinstance(principal, Principal):
+            return principal
+        valid, results = parse_batch_items(items, with_id=False)
+        if valid:
+            now = datetime.utcnow()
+            rows = [{"id": uuid4(), "name": item.name, "points": item.points, "num_of_attemps": item.num_of_attemps,
+                     "deadline": item.deadline, "owner_user_id": principal.id, "submission_count": 0,
+                     "assignment_created": now, "assignment_updated": now} for _, _, item in valid]
+            statement = insert(models.Assignment.__table__).returning(*assignment_columns())
+            created = {row.id: row._mapping for row in (await db.execute(statement, rows)).all()}
+            await db.commit()
+            await assignment_cache.invalidate()
+            for (index, _, _), row in zip(valid, rows):
+                results[index] = {"index": index, "status": status.HTTP_201_CREATED, "data": dict(created[row["id"]])}
+        return batch_response(results)
+    except Exception as e:
+        return response(str(e), status.HTTP_408_REQUEST_TIMEOUT)
 
-        if authorization is None:
-            return response( "Authorization header missing", status.HTTP_400_BAD_REQUEST)
-        try:
-            auth_type, encoded_code = authorization.split(" ")
-            if auth_type != "Basic":
-                return response( "Authorization type not supported", status.HTTP_400_BAD_REQUEST)
 
-            code = base64.b64decode(encoded_code).decode("utf-8")
-            email, password = code.split(":")
+@app.patch("/v3/assignments:batch")
+async def update_assignments_batch(items: List[Any] = Body(...), authorization: str = Header(None),
+                                   db: AsyncSession = Depends(get_session)):
+    """
+    Apply the PUT update to every item (``id`` plus the assignment fields) with a
+    single UPDATE ... RETURNING, setting each column through a CASE on the id.
+    """
+    metrics.incr("Batch_Update_Assignment")
+    try:
+        principal = await batch_principal(items, authorization, db)
+        if not isinstance(principal, Principal):
+            return principal
+        valid, results = parse_batch_items(items, with_id=True)
+        if valid:
+            table = models.Assignment.__table__
+            ids = [id for _, id, _ in valid]
+            by_id = lambda name: case({id: getattr(item, name) for _, id, item in valid}, value=table.c.id)
+            statement = (update(table)
+                         .where(table.c.id.in_(ids), table.c.owner_user_id == principal.id)
+                         .values(name=by_id("name"), points=by_id("points"), num_of_attemps=by_id("num_of_attemps"),
+                                 deadline=by_id("deadline"), assignment_updated=datetime.utcnow())
+                         .returning(*assignment_columns()))
+            updated = {row.id: row._mapping for row in (await db.execute(statement)).all()}
+            missing = await missing_batch_ids(db, [id for id in ids if id not in updated], principal)
+            await db.commit()
+            await assignment_cache.invalidate(*updated)
+            for index, id, _ in valid:
+                if id in updated:
+                    results[index] = {"index": index, "status": status.HTTP_200_OK, "data": dict(updated[id])}
+                else:
+                    results[index] = batch_error(index, missing[id], {"id": "Assignment not found" if missing[id] == 404
+                                                                      else "Assignment belongs to another user"})
+        return batch_response(results)
+    except Exception as e:
+        return response(str(e), status.HTTP_400_BAD_REQUEST)
+
 
-            user = db.query(models.User).filter_by(email=email).first()
-            if not user:
-                return response( "User not found", status.HTTP_404_NOT_FOUND)
-            
-            # Check if user is authorized to access this data
-            if assignment.owner_user_id != user.id:
-                return response( "Not authorized to access other user's data", status.HTTP_403_FORBIDDEN)
+@app.delete("/v3/assignments:batch")
+async def delete_assignments_batch(items: List[Any] = Body(...), authorization: str = Header(None),
+                                   db: AsyncSession = Depends(get_session)):
+    """
+    Delete the assignments named by the items (ids, or objects with an ``id``) with
+    one DELETE ... RETURNING. Assignments that have submissions are kept and answered with 409.
+    """
+    metrics.incr("Batch_Delete_Assignment")
+    try:
+        principal = await batch_principal(items, authorization, db)
+        if not isinstance(principal, Principal):
+            return principal
+        results, ids = {}, {}
+        for index, item in enumerate(items):
+            id = batch_item_id(item)
+            if id is None or id in ids:
+                results[index] = batch_error(index, status.HTTP_400_BAD_REQUEST, {"id": "A unique assignment id is required"})
+            else:
+                ids[id] = index
+        if ids:
+            table = models.Assignment.__table__
+            submissions = models.Submission.__table__
+            statement = (delete(table)
+                         .where(table.c.id.in_(list(ids)), table.c.owner_user_id == principal.id,
+                                ~exists().where(submissions.c.assignment_id == table.c.id))
+                         .returning(table.c.id))
+            deleted = set((await db.execute(statement)).scalars().all())
+            missing = await missing_batch_ids(db, [id for id in ids if id not in deleted], principal)
+            await db.commit()
+            await assignment_cache.invalidate(*deleted)
+            errors = {404: "Assignment not found", 403: "Assignment belongs to another user",
+                      None: "Assignment has submissions"}
+            for id, index in ids.items():
+                if id in deleted:
+                    results[index] = {"index": index, "status": status.HTTP_204_NO_CONTENT, "id": id}
+                else:
+                    results[index] = batch_error(index, missing[id] or status.HTTP_409_CONFLICT, {"id": errors[missing[id]]})
+        return batch_response(results)
+    except Exception as e:
+        return response(str(e), status.HTTP_400_BAD_REQUEST)
+
+
+@app.post("/v3/assignments:import")
+async def import_assignments(request: Request, format: Optional[str] = None, authorization: str = Header(None),
+                             db: AsyncSession = Depends(get_session)):
+    """
+    Import a CSV or NDJSON upload of assignments, parsed as the body streams in and
+    inserted IMPORT_BATCH_SIZE rows at a time. Rejected rows are reported by line.
+    """
+    metrics.incr("Import_Assignments")
+    format = format or import_format(request.headers.get("content-type"))
+    if format not in MEDIA_TYPES:
+        return response("format must be csv or ndjson", status.HTTP_400_BAD_REQUEST)
+    if not db_health.is_available():
+        return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
+    principal = await authenticate(authorization, db)
+    if not isinstance(principal, Principal):
+        return principal
 
+    compressed = request.headers.get("content-encoding", "").lower() == "gzip"
+    importer = AssignmentImport(principal.id, format, IMPORT_BATCH_SIZE, compressed)
+    try:
+        async for chunk in request.stream():
+            for rows in importer.feed(chunk):
+                await db.run_sync(insert_rows, rows)
+                await db.commit()
+                importer.loaded(rows)
+        for rows in importer.finish():
+            await db.run_sync(insert_rows, rows)
+            await db.commit()
+            importer.loaded(rows)
+    except CustomException:
+        raise
+    except Exception as e:
+        # Batches committed so far stay imported
+        return response(str(e), status.HTTP_400_BAD_REQUEST, dict(importer.summary(), message=str(e)))
+    finally:
+        if importer.imported:
+            await assignment_cache.invalidate()
+    return response("Assignments imported", status.HTTP_200_OK, importer.summary(), log_level="info")
 
-            if not pwd_context.verify(password, user.password):
-                return response( "Invalid authorization", status.HTTP_401_UNAUTHORIZED)
-            
-            db.delete(assignment)
-            db.commit()
 
-            return response( "Assignment deleted successfully", status.HTTP_204_NO_CONTENT, log_level="info")
+def cacheable_generation(request, generation):
+    """A replica may still be behind the write that invalidated the cache, only rows read on the primary are cached."""
+    return generation if request.state.replica is None else None
 
-        except Exception as e:
-            return response( "Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST)
 
-    except Exception as e:
-            return response( str(e), status.HTTP_408_REQUEST_TIMEOUT)
+def cached_assignment_response(request, entry):
+    headers = {"ETag": entry.etag}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return response("Assignment not modified", status.HTTP_304_NOT_MODIFIED, headers=headers, log_level="info",
+                        no_content=True)
+    return response("Assignemnt data retrieved successfully", status.HTTP_200_OK, data=entry.body, headers=headers,
+                    log_level="info")
 
 
 @app.get("/v3/assignments/{id}")
-async def get_assignment(id: str, db: Session = Depends(get_db), authorization: str = Header(None)):
-    c.incr("Get_Assignment")
+async def get_assignment(id: UUID, request: Request, db: AsyncSession = Depends(get_read_session), authorization: str = Header(None)):
+    metrics.incr("Get_Assignment")
+    # Owner with a token, or credentials verified recently, is served from the cache without loading the assignment
+    cached = await assignment_cache.get_assignment(id)
+    if cached and db_health.is_available() and await cached_principal(authorization, db) == cached.owner_user_id:
+        metrics.incr("Assignment_Cache_Hit")
+        return cached_assignment_response(request, cached)
+    generation = await assignment_cache.generation()
+    assignment = await owned_assignment.resolve(id, request, authorization, db)
     try:
-        if not database_connection():
-            return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
-        # Check if assignment exists
-        assignment = db.query(models.Assignment).filter_by(id=id).first()
-        if not assignment:
-            return response( "Assignment not found", status.HTTP_404_NOT_FOUND)
-
-        if authorization is None:
-            return response( "Authorization header missing", status.HTTP_400_BAD_REQUEST)
-        try:
-            auth_type, encoded_code = authorization.split(" ")
-            if auth_type != "Basic":
-                return response( "Authorization type not supported", status.HTTP_400_BAD_REQUEST)
-
-            code = base64.b64decode(encoded_code).decode("utf-8")
-            email, password = code.split(":")
-
-            user = db.query(models.User).filter_by(email=email).first()
-            if not user:
-                return response( "User not found", status.HTTP_404_NOT_FOUND)
-            
-            # Check if user is authorized to access this data
-            if assignment.owner_user_id != user.id:
-                return response( "Not authorized to access other user's data", status.HTTP_403_FORBIDDEN)
-
-
-            if not pwd_context.verify(password, user.password):
-                return response( "Invalid authorization", status.HTTP_401_UNAUTHORIZED)
-            
-            return response("Assignemnt data retrieved successfully", status.HTTP_200_OK,
-                        data=json.loads(json.dumps(assignment.to_dict(), indent=4, sort_keys=True, default=str)), log_level="info")
-
-        except Exception as e:
-            return response( "Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST)
-
+        return cached_assignment_response(request, await assignment_cache.put_assignment(
+            assignment, cacheable_generation(request, generation)))
     except Exception as e:
-            return response( str(e), status.HTTP_408_REQUEST_TIMEOUT)
+        return response( str(e), status.HTTP_400_BAD_REQUEST)
     
 
+def assignment_list_query(columns, after=None, owner=None, deadline_from=None, deadline_to=None):
+    """Keyset paginated listing ordered by (assignment_created, id)."""
+    # The sort key and assignment_updated (for the ETag) are selected even when not requested
+    sort_key = [name for name in ("assignment_created", "id", "assignment_updated") if name not in columns]
+    statement = select(*[getattr(models.Assignment, name) for name in columns + sort_key])
+    if after:
+        statement = statement.where(
+            tuple_(models.Assignment.assignment_created, models.Assignment.id) > tuple_(*after))
+    if owner:
+        statement = statement.where(models.Assignment.owner_user_id == select(models.User.id).filter_by(email=owner).scalar_subquery())
+    if deadline_from:
+        statement = statement.where(models.Assignment.deadline >= deadline_from)
+    if deadline_to:
+        statement = statement.where(models.Assignment.deadline <= deadline_to)
+    return statement.order_by(models.Assignment.assignment_created, models.Assignment.id)
+
+
+async def ndjson_rows(statement, columns, bind=None):
+    async for partition in stream_partitions(statement, bind=bind):
+        yield b"".join(dumps({name: row._mapping[name] for name in columns}, option=orjson.OPT_APPEND_NEWLINE)
+                       for row in partition)
+
+
 @app.get("/v3/assignments")
-async def get_assignments(db: Session = Depends(get_db)):
-    c.incr("Get_Assignment_List")
+async def get_assignments(request: Request, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                          cursor: Optional[str] = None, owner: Optional[str] = None,
+                          deadline_from: Optional[datetime] = None, deadline_to: Optional[datetime] = None,
+                          fields: Optional[str] = None, format: Optional[str] = None,
+                          db: AsyncSession = Depends(get_read_session)):
+    metrics.incr("Get_Assignment_List")
+    columns = parse_fields(fields, models.Assignment.public_fields)
+    after = decode_cursor(cursor) if cursor else None
+    stream = format == "ndjson" or "application/x-ndjson" in request.headers.get("accept", "")
     try:
-        if not database_connection():
-            return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
-        assignments = db.query(models.Assignment).all()
-
-        
-        assignments_data = [assignment.to_dict() for assignment in assignments]
-        logger.info("Images fetched successfully 200")
-        return assignments_data
+        if stream:
+            if not db_health.is_available():
+                return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
+            # Server-side cursor, rows are encoded and sent as they arrive
+            statement = assignment_list_query(columns, after, owner, deadline_from, deadline_to)
+            if limit:
+                statement = statement.limit(limit)
+            return StreamingResponse(ndjson_rows(statement, columns, db.bind), media_type="application/x-ndjson")
+
+        query = urlencode(sorted(request.query_params.multi_items()))
+        generation = await assignment_cache.generation()
+        page = await assignment_cache.get_page(query, generation)
+        if page is None:
+            if not db_health.is_available():
+                return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
+            page_size = limit or DEFAULT_PAGE_SIZE
+            statement = assignment_list_query(columns, after, owner, deadline_from, deadline_to)
+            rows = (await db.execute(statement.limit(page_size + 1))).all()
+            next_cursor = None
+            if len(rows) > page_size:
+                rows = rows[:page_size]
+                next_cursor = encode_cursor(rows[-1].assignment_created, rows[-1].id)
+            body = dumps([{name: row._mapping[name] for name in columns} for row in rows])
+            page = await assignment_cache.put_page(query, cacheable_generation(request, generation), columns, rows, body,
+                                             next_cursor)
+        else:
+            metrics.incr("Assignment_List_Cache_Hit")
+
+        headers = {"ETag": page.etag}
+        if page.next_cursor:
+            headers["X-Next-Cursor"] = page.next_cursor
+            headers["Link"] = '<{}>; rel="next"'.format(request.url.include_query_params(cursor=page.next_cursor))
+        if etag_matches(request.headers.get("if-none-match"), page.etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        logger.info("Images fetched successfully 200", extra={"status_code": status.HTTP_200_OK})
+        return Response(content=page.body, headers=headers, media_type="application/json")
 
     except Exception as e:
         return response( "Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST)
     
 
+def claim_attempt_statement(assignment_id, now):
+    """Take one attempt if the deadline has not passed and the limit is not reached."""
+    assignments = models.Assignment.__table__
+    return (update(assignments)
+            .where(assignments.c.id == assignment_id,
+                   assignments.c.deadline >= now,
+                   assignments.c.submission_count < assignments.c.num_of_attemps)
+            .values(submission_count=assignments.c.submission_count + 1,
+                    assignment_updated=assignments.c.assignment_updated)
+            .returning(assignments.c.id))
+
+
+def submission_insert_statement(submission, event, now):
+    """
+    Claim an attempt and insert the submission and its outbox event in one statement.
+
+    The UPDATE row lock serializes concurrent submitters for an assignment, and the
+    inserts only run when it matched, so the attempt limit holds under concurrency.
+    """
+    submissions = models.Submission.__table__
+    events = models.SubmissionEvent.__table__
+    slot = claim_attempt_statement(submission.assignment_id, now).cte("slot")
+    inserted = (insert(submissions)
+                .from_select(["id", "assignment_id", "submission_url", "submission_date", "submission_updated"],
+                             select(literal(submission.id, submissions.c.id.type), slot.c.id,
+                                    literal(str(submission.submission_url)), literal(submission.submission_date),
+                                    literal(submission.submission_updated)))
+                .returning(submissions.c.id)
+                .cte("new_submission"))
+    return (insert(events)
+            .from_select(["id", "submission_id", "payload", "created"],
+                         select(literal(event.id, events.c.id.type), inserted.c.id, literal(event.payload),
+                                literal(event.created)))
+            .returning(events.c.id))
+
+
+async def insert_submission_within_limit(db, submission, event, now):
+    """Insert the submission and its outbox event unless the deadline or attempt limit forbids it."""
+    if db.bind.dialect.name == "postgresql":
+        return (await db.execute(submission_insert_statement(submission, event, now))).first() is not None
+    # Without data-modifying CTEs the claim and the inserts share one transaction instead
+    if (await db.execute(claim_attempt_statement(submission.assignment_id, now))).first() is None:
+        return False
+    db.add_all([submission, event])
+    return True
+
+
 @app.post("/v3/assignments/{id}/submission")
-async def create_submission(submission: Submission, id: str, db: Session = Depends(get_db), authorization: str = Header(None)):
+async def create_submission(submission: Submission, request: Request,
+                            assignment: models.Assignment = Depends(OwnedAssignment(status.HTTP_400_BAD_REQUEST)),
+                            db: AsyncSession = Depends(get_session)):
+    metrics.incr("Create_Submission")
+    principal = request.state.principal
     try:
-        if not database_connection():
-            return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
-        
-        if authorization is None:
-            return response( "Authorization header missing", status.HTTP_400_BAD_REQUEST)
-        
-        try:
-            auth_type, encoded_code = authorization.split(" ")
-            if auth_type != "Basic":
-                return response( "Authorization type not supported", status.HTTP_400_BAD_REQUEST)
-
-            code = base64.b64decode(encoded_code).decode("utf-8")
-            email, password = code.split(":")
-
-            user = db.query(models.User).filter_by(email=email).first()
-            if not user:
-                return response( "User not found", status.HTTP_404_NOT_FOUND)
-
-            if not pwd_context.verify(password, user.password):
-                return response( "Invalid authorization", status.HTTP_401_UNAUTHORIZED)
-            
-            # Check if assignment exists
-            assignment = db.query(models.Assignment).filter_by(id=id).first()
-            if not assignment:
-                return response( "Assignment not found", status.HTTP_400_BAD_REQUEST)
-            
-            # Check if user is authorized to access this data
-            if assignment.owner_user_id != user.id:
-                return response( "Not authorized to access other user's data", status.HTTP_403_FORBIDDEN)
+        now = datetime.now()
+        created = datetime.utcnow()
+        new_submission = models.Submission(
+            id=uuid4(),
+            assignment_id=assignment.id,
+            submission_url=submission.submission_url,
+            submission_date=created,
+            submission_updated=created
+        )
+        event = submission_event(new_submission, principal.id, principal.email)
 
-    
+        if not await insert_submission_within_limit(db, new_submission, event, now):
             # Check if the submission deadline has passed
-            if assignment.deadline < datetime.now():
+            if assignment.deadline < now:
                 return response( "Submission deadline has passed", status.HTTP_400_BAD_REQUEST)
-    
-            # Get the count of submissions for the assignment
-            submissions_count = db.query(models.Submission).filter(models.Submission.assignment_id == id).count()
-
-            if submissions_count >= assignment.num_of_attemps:
-                return response(f"Submission limit exceeded for assignment {assignment.name}", status.HTTP_400_BAD_REQUEST)
-            
-            new_submission = models.Submission(
-                assignment_id=assignment.id,
-                submission_url=submission.submission_url
-            )
-
-            db.add(new_submission)
-            db.commit()
-            send_to_sns_topic(new_submission.submission_url, str(user.id), str(assignment.id), str(new_submission.id), user.email)
-
-            return_data = json.loads(
-                json.dumps(db.query(models.Submission).filter_by(id=new_submission.id).first().to_dict(),
-                        indent=4, sort_keys=True, default=str))
-            return response( "Submission Created Successfully", status.HTTP_201_CREATED, return_data, log_level="info")
-        
-        except Exception as e:
-            return response( "Invalid authorization header : {}".format(str(e)), status.HTTP_400_BAD_REQUEST)
+            return response(f"Submission limit exceeded for assignment {assignment.name}", status.HTTP_400_BAD_REQUEST)
+
+        # The outbox row commits with the submission, the publisher sends it after the response
+        await db.commit()
+        publisher.enqueue(event)
+
+        return response( "Submission Created Successfully", status.HTTP_201_CREATED, new_submission.to_json(), log_level="info")
 
     except Exception as e:
-            return response( str(e), status.HTTP_408_REQUEST_TIMEOUT)
-    
-    
-def send_to_sns_topic(url, user_id, assigmment_id, submission_id, user_email):
-    # Replace 'your-aws-region' and 'your-sns-topic-arn' with your AWS region and SNS topic ARN
-    aws_region = os.getenv("AWS_REGION")
-    sns_topic_arn = os.getenv("SNS_TOPIC_ARN")
-
-    # Create an SNS client
-    sns_client = boto3.client('sns', region_name=aws_region)
-
-    # Message to be sent to the SNS topic
-    message = json.dumps({
-        "repo_url": url,
-        "user_id": user_id,
-        "assigmment_id": assigmment_id,
-        "submission_id": submission_id,
-        "user_email": user_email
-    })
-
-    # Publish the message to the SNS topic
-    sns_client.publish(
-        TopicArn=sns_topic_arn,
-        Message=message,
-        Subject='New Submission',
-    )
\ No newline at end of file
+        return response( str(e), status.HTTP_400_BAD_REQUEST)
+
+
+async def export_chunks(statement, encoder, bind):
+    yield encoder.start()
+    async for partition in stream_partitions(statement, size=EXPORT_BATCH_SIZE, bind=bind):
+        yield encoder.encode(partition)
+    yield encoder.finish()
+
+
+@app.get("/v3/submissions/export")
+async def export_submissions(request: Request, format: str = "ndjson", cursor: Optional[str] = None,
+                             assignment_id: Optional[UUID] = None, authorization: str = Header(None),
+                             db: AsyncSession = Depends(get_read_session)):
+    """
+    Stream the submissions to the caller's assignments from a server-side cursor, as
+    CSV or NDJSON, gzip compressed when the client accepts it. Every row carries the
+    cursor to resume after it.
+    """
+    metrics.incr("Export_Submissions")
+    if format not in MEDIA_TYPES:
+        return response("format must be csv or ndjson", status.HTTP_400_BAD_REQUEST)
+    if not db_health.is_available():
+        return response("Database is not connected", status.HTTP_503_SERVICE_UNAVAILABLE, no_content=True)
+    principal = await authenticate(authorization, db)
+    if not isinstance(principal, Principal):
+        return principal
+    statement = submission_export_query(principal.id, decode_cursor(cursor) if cursor else None, assignment_id)
+    compress = "gzip" in request.headers.get("accept-encoding", "")
+    headers = {"Content-Disposition": 'attachment; filename="submissions.{}"'.format(format), "Vary": "Accept-Encoding"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    encoder = ChunkEncoder(format, compress, header=not cursor)
+    bind = db.bind
+    # The stream reads on a connection of its own, give back the one authentication used
+    # instead of holding it until the dependency exits after the last chunk
+    await db.close()
+    # No Content-Length, the body goes out with chunked transfer encoding as rows arrive
+    return StreamingResponse(export_chunks(statement, encoder, bind), media_type=MEDIA_TYPES[format], headers=headers)
@@ -0,0 +1,141 @@
+"""
+StatsD metrics for the CloudWatch agent listening on :8125.
+
+Metrics recorded while a request is being served are buffered on the request
+and sent in one pipeline when the response finishes, so the hot path does not
+pay a UDP send per metric. Outside a request (background threads, CLIs) they
+are sent right away.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+import statsd
+from sqlalchemy import event
+
+STATSD_HOST = os.getenv("STATSD_HOST", "localhost")
+STATSD_PORT = int(os.getenv("STATSD_PORT", "8125"))
+
+c = statsd.StatsClient(STATSD_HOST, STATSD_PORT)
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """Metrics buffered for one request, plus its database query totals."""
+
+    __slots__ = ("buffer", "queries", "query_time")
+
+    def __init__(self):
+        self.buffer = []
+        self.queries = 0
+        self.query_time = 0.0
+
+    def send(self, client=c):
+        pipe = client.pipeline()
+        for kind, name, value in self.buffer:
+            getattr(pipe, kind)(name, value)
+        pipe.send()
+
+
+def _record(kind, name, value):
+    current = _current.get()
+    if current is None:
+        getattr(c, kind)(name, value)
+    else:
+        current.buffer.append((kind, name, value))
+
+
+def incr(name, count=1):
+    _record("incr", name, count)
+
+
+def gauge(name, value):
+    _record("gauge", name, value)
+
+
+def timing(name, ms):
+    _record("timing", name, ms)
+
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, (time.perf_counter() - start) * 1000)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    current = _current.get()
+    if current is not None:
+        current.queries += 1
+        current.query_time += elapsed
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def instrument_engine(engine):
+    """Count queries and their duration per request. Takes a sync Engine or the sync_engine of an AsyncEngine."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+def _route_name(scope):
+    endpoint = scope.get("endpoint")
+    return getattr(endpoint, "__name__", "unmatched")
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware timing every HTTP request per route and status code.
+
+    Emits ``route.<endpoint>.<status>`` timings, the number and total duration of
+    the queries the request ran, and flushes everything the handlers recorded in
+    a single pipeline.
+    """
+
+    def __init__(self, app, client=c):
+        self.app = app
+        self.client = client
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_metrics = RequestMetrics()
+        token = _current.set(request_metrics)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            _current.reset(token)
+            route = _route_name(scope)
+            request_metrics.buffer += [
+                ("timing", "route.{}.{}".format(route, status_code), elapsed),
+                ("timing", "route.{}.db_queries".format(route), request_metrics.queries),
+                ("timing", "route.{}.db_time".format(route), request_metrics.query_time * 1000),
+                ("incr", "db.queries", request_metrics.queries),
+            ]
+            request_metrics.send(self.client)
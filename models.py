@@ -1,21 +1,16 @@
-from database import database_connection, SQLALCHEMY_DATABASE_URL
-from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, CheckConstraint
+from database import get_engine
+from sqlalchemy import Column, String, DateTime, Integer, ForeignKey, CheckConstraint, Index, LargeBinary, Uuid, text, inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex, CreateTable
 from datetime import datetime
-from sqlalchemy import create_engine
+import hashlib
 import logging
-from logging.config import dictConfig
-from log import LogConfig
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-import csv
+from sqlalchemy.orm import relationship, declarative_base
+import orjson
+from utils import dumps
 import uuid
-from sqlalchemy.dialects.postgresql import UUID
-import os
 
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-dictConfig(LogConfig().dict())
 logger = logging.getLogger("cloud")
 
 Base = declarative_base()
@@ -23,7 +18,7 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = "users"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
+    id = Column(Uuid, primary_key=True, index=True, default=uuid.uuid4)
     first_name = Column(String, nullable=False)
     last_name = Column(String, nullable=False)
     password = Column(String, nullable=False)
@@ -35,32 +30,31 @@ class User(Base):
 class Assignment(Base):
     __tablename__ = "assignments"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
+    id = Column(Uuid, primary_key=True, index=True, default=uuid.uuid4)
     name = Column(String, nullable=False)
     points = Column(Integer, nullable=False)
     num_of_attemps = Column(Integer, nullable=False)
     deadline = Column(DateTime, nullable=False)
     assignment_created = Column(DateTime, default=datetime.utcnow)
     assignment_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    owner_user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False, index=True)
+    owner_user_id = Column(Uuid, ForeignKey("users.id"), nullable=False, index=True)
+    # Maintained by the submission insert so the attempt limit is enforced atomically
+    submission_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     __table_args__ = (
         CheckConstraint('points >= 1 AND points <= 10', name='check_points_range'),
         CheckConstraint('num_of_attemps >= 1 AND num_of_attemps <= 100', name='check_num_of_attemps_range'),
+        # Keyset pagination sort key for GET /v3/assignments
+        Index('ix_assignments_created_id', 'assignment_created', 'id'),
     )
 
+    public_fields = ("id", "name", "points", "num_of_attemps", "deadline", "assignment_created", "assignment_updated")
+
     user = relationship("User", back_populates="assignments")
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "points": self.points,
-            "num_of_attemps": self.num_of_attemps,
-            "deadline": self.deadline,
-            "assignment_created": self.assignment_created,
-            "assignment_updated": self.assignment_updated
-        }
+    def to_json(self):
+        """Serialize straight to JSON bytes; orjson encodes UUID and datetime natively."""
+        return dumps({field: getattr(self, field) for field in self.public_fields}, option=orjson.OPT_SORT_KEYS)
 
     
 
@@ -69,63 +63,116 @@ User.assignments = relationship("Assignment",order_by= "Assignment.id" , back_po
 class Submission(Base):
     __tablename__ = 'submissions'
 
-    id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
-    assignment_id = Column(UUID(as_uuid=True), ForeignKey("assignments.id"), nullable=False, index=True)
+    id = Column(Uuid, primary_key=True, index=True, default=uuid.uuid4)
+    assignment_id = Column(Uuid, ForeignKey("assignments.id"), nullable=False, index=True)
     submission_url = Column(String)
     submission_date = Column(DateTime, default=datetime.utcnow)
     submission_updated = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     assignment = relationship("Assignment", back_populates="submissions")
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "assignment_id": self.assignment_id,
-            "submission_url": self.submission_url,
-            "submission_date": self.submission_date,
-            "submission_updated": self.submission_updated,
-        }
+    __table_args__ = (
+        # Keyset order of the submission export
+        Index('ix_submissions_date_id', 'submission_date', 'id'),
+    )
+
+    public_fields = ("id", "assignment_id", "submission_url", "submission_date", "submission_updated")
+
+    def to_json(self):
+        return dumps({field: getattr(self, field) for field in self.public_fields}, option=orjson.OPT_SORT_KEYS)
 
 Assignment.submissions = relationship("Submission", back_populates="assignment", order_by= "Submission.id")
 
-if database_connection():
-    logger.info("Database is connected")
-    engine = create_engine(SQLALCHEMY_DATABASE_URL)
-    Base.metadata.create_all(bind=engine)
-
-    SessionLocal = sessionmaker(autocommit=False,autoflush=False, bind=engine)
-    db = SessionLocal()
-
-    file_path = "/opt/user.csv"
-    if os.path.isfile(file_path):
-        users_data = []
-
-        with open("/opt/user.csv", mode='r') as csv_file:
-            
-            csv_reader = csv.DictReader(csv_file)
-            for row in csv_reader:
-                users_data.append({
-                    "first_name": row["first_name"],
-                    "last_name": row["last_name"],
-                    "email": row["email"],
-                    "password": row["password"]
-                })
-        
-        for user_data in users_data:
-            existing_user = db.query(User).filter_by(email=user_data["email"]).first()
-            if existing_user:
-                continue
-
-            new_user = User(email=user_data["email"],
-                            first_name=user_data["first_name"],
-                            last_name=user_data["last_name"],
-                            password=pwd_context.encrypt(user_data["password"])
-                            )
-
-            db.add(new_user)
-            db.commit()
-    else:
-        logger.error("CSV file doesn't exist")
-    
-    db.close()
 
+class SubmissionEvent(Base):
+    """Transactional outbox of submission notifications waiting to be published to SNS."""
+    __tablename__ = "submission_events"
+
+    id = Column(Uuid, primary_key=True, default=uuid.uuid4)
+    submission_id = Column(Uuid, ForeignKey("submissions.id"), nullable=False, index=True)
+    payload = Column(String, nullable=False)
+    created = Column(DateTime, default=datetime.utcnow)
+    published_at = Column(DateTime, nullable=True)
+    # Lease of the outbox sweep publishing the row, other sweeps skip it until then
+    claimed_until = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_submission_events_unpublished', 'created',
+              postgresql_where=text('published_at IS NULL'), sqlite_where=text('published_at IS NULL')),
+    )
+
+class IdempotencyKey(Base):
+    """
+    Response stored for an Idempotency-Key, shared by every worker. A row is
+    ``pending`` while its request runs, until ``locked_until``, then ``complete``.
+    """
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(32), primary_key=True)
+    fingerprint = Column(String(32), nullable=False)
+    status = Column(String(8), nullable=False)
+    status_code = Column(Integer, nullable=True)
+    headers = Column(LargeBinary, nullable=True)
+    body = Column(LargeBinary, nullable=True)
+    locked_until = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class SchemaVersion(Base):
+    """Fingerprint of the schema last applied, so worker startup can skip schema checks."""
+    __tablename__ = "schema_version"
+
+    version = Column(String, primary_key=True)
+    applied = Column(DateTime, default=datetime.utcnow)
+
+
+def schema_fingerprint(dialect):
+    ddl = [str(CreateTable(table).compile(dialect=dialect)) for table in Base.metadata.sorted_tables]
+    ddl += [str(CreateIndex(index).compile(dialect=dialect))
+            for table in Base.metadata.sorted_tables
+            for index in sorted(table.indexes, key=lambda index: index.name)]
+    return hashlib.sha256("\n".join(ddl).encode()).hexdigest()[:16]
+
+
+def create_schema(bind=None):
+    bind = bind or get_engine()
+    if isinstance(bind, Engine):
+        with bind.begin() as connection:
+            return create_schema(connection)
+    Base.metadata.create_all(bind=bind)
+    # create_all skips tables that already exist, so add columns and indexes introduced later
+    if "submission_count" not in {column["name"] for column in inspect(bind).get_columns("assignments")}:
+        bind.execute(text("ALTER TABLE assignments ADD COLUMN submission_count INTEGER NOT NULL DEFAULT 0"))
+        bind.execute(text("UPDATE assignments SET submission_count = "
+                          "(SELECT count(*) FROM submissions WHERE submissions.assignment_id = assignments.id)"))
+    if "claimed_until" not in {column["name"] for column in inspect(bind).get_columns("submission_events")}:
+        bind.execute(text("ALTER TABLE submission_events ADD COLUMN claimed_until {}".format(
+            DateTime().compile(dialect=bind.dialect))))
+    for index in list(Assignment.__table__.indexes) + list(Submission.__table__.indexes):
+        index.create(bind=bind, checkfirst=True)
+
+
+def ensure_schema(bind=None):
+    """
+    Create or upgrade the schema unless the stored fingerprint already matches.
+
+    :return: True if the schema was (re)applied
+    """
+    bind = bind or get_engine()
+    version = schema_fingerprint(bind.dialect)
+    try:
+        with bind.connect() as connection:
+            if connection.scalar(select(SchemaVersion.version).filter_by(version=version)):
+                return False
+    except DBAPIError:
+        pass  # first start, schema_version does not exist yet
+
+    with bind.begin() as connection:
+        if bind.dialect.name == "postgresql":
+            # Workers starting together apply the schema one at a time
+            connection.execute(text("SELECT pg_advisory_xact_lock(6225)"))
+        create_schema(connection)
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(SchemaVersion.__table__.insert().values(version=version, applied=datetime.utcnow()))
+    logger.info("Database schema {} applied".format(version))
+    return True
@@ -0,0 +1,33 @@
+import base64
+from datetime import datetime
+from uuid import UUID
+
+from fastapi import status
+
+from schema import CustomException
+
+
+def encode_cursor(created, id):
+    """Opaque keyset cursor for a (timestamp, id) sort key."""
+    raw = "{}|{}".format(created.isoformat(), id)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created, id = base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+        return datetime.fromisoformat(created), UUID(id)
+    except Exception:
+        raise CustomException(status.HTTP_400_BAD_REQUEST, {"cursor": "Invalid cursor"})
+
+
+def parse_fields(fields, allowed):
+    """Split a comma separated projection, keeping the order of ``allowed``."""
+    if not fields:
+        return list(allowed)
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested - set(allowed)
+    if unknown:
+        raise CustomException(status.HTTP_400_BAD_REQUEST, {"fields": "Unknown fields: {}".format(", ".join(sorted(unknown)))})
+    return [field for field in allowed if field in requested]
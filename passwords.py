@@ -0,0 +1,23 @@
+"""
+Password hashing with bcrypt.
+
+The functions here are submitted to the hash pool, whose workers import this
+module to unpickle them. It imports nothing but passlib, so a worker starting
+from the forkserver does not load the application, its caches or its engines.
+"""
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def hash_password(password):
+    return pwd_context.hash(password)
+
+
+def verify_password(password, password_hash):
+    return pwd_context.verify(password, password_hash)
+
+
+def warm_hash():
+    # Cheapest bcrypt cost, only loads the backend in the hash pool worker
+    return pwd_context.using(bcrypt__rounds=4).hash("warmup")
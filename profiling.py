@@ -0,0 +1,208 @@
+"""
+Opt-in sampling profiler for single requests.
+
+With PROFILING_ENABLED and PROFILING_KEY set, a request is profiled when its
+PROFILING_HEADER carries the key or it is picked by PROFILING_SAMPLE_RATE.
+Without a key profiling stays disabled. While it runs, a sampler thread records the Python
+stacks of the event loop thread and of the busy io threads every
+PROFILING_INTERVAL seconds. Each profile stores wall and CPU time plus the SQL
+statements the request issued with their durations, and writes the samples as a
+collapsed-stack file (flamegraph.pl / speedscope format) to PROFILING_DIR.
+
+Samples are taken per thread, so concurrent requests sharing the loop or the
+io threads show up in each other's profiles. Profile on a quiet worker or look
+at the SQL timings, which are exact.
+
+When PROFILING_ENABLED is false the middleware and the SQL hooks are never
+installed, so the request path is unchanged.
+"""
+import contextvars
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+
+from sqlalchemy import event
+
+from executors import run_io
+
+PROFILING_KEY = os.getenv("PROFILING_KEY", "")
+# Without a key anyone could profile requests and read the profiles, so it stays off
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes") and bool(PROFILING_KEY)
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+PROFILING_HEADER = os.getenv("PROFILING_HEADER", "X-Profile")
+PROFILING_INTERVAL = float(os.getenv("PROFILING_INTERVAL", "0.005"))
+PROFILING_DIR = os.getenv("PROFILING_DIR", "profiles")
+PROFILING_KEEP = int(os.getenv("PROFILING_KEEP", "50"))
+
+_current = contextvars.ContextVar("profile", default=None)
+_recent = deque()
+_recent_lock = threading.Lock()
+
+# Innermost frames of threads that are only waiting for work
+_IDLE_FRAMES = {("selectors.py", "select"), ("thread.py", "_worker"), ("threading.py", "wait")}
+
+
+def authorized(key):
+    return bool(PROFILING_KEY) and hmac.compare_digest((key or "").encode(), PROFILING_KEY.encode())
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+
+def collapse(frame, thread_name):
+    if frame is None or (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_FRAMES:
+        return None
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of the loop thread and the io pool threads until stopped."""
+
+    def __init__(self, loop_thread_id, interval=PROFILING_INTERVAL):
+        super().__init__(name="profiler", daemon=True)
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+
+    def _threads(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        return {ident: name for ident, name in names.items()
+                if ident == self.loop_thread_id or name.startswith("io")}
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            threads = self._threads()
+            for ident, frame in sys._current_frames().items():
+                if ident in threads:
+                    stack = collapse(frame, threads[ident])
+                    if stack:
+                        self.samples[stack] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+
+class Profile:
+    def __init__(self, method, path):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.statements = []
+
+    def record_statement(self, statement, seconds):
+        self.statements.append({"statement": statement, "ms": round(seconds * 1000, 3)})
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    if profile is not None and conn.info.get("profile_start"):
+        profile.record_statement(statement, time.perf_counter() - conn.info["profile_start"].pop())
+
+
+def instrument_engine(engine):
+    """Record SQL statements of profiled requests. Only installed when profiling is enabled."""
+    if PROFILING_ENABLED and not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def save(profile, samples, status_code, wall, cpu, directory=None):
+    directory = directory or PROFILING_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "{}-{}.collapsed".format(time.strftime("%Y%m%dT%H%M%S"), profile.id))
+    with open(path, "w") as collapsed:
+        collapsed.writelines("{} {}\n".format(stack, count) for stack, count in samples.most_common())
+    summary = {
+        "id": profile.id,
+        "method": profile.method,
+        "path": profile.path,
+        "status": status_code,
+        "started": profile.started,
+        "wall_ms": round(wall * 1000, 3),
+        "cpu_ms": round(cpu * 1000, 3),
+        "samples": sum(samples.values()),
+        "sql_ms": round(sum(statement["ms"] for statement in profile.statements), 3),
+        "sql": profile.statements,
+        "file": path,
+    }
+    with open(path[:-len(".collapsed")] + ".json", "w") as metadata:
+        json.dump(summary, metadata)
+    with _recent_lock:
+        _recent.append(summary)
+        while len(_recent) > PROFILING_KEEP:
+            expired = _recent.popleft()
+            for stale in (expired["file"], expired["file"][:-len(".collapsed")] + ".json"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+    return summary
+
+
+def recent(limit=PROFILING_KEEP):
+    """Most recent profiles first, without their SQL statements."""
+    with _recent_lock:
+        profiles = list(_recent)[-limit:]
+    return [{key: value for key, value in summary.items() if key != "sql"} for summary in reversed(profiles)]
+
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling the requests selected by header or sample rate."""
+
+    def __init__(self, app, sample_rate=PROFILING_SAMPLE_RATE, header=PROFILING_HEADER):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode()
+
+    def _selected(self, scope):
+        if scope["path"].startswith("/admin/"):
+            return False
+        for name, value in scope["headers"]:
+            if name == self.header:
+                return authorized(value.decode())
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._selected(scope):
+            return await self.app(scope, receive, send)
+
+        profile = Profile(scope["method"], scope["path"])
+        token = _current.set(profile)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())]
+            await send(message)
+
+        sampler = Sampler(threading.get_ident())
+        sampler.start()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            _current.reset(token)
+            await run_io(save, profile, sampler.stop(), status_code, wall, cpu)
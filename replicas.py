@@ -0,0 +1,217 @@
+"""
+Read replicas for the handlers that only read.
+
+With DATABASE_REPLICA_URLS set, read-only handlers take their session from
+``get_read_session``. It picks the replicas round-robin and skips the ones whose
+health monitor reports them down; with none available the read goes to the
+primary. Every other handler uses ``database.get_session`` and the primary.
+
+Replicas lag behind the primary, so a client whose write to an assignment or
+submission succeeded is pinned to the primary for DB_READ_YOUR_WRITES_WINDOW
+seconds after the response, and reads back what it wrote. Logins, rejected
+requests and failed writes pin nothing. Clients are told apart by their
+Authorization header; anonymous clients cannot write and are never pinned, so
+they keep reading from the replicas. Pins are kept in the cache backend, so
+with a shared CACHE_BACKEND (as server.py sets up for several workers) they
+hold across workers. While that backend cannot be reached nobody is pinned and
+reads may lag behind writes.
+"""
+import hashlib
+import itertools
+import logging
+import os
+import re
+
+from fastapi import Request
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import database
+import metrics
+from cache import CacheUnavailable, backend_call, load_backend
+from health import DatabaseHealth
+
+logger = logging.getLogger("cloud")
+
+DATABASE_REPLICA_URLS = os.getenv("DATABASE_REPLICA_URLS", "")
+DB_READ_YOUR_WRITES_WINDOW = float(os.getenv("DB_READ_YOUR_WRITES_WINDOW", "5"))
+
+_SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+# Routes that write assignments or submissions
+_WRITE_PATHS = re.compile(r"^/v3/assignments(:batch|:import|/[^/]+(/submission)?)?$")
+
+
+class Replica:
+    """Engines, session factories and health monitor of one read replica."""
+
+    def __init__(self, url):
+        self.engine = create_engine(url, **database._engine_options(url))
+        self.SessionLocal = sessionmaker(bind=self.engine, autocommit=False, autoflush=False, expire_on_commit=False)
+        self.async_engine = None
+        self.AsyncSessionLocal = None
+        if database.DB_ASYNC:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+            async_url = database._async_database_url(url)
+            self.async_engine = create_async_engine(
+                async_url, **database._engine_options(async_url, database.InstrumentedAsyncQueuePool))
+            self.AsyncSessionLocal = async_sessionmaker(self.async_engine, autoflush=False, expire_on_commit=False)
+        self.probe = database.probe_engine(url)
+        self.health = DatabaseHealth(probe=self.ping)
+        self.reads = 0
+
+    @property
+    def name(self):
+        return self.engine.url.render_as_string(hide_password=True)
+
+    def engines(self):
+        """Sync engines to instrument, the one behind the AsyncEngine included."""
+        return [self.engine] + ([self.async_engine.sync_engine] if self.async_engine is not None else [])
+
+    def ping(self):
+        return database.ping(self.probe, "Replica {}".format(self.name))
+
+    def session(self):
+        return database.open_session(self.SessionLocal, self.AsyncSessionLocal)
+
+    async def dispose(self):
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        self.engine.dispose()
+        self.probe.dispose()
+
+
+def client_key(scope):
+    """Identity a read-your-writes pin is kept for, a hash of the Authorization header; None without one."""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            return hashlib.blake2b(value, digest_size=16).hexdigest()
+    return None
+
+
+class ReplicaRouter:
+    """Chooses the database a read goes to."""
+
+    def __init__(self, urls=DATABASE_REPLICA_URLS, window=DB_READ_YOUR_WRITES_WINDOW, backend=None):
+        self.urls = [url.strip() for url in urls.split(",") if url.strip()] if isinstance(urls, str) else list(urls)
+        self.window = window
+        self.replicas = []
+        self.pins = backend or load_backend(name="read_your_writes")
+        self._next = itertools.count()
+        self.primary_reads = 0
+        self.pinned_reads = 0
+
+    def init(self):
+        """Create the replica engines, once per worker process during startup."""
+        if not self.replicas:
+            self.replicas = [Replica(url) for url in self.urls]
+        return self.replicas
+
+    def start(self):
+        for replica in self.replicas:
+            replica.health.start()
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.health.stop()
+
+    async def dispose(self):
+        for replica in self.replicas:
+            await replica.dispose()
+        self.replicas = []
+
+    async def pin(self, key):
+        try:
+            await backend_call(self.pins, self.pins.set, "primary-pin:{}".format(key), True, self.window)
+        except CacheUnavailable:
+            metrics.incr("cache.unavailable")
+
+    async def pinned(self, key):
+        try:
+            return await backend_call(self.pins, self.pins.get, "primary-pin:{}".format(key)) is not None
+        except CacheUnavailable:
+            metrics.incr("cache.unavailable")
+            return False
+
+    def choose(self):
+        """Next healthy replica in round-robin order, None when all of them are down."""
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._next) % len(self.replicas)]
+            if replica.health.is_available():
+                return replica
+        return None
+
+    async def route(self, key):
+        """The replica to read from, or None for the primary."""
+        if not self.replicas:
+            return None
+        if key is not None and await self.pinned(key):
+            self.pinned_reads += 1
+            metrics.incr("db.reads.pinned")
+            return None
+        replica = self.choose()
+        if replica is None:
+            self.primary_reads += 1
+            metrics.incr("db.reads.primary")
+            return None
+        replica.reads += 1
+        metrics.incr("db.reads.replica")
+        return replica
+
+    def stats(self):
+        return {
+            "replicas": [{"url": replica.name, "reads": replica.reads, "health": replica.health.status()}
+                         for replica in self.replicas],
+            "primary_fallback_reads": self.primary_reads,
+            "pinned_reads": self.pinned_reads,
+        }
+
+
+replica_router = ReplicaRouter()
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware pinning a client to the primary once its write succeeded. The
+    pin is set when the 2xx status is sent, the write has committed by then, and
+    again when the response finished, so the window counts from its end however
+    long the body took.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        key = client_key(scope) if scope["type"] == "http" else None
+        if (key is None or scope["method"] in _SAFE_METHODS or not _WRITE_PATHS.match(scope["path"])
+                or not replica_router.replicas):
+            await self.app(scope, receive, send)
+            return
+        succeeded = False
+
+        async def send_wrapper(message):
+            nonlocal succeeded
+            if message["type"] == "http.response.start" and 200 <= message["status"] < 300:
+                succeeded = True
+                await replica_router.pin(key)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+        if succeeded:
+            await replica_router.pin(key)
+
+
+async def get_read_session(request: Request):
+    """
+    Session for a read-only handler, on a replica when one is available. The
+    chosen replica, or None for the primary, is kept on ``request.state.replica``.
+    """
+    replica = await replica_router.route(client_key(request.scope))
+    request.state.replica = replica
+    if replica is None:
+        database.get_engine()
+        async with database.open_session() as db:
+            yield db
+        return
+    async with replica.session() as db:
+        yield db
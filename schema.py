@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr, Field, HttpUrl
+from pydantic import BaseModel, EmailStr, Field, HttpUrl, ValidationError
 from fastapi import status
 from datetime import datetime
 
@@ -11,6 +11,11 @@ class CustomException(Exception):
         self.status_code = status_code
         self.msg = msg
 
+class ResponseException(Exception):
+    """Raised by dependencies to send an already built response."""
+    def __init__(self, response):
+        self.response = response
+
 class User(BaseModel):
     first_name: str
     last_name: str
@@ -40,6 +45,19 @@ class Assignment(BaseModel):
     class Config:
         orm_mode = True
 
+def validate_assignment(fields):
+    """
+    Validate one assignment outside a request body, e.g. a batch item or an imported row.
+
+    :return: (Assignment, None), or (None, the errors by field)
+    """
+    try:
+        return Assignment(**fields), None
+    except CustomException as e:
+        return None, e.msg
+    except ValidationError as e:
+        return None, {str(error["loc"][0]): error["msg"] for error in e.errors()}
+
 class Submission(BaseModel):
 
     def __init__(self, **data):
@@ -0,0 +1,109 @@
+"""
+Bulk load users from a CSV file with first_name,last_name,email,password columns.
+
+    python -m seed_users [/opt/user.csv] [--batch-size 1000] [--workers N]
+
+Existing emails are fetched in one query, new passwords are hashed in parallel on a
+process pool and rows are inserted in batches with executemany. The CSV is read as
+a stream, so memory only grows with the batch size.
+"""
+import argparse
+import csv
+import itertools
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert, select
+
+import models
+from database import get_engine
+from executors import process_pool
+from log import configure_logging
+from passwords import hash_password
+
+logger = logging.getLogger("cloud")
+
+DEFAULT_CSV_PATH = "/opt/user.csv"
+
+
+def new_user_rows(csv_file, existing_emails, counts):
+    """Yield CSV rows whose email is not stored yet, skipping duplicates within the file."""
+    for row in csv.DictReader(csv_file):
+        counts["read"] += 1
+        email = row["email"]
+        if email in existing_emails:
+            continue
+        existing_emails.add(email)
+        yield row
+
+
+def seed_users(path, batch_size=1000, workers=None):
+    """
+    Insert the users from ``path`` that do not exist yet.
+
+    :return: dict with the number of rows read, inserted and the rows per second
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    engine = get_engine()
+    models.ensure_schema(engine)
+    with engine.connect() as connection:
+        existing_emails = set(connection.scalars(select(models.User.email)))
+
+    counts = {"read": 0}
+    inserted = 0
+    with open(path, mode='r', newline='') as csv_file, process_pool(workers) as pool:
+        rows = new_user_rows(csv_file, existing_emails, counts)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            chunksize = max(1, len(batch) // (workers * 4))
+            hashes = pool.map(hash_password, [row["password"] for row in batch], chunksize=chunksize)
+            now = datetime.utcnow()
+            values = [{
+                "id": uuid.uuid4(),
+                "first_name": row["first_name"],
+                "last_name": row["last_name"],
+                "email": row["email"],
+                "password": password_hash,
+                "account_created": now,
+                "account_updated": now,
+            } for row, password_hash in zip(batch, hashes)]
+            with engine.begin() as connection:
+                connection.execute(insert(models.User.__table__), values)
+            inserted += len(values)
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "read": counts["read"],
+        "inserted": inserted,
+        "skipped": counts["read"] - inserted,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(inserted / elapsed, 1) if elapsed else 0.0,
+    }
+    logger.info("Seeded users: {}".format(summary))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load users from a CSV file")
+    parser.add_argument("path", nargs="?", default=DEFAULT_CSV_PATH)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None, help="hashing processes, defaults to the CPU count")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    if not os.path.isfile(args.path):
+        logger.error("CSV file doesn't exist")
+        return 1
+    seed_users(args.path, args.batch_size, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
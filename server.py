@@ -0,0 +1,253 @@
+"""
+Production entry point: a supervisor process running WEB_CONCURRENCY uvicorn workers.
+
+    python server.py
+
+The supervisor binds the listening socket once and hands it to every worker.
+Workers run on uvloop with the httptools parser. Before they are spawned, the
+total DB_CONNECTION_BUDGET is split between them into DB_POOL_SIZE and
+DB_MAX_OVERFLOW, and the CPUs into HASH_POOL_SIZE, so adding workers never
+exceeds what Postgres or the machine allows.
+
+A worker starts accepting connections only after the application lifespan has
+finished warming up; until then connections wait in the listen backlog. Once
+every worker is up the supervisor logs it and, under systemd, sends READY=1.
+
+SIGTERM or SIGINT drains: workers stop accepting, finish their in-flight
+requests and run the lifespan shutdown, and are killed after GRACEFUL_TIMEOUT.
+With MAX_REQUESTS set a worker exits after serving that many requests (plus a
+random MAX_REQUESTS_JITTER so they do not all restart together) and is
+replaced. A worker that crashes is replaced the same way.
+
+Workers share no memory, so the supervisor gives them what must agree: one
+AUTH_TOKEN_KEYS when it is not set, so a token issued by one worker is accepted
+by the others, and with more than one worker a CacheServer that holds the token
+revocations, cached assignments and read-your-writes pins for all of them
+(CACHE_BACKEND=cache:SharedBackend). It refuses to start several workers with
+CACHE_BACKEND=memory, where each would keep its own.
+
+A CacheServer that dies is restarted on the same socket and the workers
+reconnect to it. Until then they read past the caches, and reject every access
+token since they cannot check whether it was revoked. The revocations are lost
+with the old server, so the tokens issued before the restart stay rejected and
+their clients log in again.
+"""
+import logging
+import os
+import random
+import secrets
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import uvicorn
+from uvicorn._subprocess import get_subprocess, spawn
+
+import cache
+
+logger = logging.getLogger("cloud")
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+# Connections all workers may open together, 0 keeps DB_POOL_SIZE / DB_MAX_OVERFLOW as configured
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "0"))
+MAX_REQUESTS = int(os.getenv("MAX_REQUESTS", "0"))
+MAX_REQUESTS_JITTER = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+KEEPALIVE_TIMEOUT = int(os.getenv("KEEPALIVE_TIMEOUT", "5"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+
+
+def pool_settings(budget, workers, engines=1):
+    """
+    Split a connection budget into the pool size and overflow of each engine in each worker.
+
+    Two thirds of a worker's share stay open in the pool and the rest is overflow.
+    With DB_ASYNC every worker has a sync and an async engine, each gets half.
+    """
+    per_engine = budget // (workers * engines)
+    if per_engine < 1:
+        raise ValueError("DB_CONNECTION_BUDGET {} is too small for {} workers".format(budget, workers))
+    pool_size = max(1, per_engine * 2 // 3)
+    return pool_size, per_engine - pool_size
+
+
+def worker_environment(workers, budget=DB_CONNECTION_BUDGET):
+    """Settings the workers inherit, explicit environment variables win over the derived ones."""
+    if workers > 1 and os.getenv("CACHE_BACKEND") == "memory":
+        raise ValueError("CACHE_BACKEND=memory keeps token revocations, cached assignments and read-your-writes "
+                         "pins in each worker, use a shared CACHE_BACKEND or WEB_CONCURRENCY=1")
+    environment = {
+        "HASH_POOL_SIZE": str(max(1, (os.cpu_count() or 1) // workers)),
+        "AUTH_TOKEN_KEYS": "{}:{}".format(secrets.token_hex(4), secrets.token_urlsafe(32)),
+    }
+    if workers > 1:
+        environment["CACHE_BACKEND"] = "cache:SharedBackend"
+    if budget:
+        engines = 2 if os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes") else 1
+        pool_size, max_overflow = pool_settings(budget, workers, engines)
+        environment.update(DB_POOL_SIZE=str(pool_size), DB_MAX_OVERFLOW=str(max_overflow))
+    return {name: value for name, value in environment.items() if name not in os.environ}
+
+
+def start_cache_server(address, key, lost_before=0):
+    """Start a CacheServer process listening on ``address`` and wait until it accepts connections."""
+    if os.path.exists(address):
+        os.unlink(address)  # left behind by a server that died
+    process = spawn.Process(target=cache.serve, args=(address, key.encode(), lost_before),
+                            name="cache-server", daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(address) and process.is_alive() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    logger.info("Started cache server {}".format(process.pid))
+    return process
+
+
+def notify_systemd(state):
+    """sd_notify without libsystemd, a no-op outside a Type=notify unit."""
+    address = os.getenv("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+        notify_socket.sendto(state.encode(), address)
+
+
+class WorkerServer(uvicorn.Server):
+    """uvicorn Server that reports to the supervisor once it accepts connections."""
+
+    def __init__(self, config, ready):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets=None):
+        # The lifespan (schema, warmup) completes before uvicorn starts listening
+        await super().startup(sockets=sockets)
+        if not self.should_exit:
+            self.ready.set()
+
+
+class Worker:
+    def __init__(self, config, sockets):
+        self.ready = spawn.Event()
+        self.process = get_subprocess(config, WorkerServer(config, self.ready).run, sockets)
+        self.process.start()
+
+
+class Supervisor:
+    def __init__(self, workers=WEB_CONCURRENCY, host=HOST, port=PORT):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.running = []
+        self.cache_server = None
+        self.cache_directory = None
+        self._stop = threading.Event()
+
+    def config(self):
+        limit = MAX_REQUESTS + random.randint(0, MAX_REQUESTS_JITTER) if MAX_REQUESTS else None
+        return uvicorn.Config(
+            "main:app", host=self.host, port=self.port, loop="uvloop", http="httptools",
+            lifespan="on", workers=self.workers, limit_max_requests=limit,
+            timeout_keep_alive=KEEPALIVE_TIMEOUT, backlog=BACKLOG, proxy_headers=True,
+        )
+
+    def spawn_worker(self, sockets):
+        worker = Worker(self.config(), sockets)
+        logger.info("Started worker {}".format(worker.process.pid))
+        return worker
+
+    def handle_signal(self, signum, frame):
+        self._stop.set()
+
+    def start_cache_server(self):
+        """Run the CacheServer on a Unix socket in a directory only this user can open."""
+        self.cache_directory = tempfile.mkdtemp(prefix="cloud-cache-")
+        os.environ.update(CACHE_SERVER_ADDRESS=os.path.join(self.cache_directory, "cache.sock"),
+                          CACHE_SERVER_KEY=secrets.token_hex(16))
+        self.cache_server = start_cache_server(os.environ["CACHE_SERVER_ADDRESS"], os.environ["CACHE_SERVER_KEY"])
+
+    def check_cache_server(self):
+        """Restart a CacheServer that died, telling its stores when the old one lost their entries."""
+        if self.cache_server is None or self.cache_server.is_alive():
+            return
+        logger.error("Cache server {} exited with {}, restarting it; access tokens issued before are rejected".format(
+            self.cache_server.pid, self.cache_server.exitcode))
+        self.cache_server = start_cache_server(os.environ["CACHE_SERVER_ADDRESS"], os.environ["CACHE_SERVER_KEY"],
+                                               lost_before=int(time.time()))
+
+    def stop_cache_server(self):
+        if self.cache_server is None:
+            return
+        self.cache_server.kill()
+        self.cache_server.join()
+        self.cache_server = None
+        shutil.rmtree(self.cache_directory, ignore_errors=True)
+
+    def run(self):
+        environment = worker_environment(self.workers)
+        if "AUTH_TOKEN_KEYS" in environment:
+            logger.warning("AUTH_TOKEN_KEYS is not set, access tokens are only valid until the server restarts")
+        os.environ.update(environment)
+        if os.environ.get("CACHE_BACKEND") == "cache:SharedBackend":
+            self.start_cache_server()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+
+        sock = self.config().bind_socket()
+        logger.info("Listening on {}:{} with {} workers".format(self.host, self.port, self.workers))
+        self.running = [self.spawn_worker([sock]) for _ in range(self.workers)]
+        announced = False
+        while not self._stop.wait(0.5):
+            self.check_cache_server()
+            for slot, worker in enumerate(self.running):
+                if not worker.process.is_alive():
+                    logger.info("Worker {} exited with {}, replacing it".format(
+                        worker.process.pid, worker.process.exitcode))
+                    self.running[slot] = self.spawn_worker([sock])
+            if not announced and all(worker.ready.is_set() for worker in self.running):
+                logger.info("All {} workers are ready".format(self.workers))
+                notify_systemd("READY=1")
+                announced = True
+
+        notify_systemd("STOPPING=1")
+        self.drain()
+        sock.close()
+        self.stop_cache_server()
+
+    def drain(self):
+        """Ask every worker to finish its in-flight requests, kill the ones still busy after GRACEFUL_TIMEOUT."""
+        logger.info("Draining {} workers".format(len(self.running)))
+        for worker in self.running:
+            if worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        for worker in self.running:
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning("Worker {} did not drain in time, killing it".format(worker.process.pid))
+                worker.process.kill()
+                worker.process.join()
+
+
+def main():
+    from log import configure_logging
+
+    configure_logging()
+    try:
+        Supervisor().run()
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,959 @@
-from fastapi.testclient import TestClient
-from fastapi import status
-from main import app
+import asyncio
+import base64
+import gzip
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
 import pytest
+from fastapi import status
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, delete, event, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import admission
+import cache
+import database
+import events
+import export_submissions
+import idempotency
+import import_assignments
+import lifecycle
+import main
+import metrics
+import models
+import profiling
+import replicas
+import seed_users
+import server
+from auth import CredentialCache, TokenSigner, credential_cache
+from cache import MemoryBackend
+from database import SessionLocal
+from events import SubmissionPublisher, submission_event
+from executors import TrackedExecutor, run_io
+from health import CircuitBreaker, DatabaseHealth
+from idempotency import IdempotencyMiddleware, IdempotencyStore
+from log import DroppingQueueHandler, JsonFormatter, SuccessSampler
+from main import app, claim_attempt_statement, submission_insert_statement
+from passwords import pwd_context
 
 
 client = TestClient(app=app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def running_app():
+    # Keep one event loop for the whole module so pooled async connections stay valid
+    with client:
+        yield
+
+
 def test_create_user():
     response = client.get('/healthz')
     print(response.content)
 
     assert response.status_code == status.HTTP_200_OK
+
+
+def test_metrics_reports_pool_usage():
+    client.get('/v3/assignments')
+    response = client.get('/metrics')
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["db_pool"]["checkouts"] >= 1
+
+
+def test_timing_middleware_reports_route_and_query_metrics(monkeypatch):
+    sent = []
+    monkeypatch.setattr(metrics.RequestMetrics, "send", lambda self, client=None: sent.append(list(self.buffer)))
+    client.get('/v3/assignments', params={"owner": "nobody-{}@example.com".format(uuid.uuid4().hex)})
+
+    names = {name: value for kind, name, value in sent[-1]}
+    assert "route.get_assignments.200" in names
+    assert names["route.get_assignments.db_queries"] >= 1
+    assert names["Get_Assignment_List"] == 1
+
+
+def test_profiling_middleware_records_stacks_and_sql(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_DIR", str(tmp_path))
+    profiling.instrument_engine(database.engine)
+
+    def slow_query():
+        with database.engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        time.sleep(0.05)
+
+    async def endpoint(scope, receive, send):
+        await run_io(slow_query)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    try:
+        middleware = profiling.ProfilingMiddleware(endpoint, sample_rate=1.0)
+        asyncio.run(middleware({"type": "http", "method": "GET", "path": "/profiled", "headers": []}, None, send))
+    finally:
+        event.remove(database.engine, "before_cursor_execute", profiling._before_cursor_execute)
+        event.remove(database.engine, "after_cursor_execute", profiling._after_cursor_execute)
+
+    summary = profiling.recent(1)[0]
+    assert (b"x-profile-id", summary["id"].encode()) in messages[0]["headers"]
+    monkeypatch.setattr(profiling, "PROFILING_KEY", "secret")
+    listed = client.get('/admin/profiles?limit=1', headers={profiling.PROFILING_HEADER: "secret"}).json()["profiles"]
+    assert [profile["id"] for profile in listed] == [summary["id"]]
+    assert summary["path"] == "/profiled" and summary["wall_ms"] >= 50
+    with open(summary["file"][:-len(".collapsed")] + ".json") as metadata:
+        assert [statement["statement"] for statement in json.load(metadata)["sql"]] == ["SELECT 1"]
+    with open(summary["file"]) as collapsed:
+        assert "slow_query (test_main.py" in collapsed.read()
+
+
+
+def test_profiles_are_only_listed_with_the_profiling_key(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_KEY", "")
+    assert not profiling.authorized("") and not profiling.authorized("anything")
+    assert client.get('/admin/profiles').status_code == status.HTTP_403_FORBIDDEN
+
+    monkeypatch.setattr(profiling, "PROFILING_KEY", "secret")
+    assert profiling.authorized("secret") and not profiling.authorized("\xe9")
+    assert client.get('/admin/profiles', headers={profiling.PROFILING_HEADER: "wrong"}).status_code == status.HTTP_403_FORBIDDEN
+    assert client.get('/admin/profiles', headers={profiling.PROFILING_HEADER: "secret"}).status_code == status.HTTP_200_OK
+
+def test_schema_is_only_applied_when_fingerprint_changes():
+    assert app.state.ready is True
+    assert models.ensure_schema() is False
+
+
+def test_worker_stays_unready_until_the_schema_applies(monkeypatch):
+    attempts = []
+
+    def ensure_schema():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("database is starting")
+
+    monkeypatch.setattr(models, "ensure_schema", ensure_schema)
+    monkeypatch.setattr(lifecycle, "SCHEMA_RETRY_INTERVAL", 0.01)
+    monkeypatch.setattr(lifecycle, "STARTUP_WARMUP", False)
+    worker = types.SimpleNamespace(state=types.SimpleNamespace(ready=False))
+    assert client.portal.call(lifecycle.apply_schema) is False
+    client.portal.call(lifecycle.retry_schema, worker)
+    assert len(attempts) == 3 and worker.state.ready is True
+
+
+def test_circuit_breaker_fast_fails_until_half_open_probe_succeeds():
+    probe_results = [False, False, True]
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return probe_results[len(calls) - 1]
+
+    health = DatabaseHealth(probe=probe, ttl=60, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.05))
+    # Requests never probe, only the monitor (or startup) does
+    assert health.is_available() is False
+    assert len(calls) == 0
+    assert health.check() is False
+    assert health.check() is False
+    assert health.breaker.state == CircuitBreaker.OPEN
+
+    # Open breaker rejects without probing
+    assert health.check() is False
+    assert len(calls) == 2
+
+    time.sleep(0.06)
+    assert health.breaker.state == CircuitBreaker.HALF_OPEN
+    assert health.check() is True
+    assert health.is_available() is True
+    assert health.breaker.state == CircuitBreaker.CLOSED
+    assert len(calls) == 3
+    health._checked_at -= 61
+    assert health.is_available() is False
+
+
+def test_credential_cache_invalidates_on_hash_change_and_evicts_lru():
+    cache = CredentialCache(max_size=2, ttl=60, enabled=True)
+    cache.put("Basic a", "hash-a")
+    assert cache.get("Basic a", "hash-a") is True
+    assert cache.get("Basic a", "new-hash") is False
+    assert cache.get("Basic a", "hash-a") is False
+
+    cache.put("Basic a", "hash-a")
+    cache.put("Basic b", "hash-b")
+    cache.put("Basic c", "hash-c")
+    assert cache.get("Basic a", "hash-a") is False
+    assert cache.stats()["evictions"] == 1
+    assert all(b"Basic" not in key for key in cache._entries)
+
+
+def test_token_signer_rotates_keys_and_revokes():
+    old = TokenSigner(keys=OrderedDict(k1=b"old-secret"), ttl=60)
+    token = old.issue(uuid.uuid4(), "a@example.com")
+    rotated = TokenSigner(keys=OrderedDict(k2=b"new-secret", k1=b"old-secret"), ttl=60)
+    assert rotated.verify(token)["email"] == "a@example.com"
+    assert rotated.issue(uuid.uuid4(), "b@example.com").startswith("k2.")
+    assert TokenSigner(keys=OrderedDict(k2=b"new-secret")).verify(token) is None
+
+    kid, payload, signature = token.split(".")
+    assert rotated.verify("{}.{}.{}".format(kid, payload[:-2] + "AA", signature)) is None
+    assert TokenSigner(keys=OrderedDict(k1=b"old-secret"), ttl=-1).verify(
+        TokenSigner(keys=OrderedDict(k1=b"old-secret"), ttl=-1).issue(uuid.uuid4(), "c@example.com")) is None
+
+    rotated.revoke(rotated.verify(token))
+    assert rotated.verify(token) is None
+
+
+def test_malformed_bearer_tokens_are_rejected_with_401():
+    kid = TokenSigner().active_kid
+    assert TokenSigner().verify("{}.abc.\xe9".format(kid)) is None
+    for token in ("{}.abc.\xe9".format(kid), "\xe9.abc.def", "{}.\xe9.abc".format(kid), "no-dots"):
+        # Sent as raw bytes, the server decodes header values as latin-1
+        headers = {"Authorization": "Bearer {}".format(token).encode("latin-1")}
+        assert client.post('/v3/user/logout', headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+        assert client.post('/v3/assignments', json={"name": "x", "points": 1, "num_of_attemps": 1,
+                                                    "deadline": "2099-01-01T00:00:00"},
+                           headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+        assert client.get('/v3/assignments/{}'.format(uuid.uuid4()), headers=headers).status_code in (
+            status.HTTP_401_UNAUTHORIZED, status.HTTP_404_NOT_FOUND)
+
+
+def test_log_queue_drops_when_full_and_samples_successes():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    handler.addFilter(SuccessSampler(rate=0))
+    logger = logging.getLogger("log-pipeline-test")
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        logger.error("%s %s", "created", 201, extra={"status_code": 201})
+        logger.error("%s %s", "not found", 404, extra={"status_code": 404})
+        logger.error("%s %s", "conflict", 409, extra={"status_code": 409})
+    finally:
+        logger.removeHandler(handler)
+
+    assert handler.dropped == 1
+    line = json.loads(JsonFormatter().format(handler.queue.get_nowait()))
+    assert line["message"] == "not found 404" and line["status_code"] == 404
+
+
+def test_seed_users_skips_existing_and_duplicate_emails(tmp_path):
+    existing = "seed-{}@example.com".format(uuid.uuid4().hex)
+    new = "seed-{}@example.com".format(uuid.uuid4().hex)
+    db = SessionLocal()
+    db.add(models.User(email=existing, first_name="a", last_name="b", password="x"))
+    db.commit()
+    path = tmp_path / "users.csv"
+    path.write_text("first_name,last_name,email,password\n"
+                    "a,b,{0},pw\nc,d,{1},pw\ne,f,{1},other\n".format(existing, new))
+    try:
+        summary = seed_users.seed_users(str(path), batch_size=1, workers=1)
+        assert (summary["read"], summary["inserted"], summary["skipped"]) == (3, 1, 2)
+        stored = db.scalars(select(models.User).filter(models.User.email.in_([existing, new]))).all()
+        assert sorted(user.first_name for user in stored) == ["a", "c"]
+        assert pwd_context.verify("pw", next(user for user in stored if user.email == new).password)
+        assert seed_users.main([str(tmp_path / "missing.csv")]) == 1
+    finally:
+        db.execute(delete(models.User).filter(models.User.email.in_([existing, new])))
+        db.commit()
+        db.close()
+
+
+def test_server_splits_connection_budget_between_workers(monkeypatch):
+    assert server.pool_settings(80, 4) == (13, 7)
+    assert server.pool_settings(80, 4, engines=2) == (6, 4)
+    with pytest.raises(ValueError):
+        server.pool_settings(3, 4)
+
+    monkeypatch.setenv("DB_ASYNC", "false")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+    monkeypatch.delenv("DB_POOL_SIZE", raising=False)
+    environment = server.worker_environment(4, budget=80)
+    assert environment["DB_POOL_SIZE"] == "13" and "DB_MAX_OVERFLOW" not in environment
+    assert environment["CACHE_BACKEND"] == "cache:SharedBackend" and environment["AUTH_TOKEN_KEYS"]
+
+    monkeypatch.setenv("CACHE_BACKEND", "memory")
+    assert "CACHE_BACKEND" not in server.worker_environment(1)
+    with pytest.raises(ValueError):
+        server.worker_environment(2)
+
+
+def test_workers_accept_and_revoke_each_others_tokens(user_with_credentials):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    environment = {name: value for name, value in os.environ.items()
+                   if name not in ("CACHE_BACKEND", "AUTH_TOKEN_KEYS", "WEB_CONCURRENCY")}
+    environment.update(HOST="127.0.0.1", PORT=str(port), WEB_CONCURRENCY="2", STARTUP_WARMUP="false")
+    email = user_with_credentials[0].email
+    supervisor = subprocess.Popen([sys.executable, "server.py"], env=environment, cwd=os.path.dirname(os.path.abspath(__file__)))
+    url = "http://127.0.0.1:{}".format(port)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if httpx.get(url + "/healthz").status_code == status.HTTP_200_OK:
+                    break
+            except httpx.TransportError:
+                pass
+            assert time.monotonic() < deadline, "server.py did not start"
+            time.sleep(0.2)
+
+        token = httpx.post(url + "/v3/user/login", json={"email": email, "password": "pw"}).headers["access-token"]
+        bearer = {"Authorization": "Bearer " + token}
+        body = {"name": "workers", "points": 5, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}
+        id = httpx.post(url + "/v3/assignments", json=body, headers=bearer).json()["id"]
+
+        # A new connection per request, spread over both workers
+        get = lambda path, headers=None: httpx.get(url + path, headers=headers)
+        with ThreadPoolExecutor(8) as pool:
+            workers = {stats["auth_tokens"]["issued"] for stats in
+                       (response.json() for response in pool.map(get, ["/metrics"] * 40))}
+            assert workers == {0, 1}, "both workers serve requests"
+            assert {response.status_code for response in pool.map(
+                get, ["/v3/assignments/{}".format(id)] * 40, [bearer] * 40)} == {status.HTTP_200_OK}
+
+            assert httpx.post(url + "/v3/user/logout", headers=bearer).status_code == status.HTTP_204_NO_CONTENT
+            assert {response.status_code for response in pool.map(
+                get, ["/v3/assignments/{}".format(id)] * 40, [bearer] * 40)} == {status.HTTP_401_UNAUTHORIZED}
+            # The worker that did not issue the token saw the revocation too
+            assert any(stats["auth_tokens"]["issued"] == 0 and stats["auth_tokens"]["rejected"] for stats in
+                       (response.json() for response in pool.map(get, ["/metrics"] * 40)))
+    finally:
+        supervisor.terminate()
+        assert supervisor.wait(60) == 0
+
+
+
+def test_supervisor_restarts_a_dead_cache_server(monkeypatch):
+    # Set by the supervisor for its workers, restored after the test
+    monkeypatch.setenv("CACHE_SERVER_ADDRESS", "")
+    monkeypatch.setenv("CACHE_SERVER_KEY", "")
+    supervisor = server.Supervisor(workers=2)
+    supervisor.start_cache_server()
+    try:
+        monkeypatch.setattr(cache, "CACHE_SERVER_ADDRESS", os.environ["CACHE_SERVER_ADDRESS"])
+        monkeypatch.setattr(cache, "CACHE_SERVER_KEY", os.environ["CACHE_SERVER_KEY"])
+        monkeypatch.setattr(cache, "CACHE_RECONNECT_INTERVAL", 0)
+        signer = TokenSigner(keys=OrderedDict(k1=b"secret"), backend=cache.SharedBackend("revoked_tokens"))
+        assignments = cache.AssignmentCache(cache.SharedBackend("assignments"))
+        token = signer.issue(uuid.uuid4(), "a@example.com")
+        assert client.portal.call(signer.check, token)["email"] == "a@example.com"
+        client.portal.call(assignments.invalidate)
+        assert client.portal.call(assignments.generation) == 1
+        assert assignments.backend.set_if_counter("page", b"[]", "assignments:generation", 1)
+        assert not assignments.backend.set_if_counter("page", b"{}", "assignments:generation", 0)
+
+        supervisor.cache_server.kill()
+        supervisor.cache_server.join()
+        # Revocations cannot be checked so the token is rejected, the assignment cache only misses
+        assert client.portal.call(signer.check, token) is None
+        assert client.portal.call(assignments.generation) is None
+        assert client.portal.call(assignments.get_assignment, uuid.uuid4()) is None
+        client.portal.call(assignments.invalidate)
+
+        supervisor.check_cache_server()
+        assert supervisor.cache_server.is_alive()
+        # Its revocation may have been lost with the old server
+        assert client.portal.call(signer.check, token) is None
+        assert client.portal.call(assignments.generation) > 1
+        time.sleep(1.1)
+        assert client.portal.call(signer.check, signer.issue(uuid.uuid4(), "a@example.com"))
+    finally:
+        supervisor.stop_cache_server()
+
+
+def test_assignment_cache_only_stores_pages_of_the_current_generation():
+    assignments = cache.AssignmentCache(MemoryBackend(), enabled=True)
+    put_page = lambda generation: client.portal.call(assignments.put_page, "q", generation, ["id"], [], b"[]", None)
+    generation = client.portal.call(assignments.generation)
+    # A write committed while the page was queried
+    client.portal.call(assignments.invalidate)
+    put_page(generation)
+    assert client.portal.call(assignments.get_page, "q", generation) is None
+
+    generation = client.portal.call(assignments.generation)
+    put_page(generation)
+    assert client.portal.call(assignments.get_page, "q", generation).body == b"[]"
+
+
+def test_hash_pool_functions_only_import_passlib():
+    # What a forkserver hash worker imports to unpickle them
+    loaded = subprocess.run([sys.executable, "-c", "import sys, passwords; print(' '.join(sys.modules))"],
+                            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert not {"auth", "cache", "database", "fastapi", "sqlalchemy"} & set(loaded.stdout.split())
+
+def test_tracked_executor_reports_queue_depth():
+    release = threading.Event()
+    pool = TrackedExecutor("test", lambda size: ThreadPoolExecutor(size), 1)
+    futures = [pool.submit(release.wait) for _ in range(3)]
+    assert pool.stats()["in_flight"] == 3
+    assert pool.stats()["queued"] == 2
+
+    release.set()
+    for future in futures:
+        future.result()
+    pool.shutdown()
+    assert pool.stats()["in_flight"] == 0
+    assert pool.stats()["completed"] == 3
+
+
+
+@pytest.mark.parametrize("db_async", [False, True])
+def test_open_session_reads_and_writes_on_either_driver(db_async, tmp_path, monkeypatch):
+    url = "sqlite:///{}".format(tmp_path / "sessions.db")
+    sync_engine = create_engine(url)
+    models.Base.metadata.create_all(sync_engine)
+    session_factory = sessionmaker(bind=sync_engine, autoflush=False, expire_on_commit=False)
+    monkeypatch.setattr(database, "DB_ASYNC", db_async)
+    monkeypatch.setattr(database, "async_engine", None)
+    monkeypatch.setattr(database, "AsyncSessionLocal", None)
+    monkeypatch.setenv("DATABASE_ASYNC_URL", database._async_database_url(url))
+    if db_async:
+        assert database.init_async_engine().dialect.driver == "aiosqlite"
+
+    async def write_and_read():
+        async with database.open_session(session_factory) as db:
+            db.add(models.User(first_name="A", last_name="B", password="x", email="driver@example.com"))
+            await db.commit()
+        async with database.open_session(session_factory) as db:
+            return type(db), await db.scalar(select(models.User.first_name).filter_by(email="driver@example.com"))
+
+    try:
+        assert client.portal.call(write_and_read) == (AsyncSession if db_async else database.ThreadedSession, "A")
+    finally:
+        if database.async_engine is not None:
+            client.portal.call(database.async_engine.dispose)
+        sync_engine.dispose()
+
+@pytest.fixture
+def owner_with_assignments():
+    db = SessionLocal()
+    owner = models.User(email="owner-{}@example.com".format(uuid.uuid4().hex), first_name="a", last_name="b", password="x")
+    db.add(owner)
+    db.flush()
+    created = datetime(2020, 1, 1)
+    for i in range(5):
+        db.add(models.Assignment(name="a{}".format(i), points=5, num_of_attemps=3, owner_user_id=owner.id,
+                                 deadline=created + timedelta(days=i), assignment_created=created + timedelta(seconds=i)))
+    db.commit()
+    yield owner
+    db.query(models.Assignment).filter_by(owner_user_id=owner.id).delete()
+    db.delete(owner)
+    db.commit()
+    db.close()
+
+
+@pytest.fixture
+def user_with_credentials():
+    """A user whose password is ``pw`` and its Basic auth headers, deleted with everything it owns."""
+    db = SessionLocal()
+    user = models.User(email="user-{}@example.com".format(uuid.uuid4().hex), first_name="a", last_name="b",
+                       password=pwd_context.using(bcrypt__rounds=4).hash("pw"))
+    db.add(user)
+    db.commit()
+    yield user, {"Authorization": "Basic " + base64.b64encode("{}:pw".format(user.email).encode()).decode()}
+    owned = select(models.Assignment.id).filter_by(owner_user_id=user.id)
+    submissions = select(models.Submission.id).where(models.Submission.assignment_id.in_(owned))
+    db.execute(delete(models.SubmissionEvent).where(models.SubmissionEvent.submission_id.in_(submissions)))
+    db.execute(delete(models.Submission).where(models.Submission.assignment_id.in_(owned)))
+    db.execute(delete(models.Assignment).filter_by(owner_user_id=user.id))
+    db.execute(delete(models.User).filter_by(id=user.id))
+    db.commit()
+    db.close()
+
+
+def test_list_assignments_keyset_pagination(owner_with_assignments):
+    params = {"owner": owner_with_assignments.email, "limit": 2, "fields": "name,id"}
+    names = []
+    while True:
+        response = client.get('/v3/assignments', params=params)
+        assert response.status_code == status.HTTP_200_OK
+        assert all(set(item) == {"id", "name"} for item in response.json())
+        names += [item["name"] for item in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert names == ["a0", "a1", "a2", "a3", "a4"]
+
+
+def test_list_assignments_streams_ndjson_with_filters(owner_with_assignments):
+    response = client.get('/v3/assignments', params={
+        "owner": owner_with_assignments.email, "format": "ndjson",
+        "deadline_from": "2020-01-02T00:00:00", "deadline_to": "2020-01-04T00:00:00"})
+    assert response.status_code == status.HTTP_200_OK
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["name"] for row in rows] == ["a1", "a2", "a3"]
+
+
+def test_assignment_etag_and_bearer_token_flow(user_with_credentials):
+    user, headers = user_with_credentials
+    email = user.email
+    body = {"name": "etag", "points": 5, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}
+    id = client.post('/v3/assignments', json=body, headers=headers).json()["id"]
+    first = client.get('/v3/assignments/{}'.format(id), headers=headers)
+    etag = first.headers["ETag"]
+    cached = client.get('/v3/assignments/{}'.format(id), headers=dict(headers, **{"If-None-Match": etag}))
+    assert cached.status_code == status.HTTP_304_NOT_MODIFIED
+
+    page = client.get('/v3/assignments', params={"owner": email})
+    assert client.get('/v3/assignments', params={"owner": email},
+                      headers={"If-None-Match": page.headers["ETag"]}).status_code == status.HTTP_304_NOT_MODIFIED
+
+    statements = []
+    engine = database.async_engine.sync_engine if database.DB_ASYNC else database.engine
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        client.put('/v3/assignments/{}'.format(id), json=dict(body, name="renamed"), headers=headers)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    # Assignment and caller in one SELECT, then the UPDATE and the refresh
+    assert len([statement for statement in statements if statement.lstrip().startswith("SELECT")]) == 2
+    assert len([statement for statement in statements if "JOIN users" in statement]) == 1
+    updated = client.get('/v3/assignments/{}'.format(id), headers=dict(headers, **{"If-None-Match": etag}))
+    assert updated.status_code == status.HTTP_200_OK
+    assert updated.json()["name"] == "renamed"
+    page = client.get('/v3/assignments', params={"owner": email}, headers={"If-None-Match": page.headers["ETag"]})
+    assert page.json()[0]["name"] == "renamed"
+
+    token = client.post('/v3/user/login', json={"email": email, "password": "pw"}).headers["access-token"]
+    bearer = {"Authorization": "Bearer " + token}
+    assert client.get('/v3/assignments/{}'.format(id), headers=bearer).json()["name"] == "renamed"
+    assert client.delete('/v3/assignments/{}'.format(id), headers=bearer).status_code == status.HTTP_204_NO_CONTENT
+    assert client.get('/v3/assignments', params={"owner": email}).json() == []
+
+    assert client.post('/v3/user/logout', headers=bearer).status_code == status.HTTP_204_NO_CONTENT
+    assert client.post('/v3/assignments', json=body, headers=bearer).status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_cached_assignment_read_rechecks_a_changed_password(user_with_credentials):
+    user, headers = user_with_credentials
+    basic = lambda password: {"Authorization": "Basic " + base64.b64encode("{}:{}".format(user.email, password).encode()).decode()}
+    body = {"name": "cached", "points": 5, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}
+    id = client.post('/v3/assignments', json=body, headers=headers).json()["id"]
+    assert client.get('/v3/assignments/{}'.format(id), headers=headers).status_code == status.HTTP_200_OK
+    hits = credential_cache.hits
+    assert client.get('/v3/assignments/{}'.format(id), headers=headers).status_code == status.HTTP_200_OK
+    assert credential_cache.hits > hits
+
+    with SessionLocal() as db:
+        db.execute(update(models.User).filter_by(id=user.id).values(password=pwd_context.using(bcrypt__rounds=4).hash("new")))
+        db.commit()
+    assert client.get('/v3/assignments/{}'.format(id), headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+    assert client.get('/v3/assignments/{}'.format(id), headers=basic("new")).status_code == status.HTTP_200_OK
+
+
+def test_reads_use_replica_until_the_client_writes(user_with_credentials, tmp_path, monkeypatch):
+    # The replica is a second database holding an assignment the primary does not have
+    router = replicas.ReplicaRouter("sqlite:///{}".format(tmp_path / "replica.db"), window=60)
+    replica = router.init()[0]
+    models.create_schema(replica.engine)
+    assert replica.health.check() is True
+    email = "replica-{}@example.com".format(uuid.uuid4().hex)
+    user_id = uuid.uuid4()
+    with replica.engine.begin() as connection:
+        connection.execute(models.User.__table__.insert(), {
+            "id": user_id, "email": email, "first_name": "r", "last_name": "r", "password": "x",
+            "account_created": datetime.utcnow(), "account_updated": datetime.utcnow()})
+        connection.execute(models.Assignment.__table__.insert(), {
+            "id": uuid.uuid4(), "name": "on-replica", "points": 1, "num_of_attemps": 1, "deadline": datetime(2099, 1, 1),
+            "owner_user_id": user_id, "submission_count": 0,
+            "assignment_created": datetime.utcnow(), "assignment_updated": datetime.utcnow()})
+    monkeypatch.setattr(replicas, "replica_router", router)
+    writer, writer_headers = user_with_credentials
+    body = {"name": "x", "points": 1, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}
+    read = lambda headers=None: [row["name"] for row in client.get('/v3/assignments', params={"owner": email}, headers=headers).json()]
+    try:
+        assert read(writer_headers) == ["on-replica"]
+
+        # Logins, anonymous and rejected requests and failed writes pin nobody
+        assert client.post('/v3/user/login', json={"email": writer.email, "password": "pw"},
+                           headers=writer_headers).status_code == status.HTTP_200_OK
+        assert client.post('/v3/assignments', json=body).status_code == status.HTTP_400_BAD_REQUEST
+        assert client.post('/v3/assignments', json=dict(body, points=11), headers=writer_headers).status_code == \
+            status.HTTP_400_BAD_REQUEST
+        assert read() == ["on-replica"] and read(writer_headers) == ["on-replica"]
+        assert router.stats()["pinned_reads"] == 0
+
+        assert client.post('/v3/assignments', json=body, headers=writer_headers).status_code == status.HTTP_201_CREATED
+        # The writer reads from the primary now, other clients keep using the replica
+        assert read(writer_headers) == []
+        streamed = client.get('/v3/assignments', params={"owner": email, "format": "ndjson"})
+        assert [json.loads(line)["name"] for line in streamed.text.splitlines()] == ["on-replica"]
+
+        replica.health = DatabaseHealth(probe=lambda: False)
+        assert read() == []
+        assert router.stats()["pinned_reads"] == 1 and router.stats()["primary_fallback_reads"] == 1
+
+        # A response that outlasts the window still pins the client once it finished
+        async def slow_write(scope, receive, send):
+            await send({"type": "http.response.start", "status": 201, "headers": []})
+            await asyncio.sleep(0.3)
+            await send({"type": "http.response.body", "body": b""})
+
+        async def send(message):
+            pass
+
+        router.window = 0.2
+        scope = {"type": "http", "method": "POST", "path": "/v3/assignments", "headers": [(b"authorization", b"Bearer slow")]}
+        client.portal.call(replicas.ReadYourWritesMiddleware(slow_write), scope, None, send)
+        assert client.portal.call(router.pinned, replicas.client_key(scope))
+    finally:
+        client.portal.call(router.dispose)
+
+
+def test_admission_limits_password_checks_and_sheds_load(monkeypatch):
+    buckets = admission.TokenBuckets(rate=1, burst=2, max_size=3)
+    assert [buckets.take("a", now=0), buckets.take("a", now=0)] == [0, 0]
+    assert buckets.take("a", now=0) == 1
+    buckets.take("b", now=0), buckets.take("c", now=0), buckets.take("d", now=0)
+    assert len(buckets) == 3 and buckets.evictions == 1
+    # Buckets that refilled completely are dropped from the front as traffic arrives
+    buckets.take("e", now=10)
+    assert len(buckets) == 2
+
+    control = admission.admission_control
+    monkeypatch.setattr(control, "email_buckets", admission.TokenBuckets(rate=0.001, burst=2))
+    email = "admission-{}@example.com".format(uuid.uuid4().hex)
+    statuses = [client.post('/v3/user/login', json={"email": email, "password": "wrong"}).status_code for _ in range(3)]
+    assert statuses == [status.HTTP_401_UNAUTHORIZED, status.HTTP_401_UNAUTHORIZED, status.HTTP_429_TOO_MANY_REQUESTS]
+    basic = {"Authorization": "Basic " + base64.b64encode("{}:wrong".format(email).encode()).decode()}
+    limited = client.get('/v3/assignments/{}'.format(uuid.uuid4()), headers=basic)
+    assert limited.status_code == status.HTTP_429_TOO_MANY_REQUESTS and int(limited.headers["retry-after"]) > 1
+
+    monkeypatch.setattr(control, "db_waiting_limit", 1)
+    monkeypatch.setattr(database, "request_pool", lambda: type("Pool", (), {"waiting": 1})())
+    assert client.get('/v3/assignments').status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert client.get('/healthz').status_code == status.HTTP_200_OK
+    assert control.stats()["rejected"]["email"] == 2 and control.stats()["rejected"]["db_pool"] >= 1
+
+
+def test_idempotency_key_replays_and_coalesces_duplicates(user_with_credentials, monkeypatch):
+    headers = user_with_credentials[1]
+    body = {"name": "once", "points": 5, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}
+    published = []
+    monkeypatch.setattr(events.publisher, "enqueue", published.append)
+    first = client.post('/v3/assignments', json=body, headers=dict(headers, **{"Idempotency-Key": "create-1"}))
+    again = client.post('/v3/assignments', json=body, headers=dict(headers, **{"Idempotency-Key": "create-1"}))
+    assert again.json()["id"] == first.json()["id"] and again.headers["idempotent-replayed"] == "true"
+    reused = client.post('/v3/assignments', json=dict(body, name="other"), headers=dict(headers, **{"Idempotency-Key": "create-1"}))
+    assert reused.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # One attempt is allowed, duplicates sent at the same time must not run again
+    url = '/v3/assignments/{}/submission'.format(first.json()["id"])
+    submit = lambda i: client.post(url, json={"submission_url": "https://example.com/a.zip"},
+                                   headers=dict(headers, **{"Idempotency-Key": "submit-1"}))
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(submit, range(4)))
+    assert [response.status_code for response in responses] == [status.HTTP_201_CREATED] * 4
+    assert len({response.json()["id"] for response in responses}) == 1
+    assert len(published) == 1
+
+
+
+def test_idempotency_key_is_not_used_up_by_a_rejected_request(user_with_credentials):
+    user, headers = user_with_credentials
+    body = {"name": "after-401", "points": 5, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}
+    headers = dict(headers, **{"Idempotency-Key": "create-after-401"})
+    with SessionLocal() as db:
+        password = db.scalar(select(models.User.password).filter_by(id=user.id))
+        db.execute(update(models.User).filter_by(id=user.id).values(password=pwd_context.using(bcrypt__rounds=4).hash("new")))
+        db.commit()
+    assert client.post('/v3/assignments', json=body, headers=headers).status_code == status.HTTP_401_UNAUTHORIZED
+
+    with SessionLocal() as db:
+        db.execute(update(models.User).filter_by(id=user.id).values(password=password))
+        db.commit()
+    retried = client.post('/v3/assignments', json=body, headers=headers)
+    assert retried.status_code == status.HTTP_201_CREATED and "idempotent-replayed" not in retried.headers
+
+def test_idempotency_keys_are_shared_by_stores_of_different_workers():
+    # Two workers: their own memory and in-flight requests, one idempotency_keys table
+    first, second = (IdempotencyStore(backend=MemoryBackend(), lock_timeout=0.5) for _ in range(2))
+    calls = []
+
+    async def create(scope, receive, send):
+        calls.append(scope["path"])
+        await asyncio.sleep(0.2)
+        await send({"type": "http.response.start", "status": 201, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b'{"n":%d}' % len(calls)})
+
+    async def post(store, key, body=b"{}", app=create):
+        messages = []
+        scope = {"type": "http", "method": "POST", "path": "/v3/assignments",
+                 "headers": [(b"authorization", b"Bearer shared"), (b"idempotency-key", key)]}
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+        await IdempotencyMiddleware(app, store)(scope, receive, send)
+        return messages[0]["status"], dict(messages[0]["headers"]), messages[1]["body"]
+
+    async def duplicates(key):
+        return await asyncio.gather(post(first, key), post(second, key))
+
+    key = uuid.uuid4().hex.encode()
+    # Whichever worker claimed the key first ran it, the other one waited for its response
+    (status_code, headers, body), replayed = sorted(client.portal.call(duplicates, key),
+                                                    key=lambda response: b"idempotent-replayed" in response[1])
+    assert replayed == (201, {**headers, b"idempotent-replayed": b"true"}, body) and len(calls) == 1
+    assert first.stats()["coalesced"] + second.stats()["coalesced"] >= 1
+    assert client.portal.call(post, second, key, b"other")[0] == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # A key left pending by a worker that died is taken over after the lock timeout
+    stale = uuid.uuid4().hex.encode()
+    stale_key = idempotency._digest(b"Bearer shared", b"/v3/assignments", stale)
+    assert first.claim(stale_key, idempotency._digest(b"{}"))[0] == IdempotencyStore.CLAIMED
+    assert client.portal.call(post, second, stale)[0] == status.HTTP_201_CREATED
+    assert len(calls) == 2 and second.taken_over == 1
+
+    # An error response releases the key for a retry
+    async def fail(scope, receive, send):
+        await send({"type": "http.response.start", "status": 503, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+    retried = uuid.uuid4().hex.encode()
+    assert client.portal.call(post, first, retried, b"{}", fail)[0] == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert client.portal.call(post, second, retried)[0] == status.HTTP_201_CREATED
+
+
+def test_assignment_batch_endpoints_apply_bulk_statements(owner_with_assignments, user_with_credentials):
+    user, headers = user_with_credentials
+    body = {"points": 5, "num_of_attemps": 2, "deadline": "2099-01-01T00:00:00"}
+    with SessionLocal() as db:
+        others = db.scalars(select(models.Assignment.id).filter_by(owner_user_id=owner_with_assignments.id)).first()
+    created = client.post('/v3/assignments:batch', headers=headers, json=[
+        dict(body, name="b0"), dict(body, name="b1", points=11), dict(body, name="b2", extra=1), dict(body, name="b3")]).json()
+    assert [item["status"] for item in created] == [201, 400, 400, 201]
+    ids = [created[0]["data"]["id"], created[3]["data"]["id"]]
+
+    statements = []
+    engine = database.async_engine.sync_engine if database.DB_ASYNC else database.engine
+    record = lambda conn, cursor, statement, *args: statements.append(statement)
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        updated = client.patch('/v3/assignments:batch', headers=headers, json=[
+            dict(body, id=ids[0], name="renamed0"), dict(body, id=ids[1], name="renamed1", points=9),
+            dict(body, id=str(others), name="not mine"), dict(body, id=str(uuid.uuid4()), name="missing")]).json()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert [item["status"] for item in updated] == [200, 200, 403, 404]
+    assert updated[1]["data"]["name"] == "renamed1" and updated[1]["data"]["points"] == 9
+    assert len([statement for statement in statements if statement.lstrip().startswith("UPDATE")]) == 1
+
+    deleted = client.request("DELETE", '/v3/assignments:batch', headers=headers, json=ids + [ids[0], "nope"]).json()
+    assert [item["status"] for item in deleted] == [204, 204, 400, 400]
+    assert client.get('/v3/assignments', params={"owner": user.email}).json() == []
+
+
+def test_submission_export_streams_csv_and_ndjson_and_resumes(user_with_credentials, monkeypatch):
+    owner, headers = user_with_credentials
+    with SessionLocal() as db:
+        assignment = models.Assignment(name="graded", points=5, num_of_attemps=5, owner_user_id=owner.id, deadline=datetime(2099, 1, 1))
+        db.add(assignment)
+        db.flush()
+        db.add_all([models.Submission(assignment_id=assignment.id, submission_url="https://example.com/{}.zip".format(i),
+                                      submission_date=datetime(2024, 1, 1 + i)) for i in range(3)])
+        db.commit()
+    checked_out = []
+    stream_export = main.export_chunks
+
+    async def export_chunks(*args):
+        # Only the stream's own connection is held while the rows go out
+        checked_out.append(database.pool_stats()["checked_out"])
+        async for chunk in stream_export(*args):
+            yield chunk
+    monkeypatch.setattr(main, "export_chunks", export_chunks)
+    lines = client.get('/v3/submissions/export', headers=headers).text.splitlines()
+    assert checked_out == [0]
+    rows = [json.loads(line) for line in lines]
+    assert [row["submission_url"][-5:] for row in rows] == ["0.zip", "1.zip", "2.zip"]
+    assert all(row["assignment_name"] == "graded" for row in rows)
+
+    resumed = client.get('/v3/submissions/export', params={"format": "csv", "cursor": rows[0]["cursor"]},
+                         headers=dict(headers, **{"Accept-Encoding": "gzip"}))
+    assert resumed.headers["content-encoding"] == "gzip"
+    assert [line.split(",")[3][-5:] for line in resumed.text.splitlines()] == ["1.zip", "2.zip"]
+
+    output = io.BytesIO()
+    assert export_submissions.export_submissions(owner.email, output, "csv", compress=True, batch_size=2)["rows"] == 3
+    exported = gzip.decompress(output.getvalue()).decode().splitlines()
+    assert exported[0] == ",".join(export_submissions.EXPORT_COLUMNS) and len(exported) == 4
+
+
+def test_assignment_import_streams_validates_and_reports_rejections(user_with_credentials):
+    owner, headers = user_with_credentials
+    headers = dict(headers, **{"Content-Type": "text/csv"})
+    upload = ('points,name,num_of_attemps,deadline\n'
+              '5,"Essay, part\n""one""",3,2099-01-01T00:00:00\n'
+              '11,too many points,3,2099-01-01T00:00:00\n'
+              '5,no attempts,abc,2099-01-01T00:00:00\n'
+              '\n'
+              '10,last,100,2099-01-01T00:00:00').encode()
+    # Chunks of 7 bytes split lines, quoted fields and the header
+    chunks = (upload[i:i + 7] for i in range(0, len(upload), 7))
+    res = client.post('/v3/assignments:import', content=chunks, headers=headers)
+    assert res.status_code == status.HTTP_200_OK
+    summary = res.json()
+    assert (summary["imported"], summary["rejected"]) == (2, 2)
+    assert [(rejection["line"], list(rejection["errors"])) for rejection in summary["rejections"]] == \
+        [(4, ["points"]), (5, ["num_of_attemps"])]
+    with SessionLocal() as db:
+        names = set(db.scalars(select(models.Assignment.name).filter_by(owner_user_id=owner.id)))
+    assert names == {'Essay, part\n"one"', "last"}
+
+    bad_header = client.post('/v3/assignments:import', content=b"name,points\n", headers=headers)
+    assert bad_header.status_code == status.HTTP_400_BAD_REQUEST
+
+    ndjson = b"".join(json.dumps(row).encode() + b"\n" for row in [
+        {"name": "from file", "points": 1, "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"},
+        {"name": "wrong type", "points": "1", "num_of_attemps": 1, "deadline": "2099-01-01T00:00:00"}])
+    summary = import_assignments.import_assignments(owner.email, io.BytesIO(gzip.compress(ndjson + b"[]\n")), "ndjson",
+                                                    compressed=True, batch_size=1)
+    assert (summary["imported"], summary["rejected"]) == (1, 2)
+    assert summary["rejections"][1] == {"line": 3, "errors": {"row": "Expected a JSON object"}}
+
+
+class StubSNS:
+    def __init__(self, failures=1):
+        self.failures = failures
+        self.batch_sizes = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batch_sizes.append(len(PublishBatchRequestEntries))
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Throttled")
+        return {"Successful": [{"Id": entry["Id"]} for entry in PublishBatchRequestEntries], "Failed": []}
+
+
+def test_publisher_batches_retries_and_marks_outbox(owner_with_assignments, monkeypatch):
+    monkeypatch.setattr(events, "SNS_RETRY_BACKOFF", 0)
+    db = SessionLocal()
+    assignment = db.scalars(select(models.Assignment).filter_by(owner_user_id=owner_with_assignments.id)).first()
+    outbox = []
+    for i in range(12):
+        submission = models.Submission(id=uuid.uuid4(), assignment_id=assignment.id,
+                                       submission_url="https://example.com/{}.zip".format(i))
+        outbox.append(submission_event(submission, owner_with_assignments.id, owner_with_assignments.email))
+        db.add_all([submission, outbox[-1]])
+    db.commit()
+    try:
+        sns = StubSNS(failures=1)
+        publisher = SubmissionPublisher(topic_arn="arn:aws:sns:us-east-1:000000000000:test", client=sns)
+        assert all(publisher.enqueue(event) for event in outbox)
+        publisher.flush()
+
+        assert sns.batch_sizes == [10, 10, 2]
+        published = db.scalars(select(models.SubmissionEvent.published_at)
+                               .where(models.SubmissionEvent.id.in_([event.id for event in outbox]))).all()
+        assert len(published) == 12 and all(published)
+        assert publisher.stats()["published"] == 12
+    finally:
+        db.execute(delete(models.SubmissionEvent).where(models.SubmissionEvent.id.in_([event.id for event in outbox])))
+        db.execute(delete(models.Submission).where(models.Submission.assignment_id == assignment.id))
+        db.commit()
+        db.close()
+
+
+def test_outbox_sweep_publishes_without_holding_a_transaction(owner_with_assignments, monkeypatch):
+    monkeypatch.setattr(events, "SNS_RETRY_BACKOFF", 0)
+    db = SessionLocal()
+    assignment = db.scalars(select(models.Assignment).filter_by(owner_user_id=owner_with_assignments.id)).first()
+    outbox = []
+    for i in range(3):
+        submission = models.Submission(id=uuid.uuid4(), assignment_id=assignment.id,
+                                       submission_url="https://example.com/{}.zip".format(i))
+        outbox.append(submission_event(submission, owner_with_assignments.id, owner_with_assignments.email))
+        outbox[-1].created = datetime.utcnow() - timedelta(seconds=events.SNS_OUTBOX_GRACE + 1)
+        db.add_all([submission, outbox[-1]])
+    db.commit()
+    ids = [event.id for event in outbox]
+    leases = []
+
+    class LeaseCheckingSNS(StubSNS):
+        def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+            # Rows are leased and committed, no connection is checked out while SNS is called
+            with SessionLocal() as session:
+                leases.append(session.scalars(select(models.SubmissionEvent.claimed_until)
+                                              .where(models.SubmissionEvent.id.in_(ids))).all())
+            leases[-1].append(database.get_engine().pool.checkedout())
+            return super().publish_batch(TopicArn, PublishBatchRequestEntries)
+
+    try:
+        sns = LeaseCheckingSNS(failures=1)
+        publisher = SubmissionPublisher(topic_arn="arn:aws:sns:us-east-1:000000000000:test", client=sns)
+        publisher.sweep_outbox()
+        assert len(leases) == 2 and all(leases[0][:3]) and leases[0][3] == 0
+        published = db.scalars(select(models.SubmissionEvent.published_at)
+                               .where(models.SubmissionEvent.id.in_(ids))).all()
+        assert len(published) == 3 and all(published)
+
+        # Published or leased rows are not swept again
+        publisher.sweep_outbox()
+        assert len(sns.batch_sizes) == 2
+    finally:
+        db.execute(delete(models.SubmissionEvent).where(models.SubmissionEvent.id.in_(ids)))
+        db.execute(delete(models.Submission).where(models.Submission.assignment_id == assignment.id))
+        db.commit()
+        db.close()
+
+
+def test_attempt_limit_holds_under_concurrent_submitters(owner_with_assignments):
+    db = SessionLocal()
+    assignment = db.scalars(select(models.Assignment).filter_by(owner_user_id=owner_with_assignments.id)).first()
+    assignment.deadline = datetime(2999, 1, 1)
+    db.commit()
+    barrier = threading.Barrier(20)
+
+    def submit(i):
+        session = SessionLocal()
+        try:
+            submission = models.Submission(id=uuid.uuid4(), assignment_id=assignment.id,
+                                           submission_url="https://example.com/{}.zip".format(i),
+                                           submission_date=datetime.utcnow(), submission_updated=datetime.utcnow())
+            event = submission_event(submission, owner_with_assignments.id, owner_with_assignments.email)
+            barrier.wait()
+            if session.bind.dialect.name == "postgresql":
+                inserted = session.execute(submission_insert_statement(submission, event, datetime.now())).first()
+            else:
+                inserted = session.execute(claim_attempt_statement(assignment.id, datetime.now())).first()
+                if inserted:
+                    session.add_all([submission, event])
+            session.commit()
+            return inserted is not None
+        finally:
+            session.close()
+
+    try:
+        with ThreadPoolExecutor(20) as pool:
+            results = list(pool.map(submit, range(20)))
+        assert results.count(True) == assignment.num_of_attemps
+        stored = db.scalars(select(models.Submission.id).filter_by(assignment_id=assignment.id)).all()
+        assert len(stored) == assignment.num_of_attemps
+    finally:
+        db.execute(delete(models.SubmissionEvent).where(models.SubmissionEvent.submission_id.in_(
+            select(models.Submission.id).filter_by(assignment_id=assignment.id))))
+        db.execute(delete(models.Submission).filter_by(assignment_id=assignment.id))
+        db.commit()
+        db.close()
@@ -1,15 +1,26 @@
 # Rest framework imports
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import ORJSONResponse, Response
+from uuid import UUID
+import orjson
 from fastapi import status as st
 
-from logging.config import dictConfig
 import logging
-from log import LogConfig
 
-dictConfig(LogConfig().dict())
 logger = logging.getLogger("cloud")
 
 
+def _json_default(obj):
+    # Drivers such as asyncpg return their own UUID type which orjson does not know
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError
+
+
+def dumps(data, option=0):
+    """Serialize to JSON bytes with orjson, encoding UUID and datetime natively."""
+    return orjson.dumps(data, default=_json_default, option=option)
+
+
 def response(message: str, status_code: int , data=None, headers=None, log_level="error", no_content=False):
     """
     Customize the response for better information delivery.
@@ -17,7 +28,7 @@ def response(message: str, status_code: int , data=None, headers=None, log_level
     :param status: True if the response if for successful api response else False
     :param message: String message to give details
     :param status_code: states code of the response
-    :param data: send data if any
+    :param data: send data if any, already serialized JSON bytes are sent as is
     :param headers: provide headers in the response
     :return: Response class object
     """
@@ -25,13 +36,45 @@ def response(message: str, status_code: int , data=None, headers=None, log_level
         headers = {}
 
     
+    # Formatted lazily on the log listener thread, status_code drives success sampling
     if log_level == 'error':
-        logger.error(message + " {}".format(status_code))
+        logger.error("%s %s", message, status_code, extra={"status_code": status_code})
     else:
-        logger.info(message + " {}".format(status_code))
+        logger.info("%s %s", message, status_code, extra={"status_code": status_code})
     message = message if type(message) in [dict, list] else {"message":message}
 
 
     if status_code == st.HTTP_204_NO_CONTENT or no_content:
         return Response(status_code=status_code, headers=headers, media_type="application/json")
-    return JSONResponse(content=data if data else message, status_code=status_code, headers=headers, media_type="application/json")
\ No newline at end of file
+    if isinstance(data, bytes):
+        return Response(content=data, status_code=status_code, headers=headers, media_type="application/json")
+    return ORJSONResponse(content=data if data else message, status_code=status_code, headers=headers)
+
+
+async def read_body(receive):
+    """
+    Receive the whole request body in ASGI middleware.
+
+    :return: the messages received, to hand on with ``replay_receive``, and the body
+    """
+    messages = []
+    chunks = []
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return messages, b"".join(chunks)
+
+
+def replay_receive(messages, receive):
+    """ASGI receive callable that returns the already received messages first."""
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+
+    return replay